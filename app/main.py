@@ -1,15 +1,34 @@
 # app/main.py
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse, PlainTextResponse, JSONResponse
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
+from typing import List
 from fastapi.middleware.cors import CORSMiddleware
-import json, time, pathlib
+import os, asyncio, json, time
+import anyio
 
 # Import core modules (these should exist in core/)
-from core.nl2sql import nl_to_sql
-from core.validator import is_safe_sql
+from core.nl2sql import (nl_to_sql_async, nl_to_sql_stream_async, normalize_question,
+                         cache_stats as nl2sql_cache_stats, on_schema_refreshed)
+from core.schema_extractor import SchemaRefresher
+from core.validator import is_safe_sql, validator_cache_stats
 import core.executor as executor
-from core.optimizer import analyze_plan_for_issues, compare_plans_and_time
-from core.rewriter import ask_llm_for_rewrites
+from core.optimizer import compare_plans_and_time_async
+from core.rewriter import ask_llm_for_rewrites_async, FLIGHTS as rewrite_flights
+from core.limits import limits_stats
+from core.llm_gateway import gateway_stats
+from core.plan_cache import explain_with_suggestions_async, plan_cache_stats
+from core.benchmark import benchmark_rewrites
+from core.index_advisor import advise_async
+import core.columnar as columnar
+from core.batch import run_batch, BATCH_MAX_ITEMS
+from core.fingerprint import fingerprint
+from core.pagination import fetch_page, PageError, cursor_stats, close_all_cursors
+from core.admission import AdmissionRejected, admission_stats
+from core.logwriter import LOG_WRITER, begin_request, end_request, annotate, stage, log_event
+import core.metrics as metrics
 
 app = FastAPI(title="LLM SQL Agent API")
 
@@ -22,12 +41,82 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Keeps schema.json and the in-memory prompt schema in sync with the database
+schema_refresher = SchemaRefresher(on_change=on_schema_refreshed)
+
+@app.on_event("startup")
+async def start_schema_refresher():
+    schema_refresher.start()
+
+@app.on_event("shutdown")
+async def stop_schema_refresher():
+    await run_in_threadpool(schema_refresher.stop)
+    await run_in_threadpool(LOG_WRITER.close)
+    close_all_cursors()
+
+# Per-request stage timings in a Server-Timing header (read by scripts/loadtest.py)
+SERVER_TIMING = os.getenv("SERVER_TIMING", "1") not in ("0", "false", "")
+
+def _server_timing(ctx):
+    parts = [f"{name};dur={ms}" for name, ms in ctx["stages"].items()]
+    parts.append(f"total;dur={round((time.perf_counter() - ctx['started']) * 1000.0, 3)}")
+    return ", ".join(parts)
+
+@app.middleware("http")
+async def request_log_middleware(request: Request, call_next):
+    # One JSON log line per request, written by core.logwriter's background thread
+    ctx = begin_request(request.url.path, (request.headers.get("x-request-id") or "")[:64] or None)
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = ctx["request_id"]
+        if SERVER_TIMING:
+            # stages finished so far (all of them, except for streamed bodies)
+            response.headers["Server-Timing"] = _server_timing(ctx)
+        return response
+    finally:
+        end_request(ctx, status)
+        # label by route template, not raw path, to keep label cardinality bounded
+        route = request.scope.get("route")
+        endpoint = getattr(route, "path", "unmatched")
+        elapsed = time.perf_counter() - ctx["started"]
+        metrics.REQUEST_SECONDS.observe(elapsed, method=request.method, endpoint=endpoint)
+        metrics.REQUESTS.inc(method=request.method, endpoint=endpoint, status=status)
+
+# Point-in-time gauges, read on each /metrics scrape
+def _pool_gauges():
+    st = executor.pool_stats()
+    out = {("sync", k): st.get(k) for k in ("size", "idle", "in_use", "max_size")}
+    for k in ("size", "idle", "in_use", "max_size"):
+        out[("async", k)] = st.get("async", {}).get(k)
+    return out
+
+def _limit_gauges():
+    return {(name, k): v for name, st in limits_stats().items() for k, v in st.items()}
+
+metrics.gauge("sqlagent_db_pool_connections", "Database pool connections by pool and state.",
+              _pool_gauges, ("pool", "state"))
+metrics.gauge("sqlagent_concurrency_slots", "LLM/DB concurrency limiter state.",
+              _limit_gauges, ("limit", "state"))
+metrics.gauge("sqlagent_log_records", "Structured log writer queue and totals.",
+              lambda: {(k,): v for k, v in LOG_WRITER.stats().items() if k != "path"}, ("state",))
+
 # --- Pydantic models ---
 class NLQuery(BaseModel):
     question: str
 
 class SQLPayload(BaseModel):
     sql: str
+    # paging: set page_size for the first page, then send back next_page_token
+    page_size: int = None
+    page_token: str = None
+    page_mode: str = "auto"  # auto, keyset or cursor
+
+class StreamPayload(BaseModel):
+    sql: str
+    batch_size: int = None
+    max_rows: int = None
 
 class OptimizePayload(BaseModel):
     sql: str
@@ -36,93 +125,445 @@ class OptimizePayload(BaseModel):
 class RewritePayload(BaseModel):
     sql: str
 
-# --- helper for safe logging ---
-LOG_PATH = pathlib.Path("agent_logs.csv")
+class NLBatchPayload(BaseModel):
+    questions: List[str]
+    parallelism: int = None
+    explain: bool = False  # also attach the EXPLAIN plan suggestions, like /nl2sql
 
-def append_log(line: str):
-    # Safe append to CSV-like file
-    try:
-        with open(LOG_PATH, "a", encoding="utf-8") as f:
-            f.write(line + "\n")
-    except Exception:
-        pass
+class SQLBatchPayload(BaseModel):
+    queries: List[str]
+    parallelism: int = None
+    row_limit: int = 5000
 
 # --- endpoints ---
 
 @app.post("/nl2sql")
-def nl2sql_endpoint(payload: NLQuery):
+async def nl2sql_endpoint(payload: NLQuery):
     q = payload.question
-    out = nl_to_sql(q)
+    annotate(question=q)
+    with stage("llm"):
+        out = await nl_to_sql_async(q)
     sql = out.get("sql") if isinstance(out, dict) else (out or "")
     explain = out.get("explain") if isinstance(out, dict) else ""
+    annotate(sql=sql)
     # Validate before returning; don't execute here
-    ok, msg = is_safe_sql(sql)
+    with stage("validate"):
+        ok, msg = is_safe_sql(sql)
     if not ok:
+        annotate(ok=False, error=msg)
         return {"ok": False, "error": msg, "sql": sql}
     # Get EXPLAIN (FORMAT JSON) plan for summary (not ANALYZE)
     try:
-        plan = executor.explain_query(sql)
-        suggestions = analyze_plan_for_issues(plan)
+        with stage("explain"):
+            plan, suggestions, plan_cached = await explain_with_suggestions_async(sql)
+        annotate(plan_cache="hit" if plan_cached else "miss")
     except Exception as e:
         plan = None
         suggestions = [f"Error generating plan: {str(e)}"]
-    # Log minimal info
-    append_log(f"{time.time()}|nl2sql|{q.replace('|',' ')}|{bool(sql)}")
+        annotate(error=str(e))
+    annotate(ok=True)
     return {"ok": True, "sql": sql, "explain": explain, "plan": plan, "suggestions": suggestions}
 
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+async def _check_sql(sql):
+    # what /nl2sql does after generation: safety check, then EXPLAIN and suggestions
+    t0 = time.perf_counter()
+    ok, msg = is_safe_sql(sql)
+    out = {"sql": sql, "ok": ok, "error": None if ok else msg, "plan": None, "suggestions": [],
+           "plan_cached": None}
+    if ok:
+        try:
+            out["plan"], out["suggestions"], out["plan_cached"] = await explain_with_suggestions_async(sql)
+        except Exception as e:
+            out["suggestions"] = [f"Error generating plan: {str(e)}"]
+    out["check_ms"] = round((time.perf_counter() - t0) * 1000.0, 3)
+    return out
+
+@app.post("/nl2sql/stream")
+async def nl2sql_stream_endpoint(payload: NLQuery):
+    """
+    /nl2sql as server-sent events: "token" events carry LLM output as it is
+    generated; "sql" is sent as soon as the sql field of the answer is complete,
+    and validation + EXPLAIN start right then, while the explanation is still
+    streaming; "plan" carries their result; "done" has the same body as /nl2sql.
+    """
+    q = payload.question
+    annotate(question=q, streaming=True)
+    started = time.perf_counter()
+
+    async def events():
+        first_token_ms = None
+        check = None
+        result = {}
+        cached = False
+        try:
+            async for ev in nl_to_sql_stream_async(q):
+                if ev["type"] == "token":
+                    if first_token_ms is None:
+                        first_token_ms = round((time.perf_counter() - started) * 1000.0, 3)
+                    yield _sse("token", {"text": ev["text"]})
+                elif ev["type"] == "sql":
+                    check = asyncio.ensure_future(_check_sql(ev["sql"] or ""))
+                    yield _sse("sql", {"sql": ev["sql"]})
+                else:
+                    result, cached = ev["result"], ev["cached"]
+            sql = result.get("sql") or ""
+            if check is None:
+                check = asyncio.ensure_future(_check_sql(sql))
+            checked = await check
+            if checked["sql"] != sql:
+                # the streamed sql field was superseded (fallback after a mid-stream failure)
+                checked = await _check_sql(sql)
+        except BaseException:
+            if check is not None:
+                check.cancel()
+            log_event("stream_done", endpoint="/nl2sql/stream", error="client disconnected or failed",
+                      duration_ms=round((time.perf_counter() - started) * 1000.0, 3))
+            raise
+        yield _sse("plan", {"ok": checked["ok"], "error": checked["error"], "plan": checked["plan"],
+                            "suggestions": checked["suggestions"]})
+        if checked["ok"]:
+            body = {"ok": True, "sql": sql, "explain": result.get("explain", ""),
+                    "plan": checked["plan"], "suggestions": checked["suggestions"]}
+        else:
+            body = {"ok": False, "error": checked["error"], "sql": sql}
+        yield _sse("done", body)
+        log_event("stream_done", endpoint="/nl2sql/stream", sql=sql, ok=checked["ok"],
+                  error=checked["error"], cache="hit" if cached else "miss",
+                  plan_cache=None if checked["plan_cached"] is None else ("hit" if checked["plan_cached"] else "miss"),
+                  first_token_ms=first_token_ms, check_ms=checked["check_ms"],
+                  duration_ms=round((time.perf_counter() - started) * 1000.0, 3))
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.post("/execute")
-def execute_endpoint(payload: SQLPayload):
+async def execute_endpoint(payload: SQLPayload, request: Request):
     sql = payload.sql
-    ok, msg = is_safe_sql(sql)
+    annotate(sql=sql)
+    with stage("validate"):
+        ok, msg = is_safe_sql(sql)
     if not ok:
+        annotate(ok=False, error=msg)
         return {"ok": False, "error": msg}
+    # Opt-in columnar encodings via Accept; default stays {"columns", "rows"} JSON
+    fmt = columnar.negotiate(request.headers.get("accept"))
+    if payload.page_size or payload.page_token:
+        return await _execute_page(payload, fmt)
     try:
-        res = executor.run_readonly_query(sql)
-        append_log(f"{time.time()}|execute|{sql.replace('|',' ')}|rows:{len(res.get('rows',[]))}")
-        return {"ok": True, "result": res}
+        with stage("query"):
+            res, cache = await executor.run_readonly_query_cached_async(sql)
+        annotate(ok=True, rows=len(res.get("rows", [])), cache="hit" if cache["cached"] else "miss",
+                 format=fmt or "json")
+        if fmt:
+            with stage("encode"):
+                return _columnar_response(res, cache, fmt)
+        return {"ok": True, "result": res, "cached": cache["cached"], "age_s": cache["age_s"]}
+    except AdmissionRejected as e:
+        return _rejected(e)
+    except Exception as e:
+        annotate(ok=False, error=str(e))
+        return {"ok": False, "error": str(e)}
+
+def _rejected(e):
+    # a saturated cost class is worth retrying later; a query over the limits is not
+    annotate(ok=False, error=str(e), admission=e.decision.get("class") or "over_limit")
+    return JSONResponse({"ok": False, "error": str(e), "admission": e.decision},
+                        status_code=429 if e.decision.get("class") else 422)
+
+async def _execute_page(payload, fmt):
+    """One page of /execute; the result cache is bypassed."""
+    try:
+        with stage("query"):
+            res, next_token, page = await fetch_page(payload.sql, payload.page_size, payload.page_token,
+                                                     payload.page_mode)
+        annotate(ok=True, rows=page["rows"], page_mode=page["mode"], page_offset=page["offset"],
+                 format=fmt or "json")
+        if fmt:
+            with stage("encode"):
+                resp = _columnar_response(res, {"cached": False, "age_s": 0.0}, fmt)
+            if next_token:
+                resp.headers["X-Next-Page-Token"] = next_token
+            return resp
+        return {"ok": True, "result": res, "next_page_token": next_token, "page": page}
+    except AdmissionRejected as e:
+        return _rejected(e)
+    except Exception as e:
+        annotate(ok=False, error=str(e))
+        return {"ok": False, "error": str(e)}
+
+def _columnar_response(res, cache, fmt):
+    batches = columnar.batched(res["rows"], executor.STREAM_BATCH_SIZE)
+    if fmt == columnar.ARROW_MEDIA_TYPE:
+        body = columnar.encode_arrow(res["columns"], res["types"], batches)
+    else:
+        body = columnar.encode_columnar_json(res["columns"], res["types"], batches)
+    headers = {
+        "X-Cache": "hit" if cache["cached"] else "miss",
+        "X-Data-Age-S": str(cache["age_s"]),
+        "X-Row-Count": str(len(res["rows"])),
+    }
+    return Response(content=body, media_type=fmt, headers=headers)
+
+@app.post("/execute/stream")
+async def execute_stream_endpoint(payload: StreamPayload, request: Request):
+    """
+    Streams query results as NDJSON: a {"columns": ...} line, one {"rows": ...}
+    line per server-side cursor batch, then {"done": true, "row_count": n}.
+    With Accept: application/vnd.apache.arrow.stream the same batches are sent
+    as Arrow IPC record batches instead.
+    """
+    sql = payload.sql
+    annotate(sql=sql, streaming=True)
+    with stage("validate"):
+        ok, msg = is_safe_sql(sql)
+    if not ok:
+        annotate(ok=False, error=msg)
+        return {"ok": False, "error": msg}
+    # the request line is logged when headers go out; this event records the finished stream
+    started = time.perf_counter()
+
+    def stream_done(count, error=None):
+        log_event("stream_done", endpoint="/execute/stream", rows=count, error=error,
+                  duration_ms=round((time.perf_counter() - started) * 1000.0, 3))
+
+    # the admission slot is taken before the response starts and held until the stream ends
+    try:
+        with stage("admission"):
+            _, free_slot = await executor.admit_stream_async(sql)
+    except AdmissionRejected as e:
+        return _rejected(e)
     except Exception as e:
+        annotate(ok=False, error=str(e))
         return {"ok": False, "error": str(e)}
+    chunks = executor.stream_readonly_query(sql, payload.batch_size, max_rows=payload.max_rows, admitted=True)
+
+    async def release():
+        # closes the server-side cursor (in a worker thread, like the fetches), then frees
+        # the slot; shielded, as a client disconnect cancels the response task
+        with anyio.CancelScope(shield=True):
+            try:
+                await run_in_threadpool(chunks.close)
+            finally:
+                await free_slot()
+
+    if columnar.negotiate(request.headers.get("accept")) == columnar.ARROW_MEDIA_TYPE:
+        annotate(format="arrow")
+        try:
+            # run up to the first FETCH here so SQL errors still get a JSON answer
+            with stage("first_batch"):
+                head = await run_in_threadpool(next, chunks)
+        except Exception as e:
+            await release()
+            annotate(ok=False, error=str(e))
+            return {"ok": False, "error": str(e)}
+
+        def batches():
+            count = 0
+            try:
+                for c in chunks:
+                    count += len(c["rows"])
+                    yield c["rows"]
+            except Exception as e:
+                stream_done(count, str(e))
+                raise
+            stream_done(count)
+
+        async def arrow():
+            try:
+                async for part in iterate_in_threadpool(
+                        columnar.iter_arrow_stream(head["columns"], head["types"], batches())):
+                    yield part
+            finally:
+                await release()
+
+        body = arrow()
+        return StreamingResponse(body, media_type=columnar.ARROW_MEDIA_TYPE, background=BackgroundTask(body.aclose))
+
+    annotate(format="ndjson")
+
+    async def ndjson():
+        count = 0
+        error = None
+        try:
+            # the sync generator runs in worker threads, one batch at a time
+            async for chunk in iterate_in_threadpool(chunks):
+                count += len(chunk.get("rows", ()))
+                with metrics.time_stage("serialize"):
+                    line = json.dumps(chunk, default=str) + "\n"
+                yield line
+            yield json.dumps({"done": True, "row_count": count}) + "\n"
+        except Exception as e:
+            error = str(e)
+            yield json.dumps({"done": True, "row_count": count, "error": error}) + "\n"
+        finally:
+            await release()
+        stream_done(count, error)
+
+    # a client disconnect abandons the body mid-way; closing it runs its finally
+    body = ndjson()
+    return StreamingResponse(body, media_type="application/x-ndjson", background=BackgroundTask(body.aclose))
+
+async def _nl2sql_item(q, with_plan):
+    # same steps as /nl2sql, without the per-request overhead
+    out = await nl_to_sql_async(q)
+    sql = out.get("sql") if isinstance(out, dict) else (out or "")
+    ok, msg = is_safe_sql(sql)
+    if not ok:
+        return {"ok": False, "error": msg, "sql": sql}
+    res = {"ok": True, "sql": sql, "explain": out.get("explain", "") if isinstance(out, dict) else ""}
+    if with_plan:
+        try:
+            _, res["suggestions"], _ = await explain_with_suggestions_async(sql)
+        except Exception as e:
+            res["suggestions"] = [f"Error generating plan: {str(e)}"]
+    return res
+
+async def _execute_item(sql, row_limit):
+    ok, msg = is_safe_sql(sql)
+    if not ok:
+        return {"ok": False, "error": msg}
+    try:
+        res, cache = await executor.run_readonly_query_cached_async(sql, row_limit=row_limit)
+    except AdmissionRejected as e:
+        return {"ok": False, "error": str(e), "admission": e.decision}
+    return {"ok": True, "result": res, "cached": cache["cached"], "age_s": cache["age_s"]}
+
+def _batch_response(endpoint, items, key_fn, worker, parallelism):
+    """
+    NDJSON: one {"index", ...result} line per input item as results complete
+    (identical items are run once; copies carry "duplicate_of"), then a
+    {"done": true, ...} summary line.
+    """
+    started = time.perf_counter()
+    annotate(items=len(items), parallelism=parallelism)
+
+    async def lines():
+        errors = unique = 0
+        try:
+            async for positions, result in run_batch(items, key_fn, worker, parallelism):
+                unique += 1
+                if isinstance(result, Exception):
+                    result = {"ok": False, "error": str(result)}
+                if not result.get("ok"):
+                    errors += len(positions)
+                with metrics.time_stage("serialize"):
+                    for n, i in enumerate(positions):
+                        line = {"index": i, **result}
+                        if n:
+                            line["duplicate_of"] = positions[0]
+                        yield json.dumps(line, default=str) + "\n"
+        finally:
+            log_event("stream_done", endpoint=endpoint, items=len(items), unique=unique, errors=errors,
+                      duration_ms=round((time.perf_counter() - started) * 1000.0, 3))
+        yield json.dumps({"done": True, "count": len(items), "unique": unique, "errors": errors,
+                          "duration_ms": round((time.perf_counter() - started) * 1000.0, 3)}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.post("/nl2sql/batch")
+async def nl2sql_batch_endpoint(payload: NLBatchPayload):
+    """
+    Many questions in one request. Questions that normalize to the same text
+    (see nl2sql.normalize_question) are generated once.
+    """
+    if len(payload.questions) > BATCH_MAX_ITEMS:
+        return {"ok": False, "error": f"At most {BATCH_MAX_ITEMS} items per batch."}
+    return _batch_response("/nl2sql/batch", payload.questions, normalize_question,
+                           lambda q: _nl2sql_item(q, payload.explain), payload.parallelism)
+
+@app.post("/execute/batch")
+async def execute_batch_endpoint(payload: SQLBatchPayload):
+    """
+    Many queries in one request, each validated and run as in /execute
+    (including the result cache). Queries with the same fingerprint run once.
+    """
+    if len(payload.queries) > BATCH_MAX_ITEMS:
+        return {"ok": False, "error": f"At most {BATCH_MAX_ITEMS} items per batch."}
+    return _batch_response("/execute/batch", payload.queries, fingerprint,
+                           lambda q: _execute_item(q, payload.row_limit), payload.parallelism)
 
 @app.post("/optimize")
-def optimize_endpoint(payload: OptimizePayload):
+async def optimize_endpoint(payload: OptimizePayload):
     sql = payload.sql
     idx_sql = payload.index_sql
-    ok, msg = is_safe_sql(sql)
+    annotate(sql=sql, index_sql=idx_sql)
+    with stage("validate"):
+        ok, msg = is_safe_sql(sql)
     if not ok:
+        annotate(ok=False, error=msg)
         return {"ok": False, "error": msg}
     try:
-        res = compare_plans_and_time(sql, simulate_index_stmt=idx_sql, executor_module=executor)
+        if idx_sql:
+            # test one given index inside a rolled-back transaction
+            with stage("index_test"):
+                res = await compare_plans_and_time_async(sql, simulate_index_stmt=idx_sql, executor_module=executor)
+            orig_t = res.get("original", {}).get("time_ms")
+            with_idx_t = res.get("with_index", {}).get("time_ms")
+        else:
+            # derive candidate indexes from the plan and evaluate each what-if style
+            with stage("advisor"):
+                res = await advise_async(sql, executor_module=executor)
+            orig_t = res["original"]["time_ms"]
+            best = res["candidates"][0] if res["candidates"] else {}
+            with_idx_t = best.get("time_ms")
+            annotate(candidates=len(res["candidates"]))
         # Log original and index times (if present)
-        orig_t = res.get("original", {}).get("time_ms")
-        with_idx_t = res.get("with_index", {}).get("time_ms")
-        append_log(f"{time.time()}|optimize|{sql.replace('|',' ')}|orig:{orig_t}|with_idx:{with_idx_t}")
+        annotate(ok=True, original_ms=orig_t, with_index_ms=with_idx_t)
         return {"ok": True, "result": res}
     except Exception as e:
+        annotate(ok=False, error=str(e))
         return {"ok": False, "error": str(e)}
 
 @app.post("/rewrite_and_test")
-def rewrite_and_test(payload: RewritePayload):
+async def rewrite_and_test(payload: RewritePayload):
     sql = payload.sql
-    ok, msg = is_safe_sql(sql)
+    annotate(sql=sql)
+    with stage("validate"):
+        ok, msg = is_safe_sql(sql)
     if not ok:
+        annotate(ok=False, error=msg)
         return {"ok": False, "error": msg}
     try:
-        rew = ask_llm_for_rewrites(sql)
-        cands = rew.get("candidates", [])
-        results = {"original": None, "candidates": []}
-        res_orig = compare_plans_and_time(sql, executor_module=executor)
-        results["original"] = {"time_ms": res_orig["original"]["time_ms"]}
-        for c in cands:
+        with stage("llm"):
+            rew = await ask_llm_for_rewrites_async(sql)
+        cands = []
+        for c in rew.get("candidates", []):
             cand_sql = c.get("sql")
             if not cand_sql:
                 continue
             safe, _ = is_safe_sql(cand_sql)
             if not safe:
                 continue
-            r = compare_plans_and_time(cand_sql, executor_module=executor)
-            results["candidates"].append({"sql": cand_sql, "time_ms": r.get("original", {}).get("time_ms"), "note": c.get("note", "")})
-        results["candidates"].sort(key=lambda x: x.get("time_ms") or 1e9)
-        append_log(f"{time.time()}|rewrite|{sql.replace('|',' ')}|cands:{len(results['candidates'])}")
+            cands.append(c)
+        # warm-up + interleaved repeated runs, candidates in parallel on separate connections
+        with stage("benchmark"):
+            results = await benchmark_rewrites(sql, cands, executor_module=executor)
+        annotate(ok=True, candidates=len(results["candidates"]), rejected=len(results["rejected"]),
+                 faster=sum(1 for c in results["candidates"] if c.get("verdict") == "faster"))
         return {"ok": True, "result": results, "raw_rewrites": rew}
     except Exception as e:
+        annotate(ok=False, error=str(e))
         return {"ok": False, "error": str(e)}
+
+@app.get("/pool_stats")
+async def pool_stats_endpoint():
+    # Connection pool utilisation, checkout wait times, LLM/DB concurrency slots, LLM circuit state
+    # and database node health
+    return {"ok": True, "pool": executor.pool_stats(), "limits": limits_stats(), "llm": gateway_stats(),
+            "cursors": cursor_stats(), "routing": executor.routing_stats(), "admission": admission_stats()}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # Prometheus text format: stage/request latency histograms, counters and gauges
+    return PlainTextResponse(metrics.render(), media_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
+@app.get("/cache_stats")
+async def cache_stats_endpoint():
+    # Hit/miss counters for the NL->SQL answer, query result and plan caches
+    return {"ok": True, "nl2sql": nl2sql_cache_stats(), "results": executor.RESULT_CACHE.stats(),
+            "plans": plan_cache_stats(), "validator": validator_cache_stats(),
+            "rewrite_singleflight": rewrite_flights.stats(),
+            "schema": schema_refresher.stats()}
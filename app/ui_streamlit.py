@@ -1,22 +1,54 @@
 # app/ui_streamlit.py
 import streamlit as st
+import os
 import requests, json, time
+import pyarrow as pa  # installed with streamlit
 from pathlib import Path
 
 API = "http://127.0.0.1:8000"  # keep FastAPI running for backend endpoints
+ARROW = "application/vnd.apache.arrow.stream"
 st.set_page_config(page_title="LLM SQL Agent", layout="wide")
 st.title("LLM SQL Agent — Demo")
 
 q = st.text_input("Ask a question about the database", "Show the total rental revenue per month for 2006")
 
+def sse_events(resp):
+    # (event, data) pairs from a text/event-stream response
+    event, data = "message", []
+    for line in resp.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].lstrip())
+
 if st.button("Generate SQL"):
-    with st.spinner("Generating SQL..."):
-        try:
-            r = requests.post(f"{API}/nl2sql", json={"question": q}, timeout=30)
-            data = r.json()
-        except Exception as e:
-            st.error(f"API error: {e}")
-            data = {"ok": False, "error": str(e)}
+    # tokens appear as the LLM writes them; the SQL is validated and EXPLAINed
+    # while the explanation is still streaming
+    raw = st.empty()
+    status = st.empty()
+    text = ""
+    data = {"ok": False, "error": "No response"}
+    try:
+        with requests.post(f"{API}/nl2sql/stream", json={"question": q}, stream=True, timeout=60) as r:
+            for event, payload in sse_events(r):
+                if event == "token":
+                    text += payload["text"]
+                    raw.code(text, language="json")
+                elif event == "sql":
+                    status.caption("SQL complete, checking plan...")
+                elif event == "done":
+                    data = payload
+    except Exception as e:
+        st.error(f"API error: {e}")
+        data = {"ok": False, "error": str(e)}
+    raw.empty()
+    status.empty()
     if not data.get("ok"):
         st.error(data.get("error","Unknown error"))
     else:
@@ -33,28 +65,49 @@ if "last_sql" in st.session_state:
     if st.button("Run Query (preview)"):
         with st.spinner("Running query..."):
             try:
-                r = requests.post(f"{API}/execute", json={"sql": sql}, timeout=60)
-                res = r.json()
+                # Ask for Arrow; the API answers with plain JSON if it cannot produce it
+                r = requests.post(f"{API}/execute", json={"sql": sql}, timeout=60,
+                                  headers={"Accept": f"{ARROW}, application/json;q=0.5"})
+                if r.headers.get("content-type", "").startswith(ARROW):
+                    res = {
+                        "ok": True,
+                        "table": pa.ipc.open_stream(r.content).read_all(),
+                        "cached": r.headers.get("x-cache") == "hit",
+                        "age_s": float(r.headers.get("x-data-age-s", 0)),
+                    }
+                else:
+                    res = r.json()
             except Exception as e:
                 st.error(f"API error: {e}")
                 res = {"ok": False, "error": str(e)}
         if not res.get("ok"):
             st.error(res.get("error"))
         else:
-            rows = res["result"]
-            st.dataframe([dict(zip(rows["columns"], row)) for row in rows["rows"][:50]])
+            if res.get("cached"):
+                st.caption(f"Served from cache (data age {res.get('age_s', 0):.1f}s)")
+            if "table" in res:
+                st.dataframe(res["table"].slice(0, 50))
+            else:
+                rows = res["result"]
+                st.dataframe([dict(zip(rows["columns"], row)) for row in rows["rows"][:50]])
 
-    if st.button("Optimize (simulate index)"):
-        idx = "CREATE INDEX IF NOT EXISTS idx_payment_payment_date ON payment (payment_date);"
-        with st.spinner("Creating index and testing..."):
+    idx = st.text_input("Index to test (optional, leave empty for automatic suggestions)", "")
+    if st.button("Optimize (suggest indexes)"):
+        body = {"sql": sql, "index_sql": idx.strip() or None}
+        with st.spinner("Evaluating indexes (nothing is committed)..."):
             try:
-                r = requests.post(f"{API}/optimize", json={"sql": sql, "index_sql": idx}, timeout=120)
+                r = requests.post(f"{API}/optimize", json=body, timeout=120)
                 res = r.json()
             except Exception as e:
                 st.error(f"API error: {e}")
                 res = {"ok": False, "error": str(e)}
         if res.get("ok"):
-            st.write(res["result"])
+            result = res["result"]
+            if "candidates" in result:
+                st.write("Original:", result["original"])
+                st.dataframe(result["candidates"])
+            else:
+                st.write(result)
         else:
             st.error(res.get("error"))
 
@@ -75,12 +128,28 @@ if "last_sql" in st.session_state:
             st.error(res.get("error"))
 
 st.sidebar.markdown("## Logs")
-logf = Path("agent_logs.csv")
+logf = Path(os.getenv("AGENT_LOG_PATH", "agent_logs.jsonl"))
 if logf.exists():
     st.write("Recent logs (last 10):")
+    # only read the tail; the file can be up to AGENT_LOG_MAX_BYTES
+    with open(logf, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 64 * 1024))
+        lines = f.read().decode("utf-8", "replace").splitlines()[-10:]
     df = []
-    with open(logf, "r", encoding="utf-8") as f:
-        lines = f.read().strip().splitlines()[-10:]
-        for ln in lines:
-            df.append(ln.split("|"))
+    for ln in lines:
+        try:
+            rec = json.loads(ln)
+        except Exception:
+            continue
+        df.append({
+            "time": time.strftime("%H:%M:%S", time.localtime(rec.get("ts", 0))),
+            "endpoint": rec.get("endpoint") or rec.get("event"),
+            "status": rec.get("status"),
+            "ms": rec.get("duration_ms"),
+            "stages": ", ".join(f"{k} {v:.0f}" for k, v in (rec.get("stages") or {}).items()),
+            "rows": rec.get("rows"),
+            "cache": rec.get("cache"),
+            "request_id": rec.get("request_id"),
+        })
     st.table(df)
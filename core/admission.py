@@ -0,0 +1,360 @@
+# core/admission.py
+import os
+import logging
+import re
+import sys
+import time
+import asyncio
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from dotenv import load_dotenv
+load_dotenv()
+
+from core.limits import _Limit, DB_CONCURRENCY
+from core.fingerprint import fingerprint
+from core.metrics import counter, gauge, time_stage
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+# Planner estimates (EXPLAIN "Total Cost", in the server's cost units) that
+# separate the classes: cost <= CHEAP is cheap, cost > EXPENSIVE is expensive
+ADMISSION_CHEAP_COST = float(os.getenv("ADMISSION_CHEAP_COST", "10000"))
+ADMISSION_EXPENSIVE_COST = float(os.getenv("ADMISSION_EXPENSIVE_COST", "1000000"))
+# Above either limit a query is rejected without running
+ADMISSION_MAX_COST = float(os.getenv("ADMISSION_MAX_COST", "100000000"))
+ADMISSION_MAX_ROWS = float(os.getenv("ADMISSION_MAX_ROWS", "10000000"))
+# Concurrent queries per class as "class=n" entries; by default the database
+# slots are split 6/3/1, so cheap queries always have slots of their own
+ADMISSION_SLOTS = os.getenv("ADMISSION_SLOTS", "")
+# A query waiting longer than this for a slot of its class, or arriving while
+# this many already wait, is rejected (retry later) instead of queueing further
+ADMISSION_MAX_WAIT_S = float(os.getenv("ADMISSION_MAX_WAIT_S", "30"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+# Estimates are kept per statement text for this long
+ADMISSION_ESTIMATE_TTL_S = float(os.getenv("ADMISSION_ESTIMATE_TTL_S", "300"))
+ADMISSION_ESTIMATE_CACHE_SIZE = int(os.getenv("ADMISSION_ESTIMATE_CACHE_SIZE", "2048"))
+
+CLASSES = ("cheap", "medium", "expensive")
+
+DECISIONS = counter(
+    "sqlagent_admission_total",
+    "Admission decisions by cost class and outcome (admitted, rejected, timeout, queue_full).",
+    ("cost_class", "outcome"),
+)
+
+
+class AdmissionRejected(Exception):
+    """The query was not run: too expensive, or its cost class is saturated."""
+
+    def __init__(self, message, decision):
+        super().__init__(message)
+        self.decision = decision
+
+
+def _default_slots(total):
+    expensive = max(1, total // 10)
+    medium = max(1, total * 3 // 10)
+    return {"cheap": max(1, total - medium - expensive), "medium": medium, "expensive": expensive}
+
+
+def _parse_slots(text, total):
+    slots = _default_slots(total)
+    for entry in text.replace(",", " ").split():
+        name, sep, value = entry.partition("=")
+        name = name.strip().lower()
+        if not sep or name not in CLASSES or not value.strip().isdigit():
+            logger.warning("ignoring ADMISSION_SLOTS entry %r", entry)
+            continue
+        slots[name] = int(value)
+    return slots
+
+
+SLOTS = {name: _Limit(f"admission_{name}", size)
+         for name, size in _parse_slots(ADMISSION_SLOTS, DB_CONCURRENCY).items()}
+
+
+# --- estimates ---
+
+class _EstimateCache:
+    """LRU of (total_cost, plan_rows) by statement fingerprint, with a TTL."""
+
+    def __init__(self, max_entries, ttl_s):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if time.monotonic() - item[2] > self.ttl_s:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[0], item[1]
+
+    def put(self, key, cost, rows):
+        with self._lock:
+            self._data[key] = (cost, rows, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+ESTIMATES = _EstimateCache(ADMISSION_ESTIMATE_CACHE_SIZE, ADMISSION_ESTIMATE_TTL_S)
+
+
+# EXPLAIN and its options, up to the statement being explained
+_EXPLAIN_PREFIX = re.compile(
+    r"^\s*explain\s*(?:\([^)]*\)|(?:\s*\b(?:analy[sz]e|verbose)\b)*)\s*", re.IGNORECASE)
+
+
+def _planned_statement(sql_text):
+    """
+    The statement whose estimates count: sql_text itself, the explained
+    statement for EXPLAIN ANALYZE (it runs), or None for a plain EXPLAIN.
+    """
+    m = _EXPLAIN_PREFIX.match(sql_text)
+    if not m:
+        return sql_text
+    if not re.search(r"\banaly[sz]e\b", m.group(0), re.IGNORECASE):
+        return None
+    return sql_text[m.end():]
+
+
+def plan_estimates(plan_json):
+    """(Total Cost, Plan Rows) of the top plan node in EXPLAIN (FORMAT JSON) output."""
+    root = plan_json[0] if isinstance(plan_json, list) else plan_json
+    node = root.get("Plan", root)
+    return float(node.get("Total Cost", 0.0)), float(node.get("Plan Rows", 0.0))
+
+
+def classify(cost, rows):
+    """Cost class for planner estimates, or None when they exceed the limits."""
+    if cost > ADMISSION_MAX_COST or rows > ADMISSION_MAX_ROWS:
+        return None
+    if cost <= ADMISSION_CHEAP_COST:
+        return "cheap"
+    if cost <= ADMISSION_EXPENSIVE_COST:
+        return "medium"
+    return "expensive"
+
+
+def _decide(cost, rows, cached):
+    decision = {"class": classify(cost, rows), "cost": round(cost, 2), "rows": int(rows),
+                "estimate_cached": cached}
+    if decision["class"] is None:
+        DECISIONS.inc(cost_class="over_limit", outcome="rejected")
+        limit = (f"estimated cost {cost:,.0f} exceeds {ADMISSION_MAX_COST:,.0f}" if cost > ADMISSION_MAX_COST
+                 else f"estimated {rows:,.0f} rows exceed {ADMISSION_MAX_ROWS:,.0f}")
+        raise AdmissionRejected(f"Query rejected by admission control: {limit}. "
+                                "Add filters, join conditions or a LIMIT.", decision)
+    return decision
+
+
+async def estimate_async(sql_text, explain):
+    """
+    Classifies sql_text from its EXPLAIN estimates; explain(sql) is a
+    coroutine function returning EXPLAIN (FORMAT JSON) output.
+    Returns {"class", "cost", "rows", "estimate_cached"}; raises
+    AdmissionRejected when the estimates exceed the limits.
+    """
+    sql_text = _planned_statement(sql_text)
+    if sql_text is None:
+        return _decide(0.0, 0.0, True)
+    key = fingerprint(sql_text)
+    hit = ESTIMATES.get(key)
+    if hit is None:
+        with time_stage("admission_explain"):
+            cost, rows = plan_estimates(await explain(sql_text))
+        ESTIMATES.put(key, cost, rows)
+    else:
+        cost, rows = hit
+    return _decide(cost, rows, hit is not None)
+
+
+def estimate(sql_text, explain):
+    """Sync estimate_async(); explain(sql) is a plain function."""
+    sql_text = _planned_statement(sql_text)
+    if sql_text is None:
+        return _decide(0.0, 0.0, True)
+    key = fingerprint(sql_text)
+    hit = ESTIMATES.get(key)
+    if hit is None:
+        with time_stage("admission_explain"):
+            cost, rows = plan_estimates(explain(sql_text))
+        ESTIMATES.put(key, cost, rows)
+    else:
+        cost, rows = hit
+    return _decide(cost, rows, hit is not None)
+
+
+# --- scheduling ---
+
+# The decision of the admitted block the current task runs in. Queries started
+# inside it (e.g. a benchmark's parallel runs) share its slot instead of queueing
+# for their own, which could wait on the very slot their batch holds.
+_held = contextvars.ContextVar("admission_held", default=None)
+
+
+def _queue(decision):
+    """The slots of decision's class; rejects when too many already wait for them."""
+    limit = SLOTS[decision["class"]]
+    if limit.waiting >= ADMISSION_MAX_QUEUE:
+        DECISIONS.inc(cost_class=decision["class"], outcome="queue_full")
+        raise AdmissionRejected(f"Too many {decision['class']} queries queued "
+                                f"({limit.waiting} waiting); retry later.", decision)
+    return limit
+
+
+async def _take_slot(decision):
+    limit = _queue(decision)
+    started = time.perf_counter()
+    cm = limit.slot(timeout=ADMISSION_MAX_WAIT_S)
+    try:
+        await cm.__aenter__()
+    except asyncio.TimeoutError:
+        DECISIONS.inc(cost_class=decision["class"], outcome="timeout")
+        raise AdmissionRejected(f"No {decision['class']} query slot freed within "
+                                f"{ADMISSION_MAX_WAIT_S:g}s; retry later.", decision) from None
+    decision["queued_ms"] = round((time.perf_counter() - started) * 1000.0, 3)
+    DECISIONS.inc(cost_class=decision["class"], outcome="admitted")
+    return cm
+
+
+async def _no_slot():
+    return None
+
+
+@asynccontextmanager
+async def admitted(sql_text, explain):
+    """
+    async with admitted(sql, explain) as decision: runs the block once a slot
+    of the query's cost class is free. Each class has its own slots, so cheap
+    queries never wait behind expensive ones; expensive queries are deferred
+    until one of their few slots frees. Raises AdmissionRejected for queries
+    over the limits, when the class queue is full, or after waiting
+    ADMISSION_MAX_WAIT_S. A no-op when ADMISSION_ENABLED is off.
+
+    A batch of queries (benchmark, equivalence checks, index advisor) is
+    admitted once as a whole by wrapping it in admitted() for its main query;
+    queries inside are then only checked against the limits.
+    """
+    if not ADMISSION_ENABLED:
+        yield None
+        return
+    decision = await estimate_async(sql_text, explain)
+    if _held.get() is not None:
+        yield decision
+        return
+    cm = await _take_slot(decision)
+    token = _held.set(decision)
+    try:
+        yield decision
+    except BaseException:
+        if not await cm.__aexit__(*sys.exc_info()):
+            raise
+    else:
+        await cm.__aexit__(None, None, None)
+    finally:
+        _held.reset(token)
+
+
+async def acquire(sql_text, explain):
+    """
+    admitted() for a slot held beyond one block, e.g. across the tasks of a
+    streamed response: returns (decision, release), and `await release()`
+    frees the slot. Queries started meanwhile do not share it; pass the
+    admission on explicitly instead. Raises like admitted().
+    """
+    if not ADMISSION_ENABLED:
+        return None, _no_slot
+    decision = await estimate_async(sql_text, explain)
+    if _held.get() is not None:
+        return decision, _no_slot
+    cm = await _take_slot(decision)
+    return decision, lambda: cm.__aexit__(None, None, None)
+
+
+@contextmanager
+def admitted_blocking(sql_text, explain):
+    """
+    Sync admitted() for worker threads: blocks the thread until a slot of
+    the query's class frees; explain(sql) is a plain function. Threads share
+    one set of slots per class (see core.limits._Limit).
+    """
+    if not ADMISSION_ENABLED:
+        yield None
+        return
+    decision = estimate(sql_text, explain)
+    if _held.get() is not None:
+        yield decision
+        return
+    cm = _take_blocking_slot(decision)
+    token = _held.set(decision)
+    try:
+        yield decision
+    finally:
+        _held.reset(token)
+        cm.__exit__(None, None, None)
+
+
+def acquire_blocking(sql_text, explain):
+    """
+    Sync acquire(), e.g. for a generator that holds its slot while it is
+    consumed: returns (decision, release), and release() frees the slot.
+    """
+    if not ADMISSION_ENABLED:
+        return None, _no_slot_blocking
+    decision = estimate(sql_text, explain)
+    if _held.get() is not None:
+        return decision, _no_slot_blocking
+    cm = _take_blocking_slot(decision)
+    return decision, lambda: cm.__exit__(None, None, None)
+
+
+def _take_blocking_slot(decision):
+    limit = _queue(decision)
+    started = time.perf_counter()
+    cm = limit.blocking_slot(timeout=ADMISSION_MAX_WAIT_S)
+    try:
+        cm.__enter__()
+    except TimeoutError:
+        DECISIONS.inc(cost_class=decision["class"], outcome="timeout")
+        raise AdmissionRejected(f"No {decision['class']} query slot freed within "
+                                f"{ADMISSION_MAX_WAIT_S:g}s; retry later.", decision) from None
+    decision["queued_ms"] = round((time.perf_counter() - started) * 1000.0, 3)
+    DECISIONS.inc(cost_class=decision["class"], outcome="admitted")
+    return cm
+
+
+def _no_slot_blocking():
+    return None
+
+
+def admission_stats():
+    return {
+        "enabled": ADMISSION_ENABLED,
+        "thresholds": {"cheap_cost": ADMISSION_CHEAP_COST, "expensive_cost": ADMISSION_EXPENSIVE_COST,
+                       "max_cost": ADMISSION_MAX_COST, "max_rows": ADMISSION_MAX_ROWS},
+        "classes": {name: limit.stats() for name, limit in SLOTS.items()},
+        "estimates_cached": len(ESTIMATES),
+    }
+
+
+gauge(
+    "sqlagent_admission_in_flight", "Admitted queries running per cost class.",
+    lambda: {(name,): limit.in_flight for name, limit in SLOTS.items()}, ("cost_class",),
+)
+gauge(
+    "sqlagent_admission_waiting", "Queries waiting for a slot per cost class.",
+    lambda: {(name,): limit.waiting for name, limit in SLOTS.items()}, ("cost_class",),
+)
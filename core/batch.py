@@ -0,0 +1,55 @@
+# core/batch.py
+import os
+import asyncio
+from dotenv import load_dotenv
+load_dotenv()
+
+# default and maximum items in flight per batch request (the global LLM/DB
+# limits in core.limits still apply on top of this)
+BATCH_PARALLELISM = int(os.getenv("BATCH_PARALLELISM", "8"))
+BATCH_MAX_PARALLELISM = int(os.getenv("BATCH_MAX_PARALLELISM", "32"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+
+
+def dedupe(items, key_fn):
+    """
+    Groups item positions by key_fn(item), first occurrence first.
+    Returns [(key, first_item, [positions...]), ...].
+    """
+    groups = {}
+    for i, item in enumerate(items):
+        key = key_fn(item)
+        if key in groups:
+            groups[key][2].append(i)
+        else:
+            groups[key] = (key, item, [i])
+    return list(groups.values())
+
+
+async def run_batch(items, key_fn, worker, parallelism=None):
+    """
+    Async generator: runs worker(item) once per distinct key_fn(item), at most
+    `parallelism` at a time, and yields (positions, result) in completion
+    order, where positions are the indexes of every item sharing that key.
+    A worker exception is yielded as its result. Unfinished work is cancelled
+    when the consumer stops early (e.g. the client disconnected).
+    """
+    limit = max(1, min(parallelism or BATCH_PARALLELISM, BATCH_MAX_PARALLELISM))
+    sem = asyncio.Semaphore(limit)
+    groups = dedupe(items, key_fn)
+
+    async def run(item, positions):
+        async with sem:
+            try:
+                return positions, await worker(item)
+            except Exception as e:
+                return positions, e
+
+    tasks = [asyncio.ensure_future(run(item, positions)) for _, item, positions in groups]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            yield await fut
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
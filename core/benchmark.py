@@ -0,0 +1,225 @@
+# core/benchmark.py
+import os
+import math
+import random
+import asyncio
+import statistics
+from functools import lru_cache
+from dotenv import load_dotenv
+load_dotenv()
+
+from core.optimizer import extract_total_time_from_analyze, plan_diff
+from core.equivalence import check_equivalence
+import core.admission as admission
+
+BENCH_WARMUP_RUNS = int(os.getenv("BENCH_WARMUP_RUNS", "1"))
+BENCH_REPEATS = int(os.getenv("BENCH_REPEATS", "5"))
+# how many queries may run at the same time, each on its own connection
+BENCH_PARALLELISM = int(os.getenv("BENCH_PARALLELISM", "3"))
+BENCH_ALPHA = float(os.getenv("BENCH_ALPHA", "0.05"))
+# a candidate must also be at least this much faster (median) to count
+BENCH_MIN_IMPROVEMENT = float(os.getenv("BENCH_MIN_IMPROVEMENT", "0.05"))
+
+
+def summarize(samples):
+    """median / p95 / mean / stddev / min / max of timing samples in ms."""
+    if not samples:
+        return {"n": 0}
+    s = sorted(samples)
+    # nearest-rank p95
+    p95 = s[min(len(s) - 1, math.ceil(0.95 * len(s)) - 1)]
+    return {
+        "n": len(s),
+        "median_ms": round(statistics.median(s), 3),
+        "p95_ms": round(p95, 3),
+        "mean_ms": round(statistics.fmean(s), 3),
+        "stddev_ms": round(statistics.stdev(s), 3) if len(s) > 1 else 0.0,
+        "min_ms": round(s[0], 3),
+        "max_ms": round(s[-1], 3),
+    }
+
+
+@lru_cache(maxsize=None)
+def _u_counts(m, n):
+    """Number of orderings giving each Mann-Whitney U for sample sizes m, n (no ties)."""
+    if m == 0 or n == 0:
+        return (1,)
+    a = _u_counts(m - 1, n)  # largest value comes from the first sample: U += n
+    b = _u_counts(m, n - 1)
+    out = [0] * (m * n + 1)
+    for u, c in enumerate(a):
+        out[u + n] += c
+    for u, c in enumerate(b):
+        out[u] += c
+    return tuple(out)
+
+
+def mann_whitney_less(a, b):
+    """
+    One-sided Mann-Whitney U test that samples `a` tend to be smaller than `b`.
+    Exact for small samples without ties, normal approximation otherwise.
+    Returns the p-value.
+    """
+    m, n = len(a), len(b)
+    if m == 0 or n == 0:
+        return 1.0
+    # U counts pairs where a > b (ties count half); small U means a is smaller
+    u = 0.0
+    for x in a:
+        for y in b:
+            if x > y:
+                u += 1.0
+            elif x == y:
+                u += 0.5
+    tied = len(set(a) | set(b)) < m + n
+    if not tied and m * n <= 400:
+        counts = _u_counts(m, n)
+        total = sum(counts)
+        return sum(counts[: int(u) + 1]) / total
+    mean = m * n / 2.0
+    # tie-corrected variance
+    ranks = {}
+    for v in list(a) + list(b):
+        ranks[v] = ranks.get(v, 0) + 1
+    tie_term = sum(t ** 3 - t for t in ranks.values())
+    N = m + n
+    var = m * n / 12.0 * ((N + 1) - tie_term / (N * (N - 1)))
+    if var <= 0:
+        return 1.0
+    z = (u + 0.5 - mean) / math.sqrt(var)  # continuity correction
+    return 0.5 * math.erfc(-z / math.sqrt(2))
+
+
+def verdict(original, candidate, alpha=BENCH_ALPHA, min_improvement=BENCH_MIN_IMPROVEMENT):
+    """
+    Compares candidate timings with the original's. Returns a dict with
+    speedup (original median / candidate median), p-values and a verdict:
+    "faster", "slower" or "inconclusive".
+    """
+    if not original or not candidate:
+        return {"verdict": "inconclusive", "speedup": None, "p_faster": None, "p_slower": None}
+    med_o = statistics.median(original)
+    med_c = statistics.median(candidate)
+    p_faster = mann_whitney_less(candidate, original)
+    p_slower = mann_whitney_less(original, candidate)
+    speedup = med_o / med_c if med_c > 0 else None
+    if p_faster < alpha and med_c <= med_o * (1 - min_improvement):
+        v = "faster"
+    elif p_slower < alpha and med_c >= med_o * (1 + min_improvement):
+        v = "slower"
+    else:
+        v = "inconclusive"
+    return {
+        "verdict": v,
+        "speedup": round(speedup, 3) if speedup else None,
+        "p_faster": round(p_faster, 4),
+        "p_slower": round(p_slower, 4),
+    }
+
+
+async def benchmark_queries(queries, executor_module, repeats=BENCH_REPEATS,
+                            warmup=BENCH_WARMUP_RUNS, parallelism=BENCH_PARALLELISM, seed=None):
+    """
+    Times each of `queries` ({name: sql}) with EXPLAIN ANALYZE.
+
+    After `warmup` discarded rounds, runs `repeats` measured rounds. In each
+    round every query runs once, in a freshly shuffled order, with at most
+    `parallelism` queries in flight on separate pooled connections, so cache
+    warmth and background noise are spread evenly across queries.
+    Returns {name: {"samples_ms": [...], "stats": {...}, "plan": ..., "error": ...}}.
+    """
+    rng = random.Random(seed)
+    sem = asyncio.Semaphore(max(1, parallelism))
+    out = {name: {"samples_ms": [], "plan": None, "error": None} for name in queries}
+
+    async def run_once(name, measured):
+        if out[name]["error"]:
+            return
+        async with sem:
+            try:
+                plan = await executor_module.explain_analyze_async(queries[name])
+            except Exception as e:
+                out[name]["error"] = str(e)
+                return
+        t = extract_total_time_from_analyze(plan)
+        if measured and t is not None:
+            out[name]["samples_ms"].append(t)
+            out[name]["plan"] = plan
+
+    names = list(queries)
+    # every run on one node, so samples are comparable
+    with executor_module.pinned("benchmark"):
+        for r in range(warmup + repeats):
+            order = names[:]
+            rng.shuffle(order)
+            await asyncio.gather(*(run_once(n, r >= warmup) for n in order))
+
+    for name, res in out.items():
+        res["stats"] = summarize(res["samples_ms"])
+    return out
+
+
+async def _screen_candidates(original_sql, candidates, executor_module):
+    """(kept, rejected): candidates split by core.equivalence result checks."""
+    checks = await check_equivalence(original_sql, [c["sql"] for c in candidates], executor_module)
+    if checks["original"]["error"]:
+        raise RuntimeError(f"Original query failed: {checks['original']['error']}")
+    kept, rejected = [], []
+    for c, chk in zip(candidates, checks["candidates"]):
+        if chk["equivalent"]:
+            kept.append(c)
+        else:
+            rejected.append({"sql": c["sql"], "note": c.get("note", ""), "verdict": "not_equivalent",
+                             "reason": chk["reason"]})
+    return kept, rejected
+
+
+async def benchmark_rewrites(original_sql, candidates, executor_module, check_results=True, **kwargs):
+    """
+    Benchmarks the original query together with candidate rewrites
+    ([{"sql", "note"}]) and attaches a significance verdict to each candidate.
+    Candidates are ranked: significantly faster first, then by median time.
+    With check_results, candidates whose result fingerprint differs from the
+    original's (core.equivalence) are not benchmarked; they are returned
+    under "rejected" with the reason.
+    """
+    # admitted once, in the original's cost class: the parallel fingerprint and
+    # EXPLAIN ANALYZE runs share its slot rather than queueing behind each other.
+    # They all run on one node: a lagging replica and a benchmark copy could
+    # disagree about the rows.
+    rejected = []
+    async with admission.admitted(original_sql, executor_module.explain_query_async):
+        with executor_module.pinned("benchmark"):
+            if check_results and candidates:
+                candidates, rejected = await _screen_candidates(original_sql, candidates, executor_module)
+            queries = {"original": original_sql}
+            for i, c in enumerate(candidates):
+                queries[f"candidate_{i}"] = c["sql"]
+            bench = await benchmark_queries(queries, executor_module, **kwargs)
+
+    orig = bench["original"]
+    if orig["error"]:
+        raise RuntimeError(f"Original query failed: {orig['error']}")
+    ranked = []
+    for i, c in enumerate(candidates):
+        b = bench[f"candidate_{i}"]
+        entry = {
+            "sql": c["sql"],
+            "note": c.get("note", ""),
+            "time_ms": b["stats"].get("median_ms"),
+            "stats": b["stats"],
+        }
+        if b["error"]:
+            entry.update({"error": b["error"], "verdict": "error"})
+        else:
+            entry.update(verdict(orig["samples_ms"], b["samples_ms"]))
+            if orig["plan"] is not None and b["plan"] is not None:
+                # last measured round of each; shows which nodes the rewrite made cheaper
+                entry["plan_diff"] = plan_diff(orig["plan"], b["plan"], top=5)
+        ranked.append(entry)
+    ranked.sort(key=lambda x: (x.get("verdict") != "faster", x.get("time_ms") or 1e9))
+    return {
+        "original": {"time_ms": orig["stats"].get("median_ms"), "stats": orig["stats"]},
+        "candidates": ranked,
+        "rejected": rejected,
+    }
@@ -0,0 +1,161 @@
+# core/columnar.py
+import io
+import json
+import base64
+
+from core.metrics import timed
+
+# pyarrow is optional on the API side (streamlit already depends on it).
+try:
+    import pyarrow as pa
+    _has_pyarrow = True
+except Exception:
+    _has_pyarrow = False
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+COLUMNAR_JSON_MEDIA_TYPE = "application/vnd.sqlagent.columnar+json"
+
+# PostgreSQL type OID -> logical type name used in result metadata
+_PG_TYPES = {
+    16: "bool", 17: "bytea", 20: "int8", 21: "int2", 23: "int4", 25: "text",
+    114: "json", 700: "float4", 701: "float8", 1042: "text", 1043: "text",
+    1082: "date", 1083: "time", 1114: "timestamp", 1184: "timestamptz",
+    1186: "interval", 1700: "numeric", 2950: "uuid", 3802: "jsonb",
+}
+
+
+def column_types(description):
+    """
+    Logical type names for a cursor.description, e.g. ["int4", "numeric(5,2)", "timestamp"].
+    Unknown types are reported as "text" and sent as strings.
+    """
+    types = []
+    for desc in description or ():
+        name = _PG_TYPES.get(desc.type_code, "text")
+        if name == "numeric" and desc.precision and desc.scale is not None and 0 < desc.precision <= 38:
+            name = f"numeric({desc.precision},{desc.scale})"
+        types.append(name)
+    return types
+
+
+def negotiate(accept_header):
+    """
+    Picks a columnar media type from an Accept header, or None for the default JSON.
+    Arrow is only offered when pyarrow is installed.
+    """
+    accept = (accept_header or "").lower()
+    if ARROW_MEDIA_TYPE in accept and _has_pyarrow:
+        return ARROW_MEDIA_TYPE
+    if COLUMNAR_JSON_MEDIA_TYPE in accept:
+        return COLUMNAR_JSON_MEDIA_TYPE
+    return None
+
+
+def _json_converter(type_name):
+    if type_name.startswith("numeric") or type_name in ("interval", "uuid", "text"):
+        return lambda v: v if v is None or isinstance(v, str) else str(v)
+    if type_name in ("date", "time", "timestamp", "timestamptz"):
+        return lambda v: v.isoformat() if v is not None else None
+    if type_name == "bytea":
+        return lambda v: base64.b64encode(bytes(v)).decode("ascii") if v is not None else None
+    return None
+
+
+@timed("serialize")
+def encode_columnar_json(columns, types, row_batches):
+    """
+    {"columns": [...], "types": [...], "data": [[col0 values], [col1 values], ...], "row_count": n}
+    Exact types are kept as strings (numeric) or ISO-8601 (dates/times), and the
+    "types" list tells the client how to read them back.
+    """
+    data = [[] for _ in columns]
+    converters = [_json_converter(t) for t in types]
+    row_count = 0
+    for rows in row_batches:
+        if not rows:
+            continue
+        row_count += len(rows)
+        for i, values in enumerate(zip(*rows)):
+            conv = converters[i]
+            data[i].extend(values if conv is None else map(conv, values))
+    doc = {"columns": columns, "types": types, "data": data, "row_count": row_count}
+    return json.dumps(doc, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def _arrow_type(type_name):
+    simple = {
+        "bool": pa.bool_(), "int2": pa.int16(), "int4": pa.int32(), "int8": pa.int64(),
+        "float4": pa.float32(), "float8": pa.float64(), "date": pa.date32(),
+        "time": pa.time64("us"), "timestamp": pa.timestamp("us"),
+        "timestamptz": pa.timestamp("us", tz="UTC"), "bytea": pa.binary(),
+    }
+    if type_name in simple:
+        return simple[type_name]
+    if type_name.startswith("numeric("):
+        precision, scale = type_name[len("numeric("):-1].split(",")
+        return pa.decimal128(int(precision), int(scale))
+    return pa.string()
+
+
+def _arrow_values(type_name, values):
+    if type_name == "bytea":
+        return [bytes(v) if v is not None else None for v in values]
+    if type_name in ("json", "jsonb"):
+        return [json.dumps(v, default=str) if v is not None else None for v in values]
+    if type_name == "numeric" or type_name in ("interval", "uuid", "text"):
+        return [v if v is None or isinstance(v, str) else str(v) for v in values]
+    return values
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that hands back whatever was written since the last take()."""
+
+    def __init__(self):
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._parts.append(bytes(b))
+        return len(b)
+
+    def take(self):
+        out = b"".join(self._parts)
+        self._parts = []
+        return out
+
+
+def iter_arrow_stream(columns, types, row_batches):
+    """
+    Yields Arrow IPC stream bytes: the schema, then one record batch per row batch.
+    Each batch is transposed to columns once and converted column-wise.
+    """
+    if not _has_pyarrow:
+        raise RuntimeError("pyarrow is not installed")
+    schema = pa.schema([pa.field(c, _arrow_type(t)) for c, t in zip(columns, types)])
+    sink = _ChunkSink()
+    writer = pa.ipc.new_stream(sink, schema)
+    yield sink.take()
+    for rows in row_batches:
+        if not rows:
+            continue
+        arrays = [
+            pa.array(_arrow_values(t, list(values)), type=schema.field(i).type)
+            for i, (t, values) in enumerate(zip(types, zip(*rows)))
+        ]
+        writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+@timed("serialize")
+def encode_arrow(columns, types, row_batches):
+    return b"".join(iter_arrow_stream(columns, types, row_batches))
+
+
+def batched(rows, batch_size):
+    """Splits an already materialised row list into batches for the encoders."""
+    for i in range(0, len(rows), batch_size):
+        yield rows[i:i + batch_size]
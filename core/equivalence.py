@@ -0,0 +1,73 @@
+# core/equivalence.py
+import os
+import asyncio
+from dotenv import load_dotenv
+load_dotenv()
+
+from core.fingerprint import significant_tokens
+
+# fingerprint queries run the full statement; bound how many run at once
+EQUIV_PARALLELISM = int(os.getenv("EQUIV_PARALLELISM", "3"))
+EQUIV_TIMEOUT_MS = int(os.getenv("EQUIV_TIMEOUT_MS", "120000"))
+
+
+def has_top_level_order_by(sql_text):
+    """True if the statement itself (not a subquery) ends with ORDER BY."""
+    depth = 0
+    toks = significant_tokens(sql_text)
+    for i, (kind, text) in enumerate(toks):
+        if kind == "punct":
+            if text == "(":
+                depth += 1
+            elif text == ")":
+                depth -= 1
+        elif depth == 0 and kind == "word" and text == "order":
+            if i + 1 < len(toks) and toks[i + 1] == ("word", "by"):
+                return True
+    return False
+
+
+async def check_equivalence(original_sql, candidate_sqls, executor_module,
+                            parallelism=EQUIV_PARALLELISM, timeout_ms=EQUIV_TIMEOUT_MS):
+    """
+    Checks that each candidate returns the same rows as original_sql by
+    comparing result fingerprints computed inside PostgreSQL (row count plus
+    order-insensitive hash sums; see executor.result_fingerprint_async), all
+    queries at once with at most `parallelism` in flight. A candidate that
+    drops the original's top-level ORDER BY is not equivalent either.
+    Returns {"original": {"fingerprint", "error"}, "candidates": [{"equivalent",
+    "reason", "fingerprint"}, ...]} in candidate order; "equivalent" is False
+    for every candidate if the original itself fails.
+    """
+    sem = asyncio.Semaphore(max(1, parallelism))
+
+    async def run(sql):
+        async with sem:
+            try:
+                return await executor_module.result_fingerprint_async(sql, timeout_ms), None
+            except Exception as e:
+                return None, str(e).strip().splitlines()[0] if str(e).strip() else repr(e)
+
+    results = await asyncio.gather(run(original_sql), *(run(sql) for sql in candidate_sqls))
+    orig_fp, orig_err = results[0]
+    ordered = has_top_level_order_by(original_sql)
+    out = []
+    for sql, (fp, err) in zip(candidate_sqls, results[1:]):
+        if orig_err is not None:
+            entry = {"equivalent": False, "reason": "original query failed"}
+        elif err is not None:
+            entry = {"equivalent": False, "reason": f"error: {err}"}
+        elif fp[0] != orig_fp[0]:
+            entry = {"equivalent": False, "reason": f"row count differs ({fp[0]} vs {orig_fp[0]})"}
+        elif fp != orig_fp:
+            entry = {"equivalent": False, "reason": "rows differ"}
+        elif ordered and not has_top_level_order_by(sql):
+            entry = {"equivalent": False, "reason": "drops the original's ORDER BY"}
+        else:
+            entry = {"equivalent": True, "reason": None}
+        entry["fingerprint"] = list(fp) if fp is not None else None
+        out.append(entry)
+    return {
+        "original": {"fingerprint": list(orig_fp) if orig_fp is not None else None, "error": orig_err},
+        "candidates": out,
+    }
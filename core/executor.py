@@ -1,71 +1,312 @@
 # core/executor.py
 import os
-import psycopg2
-from urllib.parse import urlparse
+import time
+import uuid
 from dotenv import load_dotenv
 load_dotenv()
 
+from core.pool import connect, pool_stats
+import core.routing as routing
+from core.routing import pinned, routing_stats
+from core.limits import db_slot
+import core.admission as admission
+from core.result_cache import RESULT_CACHE, cacheable_tables
+from core.columnar import column_types
+from core.metrics import timed, cache_lookup
+from core.fingerprint import strip_semicolons, has_top_level_limit
+
 DATABASE_URL = os.getenv("DATABASE_URL")
+# pg_stat_user_tables is re-read at most this often for cache invalidation
+TABLE_STATS_POLL_S = float(os.getenv("TABLE_STATS_POLL_S", "1"))
+
+_TABLE_STATS_SQL = """
+SELECT s.schemaname, s.relname,
+       s.n_tup_ins + s.n_tup_upd + s.n_tup_del, s.n_live_tup,
+       greatest(s.last_analyze, s.last_autoanalyze)::text,
+       (SELECT count(*) FROM pg_index i WHERE i.indrelid = s.relid)
+FROM pg_stat_user_tables s
+"""
+# "lsn": the primary's WAL position once the counters were read; a replica that has
+# replayed up to it includes every write the counters saw
+_table_stats = {"fetched_at": 0.0, "versions": {}, "plan_versions": {}, "lsn": None}
+
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "500"))
+STREAM_MAX_BATCH_SIZE = 10000
 
 def get_conn():
     """
-    Creates a PostgreSQL connection using DATABASE_URL from .env.
+    Creates a new, unpooled PostgreSQL connection using DATABASE_URL from .env.
+    Request paths should use connection() instead.
+    """
+    return connect(DATABASE_URL)
+
+def _settings(timeout_ms):
+    return {"statement_timeout": timeout_ms} if timeout_ms is not None else None
+
+def connection(timeout_ms=None, route="primary"):
     """
-    url = urlparse(DATABASE_URL)
-    conn = psycopg2.connect(
-        dbname=url.path[1:],
-        user=url.username,
-        password=url.password,
-        host=url.hostname,
-        port=url.port or 5432
-    )
-    return conn
+    Checks out a pooled connection (context manager) on a node serving
+    `route` (see core.routing). statement_timeout is applied at checkout and
+    only re-sent when it differs from the last value.
+    """
+    return routing.connection(route, _settings(timeout_ms))
+
+def async_connection(timeout_ms=None, route="primary"):
+    """
+    Async counterpart of connection(): checks out from the pool bound to the running loop.
+    """
+    return routing.async_connection(route, _settings(timeout_ms))
+
+def _limited_sql(sql_text, row_limit):
+    raw = strip_semicolons(sql_text)
+    if raw.lower().startswith(("select", "with")) and not has_top_level_limit(raw):
+        return f"SELECT * FROM ({raw}) AS subq LIMIT {row_limit};"
+    return raw
 
-def run_readonly_query(sql_text, row_limit=5000, timeout_ms=20000):
+@timed("query")
+def run_readonly_query(sql_text, row_limit=5000, timeout_ms=20000, route="read"):
     """
     Safely run SELECT queries with an auto-added LIMIT if missing.
     """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(f"SET statement_timeout = {timeout_ms};")
+    wrapped = _limited_sql(sql_text, row_limit)
 
-    raw = sql_text.strip()
-    if raw.lower().startswith("select") and "limit" not in raw.lower():
-        wrapped = f"SELECT * FROM ({raw}) AS subq LIMIT {row_limit};"
-    else:
-        wrapped = raw
+    def fetch(conn):
+        cur = conn.cursor()
+        cur.execute(wrapped)
+        cols = [desc[0] for desc in cur.description] if cur.description else []
+        types = column_types(cur.description)
+        rows = cur.fetchmany(row_limit)
+        cur.close()
+        return {"columns": cols, "types": types, "rows": rows}
+    with admission.admitted_blocking(wrapped, lambda s: explain_query(s, route)):
+        return routing.run(route, _settings(timeout_ms), fetch)
 
-    cur.execute(wrapped)
-    cols = [desc[0] for desc in cur.description] if cur.description else []
-    rows = cur.fetchmany(row_limit)
+async def admit_stream_async(sql_text, route="read"):
+    """
+    admission.acquire() for stream_readonly_query(sql_text): async callers
+    take the slot before the stream starts, pass admitted=True, and await
+    the returned release() once the stream ends. Returns (decision, release).
+    """
+    return await admission.acquire(sql_text.strip().rstrip(";"), lambda s: explain_query_async(s, route))
+
+def stream_readonly_query(sql_text, batch_size=None, timeout_ms=20000, max_rows=None, route="read",
+                          admitted=False):
+    """
+    Generator version of run_readonly_query() backed by a server-side (named)
+    cursor, so only one batch is held in memory at a time. No LIMIT is added.
+    Yields {"columns": [...], "types": [...]} once, then {"rows": [...]} per batch.
+    Unless admitted (see admit_stream_async()), the generator holds an admission
+    slot from its first batch until it is exhausted or closed.
+    """
+    batch_size = max(1, min(batch_size or STREAM_BATCH_SIZE, STREAM_MAX_BATCH_SIZE))
+    raw = sql_text.strip().rstrip(";")
+    if admitted:
+        yield from _stream(raw, batch_size, timeout_ms, max_rows, route)
+        return
+    # not admitted_blocking(): the generator may be consumed and closed from other threads
+    _, release = admission.acquire_blocking(raw, lambda s: explain_query(s, route))
+    try:
+        yield from _stream(raw, batch_size, timeout_ms, max_rows, route)
+    finally:
+        release()
 
-    cur.close()
-    conn.close()
-    return {"columns": cols, "rows": rows}
+def _stream(raw, batch_size, timeout_ms, max_rows, route):
+    # DECLARE only accepts SELECT/VALUES (incl. WITH); EXPLAIN needs a plain cursor
+    server_side = not raw.lower().startswith("explain")
+    sent = 0
+    with connection(timeout_ms, route) as conn:
+        if server_side:
+            conn.autocommit = False  # named cursors live inside a transaction
+            cur = conn.cursor(name=f"stream_{uuid.uuid4().hex}")
+            cur.itersize = batch_size
+        else:
+            cur = conn.cursor()
+        try:
+            cur.execute(raw)
+            rows = cur.fetchmany(batch_size)
+            cols = [desc[0] for desc in cur.description] if cur.description else []
+            yield {"columns": cols, "types": column_types(cur.description)}
+            while rows:
+                if max_rows is not None and sent + len(rows) >= max_rows:
+                    yield {"rows": rows[:max_rows - sent]}
+                    break
+                sent += len(rows)
+                yield {"rows": rows}
+                rows = cur.fetchmany(batch_size)
+        finally:
+            cur.close()
 
-def explain_query(sql_text):
+@timed("explain")
+def explain_query(sql_text, route="read"):
     """
     EXPLAIN (FORMAT JSON) for understanding query plan structure.
     """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(f"EXPLAIN (FORMAT JSON) {sql_text}")
-    plan = cur.fetchone()[0]
-    cur.close()
-    conn.close()
-    return plan
+    def plan(conn):
+        cur = conn.cursor()
+        cur.execute(f"EXPLAIN (FORMAT JSON) {sql_text}")
+        row = cur.fetchone()
+        cur.close()
+        return row[0]
+    return routing.run(route, None, plan)
 
-def explain_analyze(sql_text):
+@timed("explain_analyze")
+def explain_analyze(sql_text, route="benchmark"):
     """
     Runs EXPLAIN ANALYZE (FORMAT JSON) which executes the query and returns
-    actual execution time + plan.
+    actual execution time + plan. Runs on a benchmark node when one is configured.
+    """
+    def plan(conn):
+        cur = conn.cursor()
+        cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql_text}")
+        row = cur.fetchone()
+        cur.close()
+        return row[0]
+    with admission.admitted_blocking(sql_text, lambda s: explain_query(s, route)):
+        return routing.run(route, _settings(120000), plan)  # 2 min timeout
+
+# --- async variants (used by the FastAPI app) ---
+
+async def run_readonly_query_async(sql_text, row_limit=5000, timeout_ms=20000, route="read"):
+    """
+    Async run_readonly_query(): runs on the event loop without holding a worker thread.
+    """
+    return (await _run_readonly_async(sql_text, row_limit, timeout_ms, route))[0]
+
+@timed("query")
+async def _run_readonly_async(sql_text, row_limit, timeout_ms, route, min_lsn=None):
     """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SET statement_timeout = 120000;")  # 2 min timeout
-    cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql_text}")
-    plan = cur.fetchone()[0]
-    cur.close()
-    conn.close()
-    return plan
+    Returns (result, caught_up): caught_up is False when the query ran on a
+    replica that had not yet replayed the primary's WAL up to min_lsn.
+    """
+    wrapped = _limited_sql(sql_text, row_limit)
+
+    async def fetch(conn):
+        caught_up = True
+        if min_lsn is not None:
+            # checked before the query, whose snapshot is newer; NULL on a primary
+            row = await conn.fetchone("SELECT coalesce(pg_last_wal_replay_lsn() >= %s::pg_lsn, true)",
+                                      (min_lsn,))
+            caught_up = bool(row[0])
+        cur = await conn.execute(wrapped)
+        cols = [desc[0] for desc in cur.description] if cur.description else []
+        types = column_types(cur.description)
+        rows = cur.fetchmany(row_limit)
+        cur.close()
+        return {"columns": cols, "types": types, "rows": rows}, caught_up
+    # the cost class slot is taken first, so the db slot is only held while running
+    async with admission.admitted(wrapped, lambda s: explain_query_async(s, route)):
+        async with db_slot():
+            return await routing.run_async(route, _settings(timeout_ms), fetch)
+
+@timed("explain")
+async def explain_query_async(sql_text, route="read"):
+    async def plan(conn):
+        return (await conn.fetchone(f"EXPLAIN (FORMAT JSON) {sql_text}"))[0]
+    async with db_slot():
+        return await routing.run_async(route, None, plan)
+
+@timed("explain_analyze")
+async def explain_analyze_async(sql_text, route="benchmark"):
+    async def plan(conn):
+        return (await conn.fetchone(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql_text}"))[0]
+    async with admission.admitted(sql_text, lambda s: explain_query_async(s, route)):
+        async with db_slot():
+            return await routing.run_async(route, _settings(120000), plan)  # 2 min timeout
+
+# Order-insensitive digest of a result set, computed by the server: the row
+# count plus two independently seeded sums of 64-bit row hashes (a multiset
+# hash: duplicates count, order does not). Sums are numeric, so they cannot overflow.
+_FINGERPRINT_SQL = """
+SELECT count(*),
+       coalesce(sum(hashtextextended(r::text, 0)), 0)::text,
+       coalesce(sum(hashtextextended(r::text, 1)), 0)::text
+FROM ({sql}) AS r
+"""
+
+@timed("fingerprint")
+async def result_fingerprint_async(sql_text, timeout_ms=120000, route="benchmark"):
+    """
+    (row_count, hash_sum_0, hash_sum_1) for the rows sql_text returns, without
+    sending the rows to the client. Rows are hashed through their text form, so
+    column order and output types matter but column names do not.
+    """
+    raw = sql_text.strip().rstrip(";")
+
+    async def digest(conn):
+        return await conn.fetchone(_FINGERPRINT_SQL.format(sql=raw))
+    async with admission.admitted(raw, lambda s: explain_query_async(s, route)):
+        async with db_slot():
+            row = await routing.run_async(route, _settings(timeout_ms), digest)
+    return int(row[0]), row[1], row[2]
+
+def _versions_by_name(rows):
+    """Maps "schema.table" and bare "table" to a version value."""
+    versions = {}
+    bare = {}
+    for schema, rel, value in rows:
+        versions[f"{schema}.{rel}"] = value
+        bare.setdefault(rel, []).append((schema, value))
+    for rel, entries in bare.items():
+        versions.setdefault(rel, tuple(sorted(entries)))
+    return versions
+
+async def _poll_table_stats_async():
+    now = time.monotonic()
+    if now - _table_stats["fetched_at"] < TABLE_STATS_POLL_S:
+        return _table_stats
+    # write counters only move on the primary; replicas do not count replayed changes
+    async with db_slot():
+        async with async_connection(route="primary") as conn:
+            cur = await conn.execute(_TABLE_STATS_SQL)
+            rows = cur.fetchall()
+            cur.close()
+            lsn = (await conn.fetchone("SELECT pg_current_wal_lsn()::text"))[0]
+    _table_stats["versions"] = _versions_by_name((r[0], r[1], (r[2], r[3])) for r in rows)
+    _table_stats["plan_versions"] = _versions_by_name((r[0], r[1], (r[4], r[5])) for r in rows)
+    _table_stats["lsn"] = lsn
+    _table_stats["fetched_at"] = time.monotonic()
+    return _table_stats
+
+async def table_versions_async():
+    """
+    Modification counters per user table ("table" and "schema.table" keys),
+    read from pg_stat_user_tables at most every TABLE_STATS_POLL_S seconds.
+    PostgreSQL publishes these counters with a short delay after commit.
+    """
+    return (await _poll_table_stats_async())["versions"]
+
+async def table_plan_versions_async():
+    """
+    Per-table (last ANALYZE/autoanalyze time, index count): when either
+    changes, cached plans for queries on that table are out of date.
+    """
+    return (await _poll_table_stats_async())["plan_versions"]
+
+async def run_readonly_query_cached_async(sql_text, row_limit=5000, timeout_ms=20000):
+    """
+    run_readonly_query_async() through the result cache.
+    Returns (result, {"cached": bool, "age_s": float}).
+    """
+    tables = cacheable_tables(sql_text)
+    if tables is None:
+        res = await run_readonly_query_async(sql_text, row_limit, timeout_ms)
+        return res, {"cached": False, "age_s": 0.0}
+
+    # snapshot counters before running, so a concurrent write makes the entry stale
+    stats = await _poll_table_stats_async()
+    versions, lsn = stats["versions"], stats["lsn"]
+    tracked = all(t in versions for t in tables)
+    key = RESULT_CACHE.key(sql_text, row_limit)
+    if tracked:
+        hit = RESULT_CACHE.get(key, versions)
+        cache_lookup("result", hit is not None)
+        if hit is not None:
+            return hit[0], {"cached": True, "age_s": round(hit[1], 3)}
 
+    # a lagging replica may return rows from before the writes the counters include;
+    # such a result is served but not stored under those counters
+    min_lsn = lsn if tracked and not routing.ROUTER.primary_only("read") else None
+    res, caught_up = await _run_readonly_async(sql_text, row_limit, timeout_ms, "read", min_lsn)
+    if tracked and caught_up:
+        RESULT_CACHE.put(key, res, tables, versions)
+    return res, {"cached": False, "age_s": 0.0}
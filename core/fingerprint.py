@@ -0,0 +1,198 @@
+# core/fingerprint.py
+import re
+import hashlib
+
+# Single-pass SQL tokenizer. Good enough to tell keywords from string
+# literals, quoted identifiers and comments without building a parse tree.
+_TOKEN_RE = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>[eE]'(?:\\.|''|[^'\\])*'|[bBxXnN]?'(?:''|[^'])*')
+  | (?P<dollar>\$(?P<tag>[A-Za-z_][A-Za-z0-9_]*|)\$.*?\$(?P=tag)\$)
+  | (?P<qident>"(?:""|[^"])*")
+  | (?P<param>\$\d+|%\(\w+\)s|%s)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<punct>::|<=|>=|<>|!=|\|\||.)
+""", re.S | re.X)
+
+_LITERAL_KINDS = ("string", "dollar", "number")
+
+# Functions whose result changes between calls; results using them must not be cached.
+VOLATILE_FUNCTIONS = frozenset((
+    "now", "random", "clock_timestamp", "statement_timestamp", "transaction_timestamp",
+    "timeofday", "current_timestamp", "current_date", "current_time", "localtime",
+    "localtimestamp", "nextval", "currval", "lastval", "setval", "txid_current",
+    "pg_sleep", "gen_random_uuid", "uuid_generate_v4",
+))
+
+_TABLE_KEYWORDS = frozenset(("from", "join"))
+# Words that end a FROM item list
+_FROM_TERMINATORS = frozenset((
+    "where", "group", "order", "limit", "offset", "having", "window", "union",
+    "intersect", "except", "on", "using", "join", "inner", "left", "right", "full",
+    "cross", "natural", "lateral", "fetch", "for", "returning", "tablesample",
+))
+
+# Functions that use FROM inside their argument list
+_FROM_FUNCTIONS = frozenset(("extract", "substring", "trim", "overlay", "position"))
+
+
+def tokenize(sql_text):
+    """
+    Yields (kind, text) tuples. kind is one of ws, comment, string, dollar,
+    qident, param, number, word, punct.
+    """
+    for m in _TOKEN_RE.finditer(sql_text or ""):
+        yield m.lastgroup if m.lastgroup != "tag" else "dollar", m.group(0)
+
+
+def significant_tokens(sql_text):
+    """Tokens without whitespace/comments; words are lowercased."""
+    out = []
+    for kind, text in tokenize(sql_text):
+        if kind in ("ws", "comment"):
+            continue
+        if kind == "word":
+            text = text.lower()
+        out.append((kind, text))
+    return out
+
+
+def normalize_sql(sql_text, strip_literals=False):
+    """
+    Canonical form of a statement: comments and redundant whitespace removed,
+    keywords/identifiers lowercased, trailing semicolons dropped.
+    With strip_literals=True constants are replaced by '?' (query shape only).
+    """
+    toks = significant_tokens(sql_text)
+    while toks and toks[-1] == ("punct", ";"):
+        toks.pop()
+    parts = []
+    for kind, text in toks:
+        if strip_literals and kind in _LITERAL_KINDS:
+            text = "?"
+        parts.append(text)
+    return " ".join(parts)
+
+
+def strip_semicolons(sql_text):
+    """The statement without surrounding whitespace and trailing semicolons."""
+    raw = (sql_text or "").strip()
+    while raw.endswith(";"):
+        raw = raw[:-1].rstrip()
+    return raw
+
+
+def has_top_level_limit(sql_text):
+    """True if the statement itself (not a subquery or CTE) has LIMIT or FETCH FIRST/NEXT."""
+    depth = 0
+    for kind, text in significant_tokens(sql_text):
+        if kind == "punct" and text == "(":
+            depth += 1
+        elif kind == "punct" and text == ")":
+            depth -= 1
+        elif depth == 0 and kind == "word" and text in ("limit", "fetch"):
+            return True
+    return False
+
+
+def fingerprint(sql_text, strip_literals=False):
+    norm = normalize_sql(sql_text, strip_literals=strip_literals)
+    return hashlib.sha1(norm.encode("utf-8")).hexdigest()
+
+
+def _ident(kind, text):
+    if kind == "qident":
+        return text[1:-1].replace('""', '"')
+    return text
+
+
+def _cte_names(toks):
+    """Names defined by WITH name AS (...) / , name AS (...)."""
+    names = set()
+    for i in range(len(toks) - 2):
+        kind, text = toks[i]
+        if kind in ("word", "qident") and toks[i + 1] == ("word", "as") and toks[i + 2] == ("punct", "("):
+            names.add(_ident(kind, text))
+        elif kind in ("word", "qident") and toks[i + 1] == ("punct", "("):
+            # WITH name (col, ...) AS (...)
+            depth, j = 0, i + 1
+            while j < len(toks):
+                if toks[j] == ("punct", "("):
+                    depth += 1
+                elif toks[j] == ("punct", ")"):
+                    depth -= 1
+                    if depth == 0:
+                        break
+                j += 1
+            if j + 2 < len(toks) and toks[j + 1] == ("word", "as") and toks[j + 2] == ("punct", "("):
+                names.add(_ident(kind, text))
+    return names
+
+
+def referenced_tables(sql_text):
+    """
+    Best-effort set of relation names read by a query ("table" or "schema.table"),
+    taken from FROM/JOIN clauses. CTE names and set-returning functions are excluded.
+    """
+    toks = significant_tokens(sql_text)
+    ctes = _cte_names(toks)
+    tables = set()
+    parens = []  # word before each open parenthesis, to spot EXTRACT(x FROM y) & co.
+    i, n = 0, len(toks)
+    while i < n:
+        kind, text = toks[i]
+        if kind == "punct" and text == "(":
+            parens.append(toks[i - 1][1] if i and toks[i - 1][0] == "word" else None)
+        elif kind == "punct" and text == ")" and parens:
+            parens.pop()
+        if not (kind == "word" and text in _TABLE_KEYWORDS) or (parens and parens[-1] in _FROM_FUNCTIONS):
+            i += 1
+            continue
+        # read a comma separated list of FROM items
+        i += 1
+        while i < n:
+            if toks[i] == ("word", "only") or toks[i] == ("word", "lateral"):
+                i += 1
+                continue
+            kind, text = toks[i] if i < n else (None, None)
+            if kind not in ("word", "qident") or (kind == "word" and text in _FROM_TERMINATORS):
+                break
+            name = [_ident(kind, text)]
+            i += 1
+            while i + 1 < n and toks[i] == ("punct", ".") and toks[i + 1][0] in ("word", "qident"):
+                name.append(_ident(*toks[i + 1]))
+                i += 2
+            is_function = i < n and toks[i] == ("punct", "(")
+            full = ".".join(name)
+            if not is_function and not (len(name) == 1 and full in ctes):
+                tables.add(full)
+            # skip alias / column alias list up to the next comma at this level
+            depth = 0
+            while i < n:
+                k, t = toks[i]
+                if t == "(" and k == "punct":
+                    depth += 1
+                elif t == ")" and k == "punct":
+                    if depth == 0:
+                        break
+                    depth -= 1
+                elif depth == 0 and (t == "," or (k == "word" and t in _FROM_TERMINATORS)):
+                    break
+                i += 1
+            if i < n and toks[i] == ("punct", ","):
+                i += 1
+                continue
+            break
+    return tables
+
+
+def uses_volatile_functions(sql_text):
+    toks = significant_tokens(sql_text)
+    for i, (kind, text) in enumerate(toks):
+        if kind == "word" and text in VOLATILE_FUNCTIONS:
+            # current_date & co. are used without parentheses
+            if text.startswith(("current_", "local")) or (i + 1 < len(toks) and toks[i + 1] == ("punct", "(")):
+                return True
+    return False
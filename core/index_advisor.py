@@ -0,0 +1,255 @@
+# core/index_advisor.py
+import os
+import re
+import asyncio
+import hashlib
+from dotenv import load_dotenv
+load_dotenv()
+
+from core.optimizer import plan_diff
+import core.admission as admission
+import core.what_if as what_if
+
+ADVISOR_MAX_CANDIDATES = int(os.getenv("ADVISOR_MAX_CANDIDATES", "5"))
+# only used when candidates are not timed; timed ones run one at a time
+ADVISOR_PARALLELISM = int(os.getenv("ADVISOR_PARALLELISM", "2"))
+# Timings (baseline and each index alike): discarded warm-up runs, then the median of N
+ADVISOR_WARMUP_RUNS = int(os.getenv("ADVISOR_WARMUP_RUNS", "1"))
+ADVISOR_MEASURE_RUNS = int(os.getenv("ADVISOR_MEASURE_RUNS", "3"))
+
+_IDENT = r'(?:"(?:[^"]|"")+"|[A-Za-z_][A-Za-z0-9_$]*)'
+# "(alias.)column <op>" at the start of a predicate, as printed by EXPLAIN
+_PRED_RE = re.compile(
+    rf"(?:^|[(\s])(?:({_IDENT})\.)?({_IDENT})\s*(=|<>|!=|<=|>=|<|>|~~\*?|!~~\*?|IS\s+(?:NOT\s+)?NULL|=\s*ANY)",
+    re.I,
+)
+# "(alias.)column = (alias.)column" in join conditions
+_JOIN_RE = re.compile(rf"(?:({_IDENT})\.)?({_IDENT})\s*=\s*(?:({_IDENT})\.)?({_IDENT})")
+# plain column sort keys, e.g. "payment.payment_date" or "amount DESC"
+_SORT_RE = re.compile(rf"^\(?(?:({_IDENT})\.)?({_IDENT})\)?(\s+DESC)?(?:\s+NULLS\s+(?:FIRST|LAST))?$", re.I)
+
+_NOT_COLUMNS = {"and", "or", "not", "null", "true", "false", "any", "all", "is", "subplan", "hashed", "case"}
+
+
+def _unquote(name):
+    if name and name.startswith('"'):
+        return name[1:-1].replace('""', '"')
+    return name
+
+
+def _quote(name):
+    if re.fullmatch(r"[a-z_][a-z0-9_$]*", name):
+        return name
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _walk(node):
+    if not isinstance(node, dict):
+        return
+    yield node
+    for child in node.get("Plans", []) or []:
+        yield from _walk(child)
+
+
+def _root(plan_json):
+    return plan_json[0]["Plan"] if isinstance(plan_json, list) else plan_json.get("Plan", plan_json)
+
+
+def derive_candidates(plan_json, max_candidates=ADVISOR_MAX_CANDIDATES):
+    """
+    Candidate indexes from an EXPLAIN (FORMAT JSON) plan, using the same nodes
+    analyze_plan_for_issues() reports on: Seq Scan filters, sort keys and join
+    conditions whose inner side is scanned sequentially.
+    Returns [{"table", "columns", "source"}], most promising first.
+    """
+    nodes = list(_walk(_root(plan_json)))
+    aliases = {}        # alias -> (schema-qualified) relation
+    seq_scanned = set()
+    for n in nodes:
+        rel = n.get("Relation Name")
+        if not rel:
+            continue
+        full = f"{n['Schema']}.{rel}" if n.get("Schema") else rel
+        aliases[n.get("Alias") or rel] = full
+        aliases.setdefault(rel, full)
+        if "Seq Scan" in str(n.get("Node Type")):
+            seq_scanned.add(full)
+    single = next(iter(set(aliases.values()))) if len(set(aliases.values())) == 1 else None
+
+    def relation(alias):
+        if alias:
+            return aliases.get(_unquote(alias))
+        return single
+
+    found = []   # (priority, table, columns, source)
+
+    for n in nodes:
+        node_type = str(n.get("Node Type", ""))
+        # Seq Scan filters: equality columns first, then range columns
+        if "Seq Scan" in node_type and n.get("Filter") and n.get("Relation Name"):
+            table = aliases.get(n.get("Alias") or n["Relation Name"])
+            eq, rng = [], []
+            for alias, col, op in _PRED_RE.findall(n["Filter"]):
+                col = _unquote(col)
+                if col.lower() in _NOT_COLUMNS or (alias and relation(alias) != table):
+                    continue
+                target = eq if op.strip().upper().startswith("=") or op.upper().startswith("IS") else rng
+                if col not in eq and col not in rng:
+                    target.append(col)
+            cols = eq + rng[:1]
+            if cols:
+                found.append((0, table, tuple(cols[:3]), "filter"))
+        # join keys on a sequentially scanned side
+        for key in ("Hash Cond", "Merge Cond", "Join Filter"):
+            cond = n.get(key)
+            if not cond:
+                continue
+            for a1, c1, a2, c2 in _JOIN_RE.findall(cond):
+                for alias, col in ((a1, c1), (a2, c2)):
+                    table = relation(alias)
+                    if table and table in seq_scanned and _unquote(col).lower() not in _NOT_COLUMNS:
+                        found.append((1, table, (_unquote(col),), "join"))
+        # sort keys that are plain columns of one relation
+        if node_type in ("Sort", "Incremental Sort") and n.get("Sort Key"):
+            tables, cols = set(), []
+            for k in n["Sort Key"]:
+                m = _SORT_RE.match(k.strip())
+                if not m:
+                    cols = []
+                    break
+                table = relation(m.group(1))
+                if table is None:
+                    cols = []
+                    break
+                tables.add(table)
+                cols.append(_unquote(m.group(2)))
+            if cols and len(tables) == 1:
+                found.append((2, tables.pop(), tuple(cols[:3]), "sort"))
+
+    seen = set()
+    out = []
+    for _, table, cols, source in sorted(found, key=lambda f: f[0]):
+        if (table, cols) in seen:
+            continue
+        seen.add((table, cols))
+        out.append({"table": table, "columns": list(cols), "source": source})
+    return out[:max_candidates]
+
+
+def _index_name(table, cols):
+    digest = hashlib.sha1(f"{table}|{','.join(cols)}".encode("utf-8")).hexdigest()[:10]
+    return f"advisor_{digest}"
+
+
+def _create_sql(table, cols, name):
+    qualified = ".".join(_quote(p) for p in table.split("."))
+    return f"CREATE INDEX {name} ON {qualified} ({', '.join(_quote(c) for c in cols)})"
+
+
+def _uses_index(plan_json, name):
+    return any(n.get("Index Name") == name for n in _walk(_root(plan_json)))
+
+
+def _total_cost(plan_json):
+    try:
+        return float(_root(plan_json)["Total Cost"])
+    except Exception:
+        return None
+
+
+async def _baseline(sql_text, executor_module, measure):
+    """
+    The query without new indexes, run like the candidates: on a sandbox
+    connection inside a transaction, with the same warm-up and repeats.
+    Without measure it is only planned.
+    """
+    async with what_if.transaction_async(sql_text, executor_module) as conn:
+        if measure:
+            return await what_if.measure_async(conn, sql_text, ADVISOR_WARMUP_RUNS, ADVISOR_MEASURE_RUNS)
+        return None, (await conn.fetchone(f"EXPLAIN (FORMAT JSON) {sql_text}"))[0]
+
+
+async def _evaluate(candidate, sql_text, executor_module, measure, base_plan=None):
+    """
+    Builds the index inside a transaction, re-plans (and optionally re-runs)
+    the query on the same connection, records the index size, then rolls back.
+    Nothing is ever committed. With base_plan, "plan_diff" shows which plan
+    nodes the index made cheaper.
+    """
+    table, cols = candidate["table"], candidate["columns"]
+    name = _index_name(table, cols)
+    create_sql = _create_sql(table, cols, name)
+    out = dict(candidate, create_sql=create_sql)
+    async with what_if.transaction_async(sql_text, executor_module) as conn:
+        try:
+            await _try_index(conn, out, name, sql_text, measure, base_plan)
+        except Exception as e:
+            out["error"] = str(e).strip()
+    return out
+
+
+async def _try_index(conn, out, name, sql_text, measure, base_plan):
+    (await conn.execute(out["create_sql"])).close()
+    out["index_size_bytes"] = (await conn.fetchone("SELECT pg_relation_size(%s::regclass)", (name,)))[0]
+    plan = (await conn.fetchone(f"EXPLAIN (FORMAT JSON) {sql_text}"))[0]
+    out["estimated_cost"] = _total_cost(plan)
+    out["used_by_plan"] = _uses_index(plan, name)
+    if measure and out["used_by_plan"]:
+        # the index's lock is held meanwhile, so the runs get a short budget
+        out["time_ms"], timed_plan = await what_if.measure_async(
+            conn, sql_text, ADVISOR_WARMUP_RUNS, ADVISOR_MEASURE_RUNS, what_if.ADVISOR_TIMED_BUDGET_MS)
+        plan = timed_plan or plan
+    if base_plan is not None and out["used_by_plan"]:
+        out["plan_diff"] = plan_diff(base_plan, plan, top=5)
+
+
+async def advise_async(sql_text, executor_module, measure=True, max_candidates=ADVISOR_MAX_CANDIDATES):
+    """
+    Suggests indexes for sql_text and evaluates each one what-if style.
+    Returns {"original": {"time_ms", "estimated_cost"}, "candidates": [...]}
+    with candidates ranked by measured (else estimated) speedup, then size.
+    The baseline and every what-if index run on the same writable node, and
+    the whole run is admitted once in the query's cost class. With measure,
+    the baseline and each index are timed the same way (warm-up, then the
+    median of ADVISOR_MEASURE_RUNS, within ADVISOR_TIMED_BUDGET_MS per index)
+    and one at a time, so runs do not compete for I/O and CPU. Nothing is
+    timed when the sandbox node is the primary; "note" then says so.
+    """
+    async with admission.admitted(sql_text, executor_module.explain_query_async):
+        with executor_module.pinned("sandbox") as node:
+            if measure and not what_if.can_measure(node):
+                out = await _advise(sql_text, executor_module, False, max_candidates)
+                out["note"] = what_if.PRIMARY_NOTE
+                return out
+            return await _advise(sql_text, executor_module, measure, max_candidates)
+
+
+async def _advise(sql_text, executor_module, measure, max_candidates):
+    base_time, base_plan = await _baseline(sql_text, executor_module, measure)
+    base_cost = _total_cost(base_plan)
+    candidates = derive_candidates(base_plan, max_candidates=max_candidates)
+
+    sem = asyncio.Semaphore(1 if measure else max(1, ADVISOR_PARALLELISM))
+
+    async def run(c):
+        async with sem:
+            return await _evaluate(c, sql_text, executor_module, measure, base_plan)
+
+    evaluated = await asyncio.gather(*(run(c) for c in candidates))
+    for c in evaluated:
+        if c.get("estimated_cost") and base_cost:
+            c["estimated_speedup"] = round(base_cost / c["estimated_cost"], 3)
+        if c.get("time_ms") and base_time:
+            c["measured_speedup"] = round(base_time / c["time_ms"], 3)
+
+    def rank(c):
+        if c.get("error") or not c.get("used_by_plan"):
+            return (1, 0.0, 0)
+        speedup = c.get("measured_speedup") or c.get("estimated_speedup") or 0.0
+        return (0, -speedup, c.get("index_size_bytes") or 0)
+
+    evaluated.sort(key=rank)
+    return {
+        "original": {"time_ms": base_time, "estimated_cost": base_cost},
+        "candidates": evaluated,
+    }
@@ -0,0 +1,101 @@
+# core/limits.py
+import os
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from dotenv import load_dotenv
+load_dotenv()
+
+# Max concurrent upstream LLM calls / database operations per process.
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "16"))
+DB_CONCURRENCY = int(os.getenv("DB_CONCURRENCY", os.getenv("DB_POOL_MAX_SIZE", "10")))
+
+
+class _Limit:
+    """
+    Named asyncio semaphore that also counts in-flight and waiting callers.
+    Semaphores bind to an event loop on first use, so one instance is kept per
+    loop; worker threads (blocking_slot()) likewise share one of their own.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = max(1, size)
+        self._sems = {}
+        self._thread_sem = threading.BoundedSemaphore(self.size)
+        self._count_lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.acquired = 0
+
+    def _count(self, waiting=0, in_flight=0, acquired=0):
+        with self._count_lock:
+            self.waiting += waiting
+            self.in_flight += in_flight
+            self.acquired += acquired
+
+    def _sem(self):
+        loop = asyncio.get_running_loop()
+        sem = self._sems.get(loop)
+        if sem is None:
+            sem = asyncio.Semaphore(self.size)
+            self._sems = {l: s for l, s in self._sems.items() if not l.is_closed()}
+            self._sems[loop] = sem
+        return sem
+
+    @asynccontextmanager
+    async def slot(self, timeout=None):
+        """Raises asyncio.TimeoutError if no slot frees within `timeout` seconds."""
+        sem = self._sem()
+        self._count(waiting=1)
+        try:
+            if timeout is None:
+                await sem.acquire()
+            else:
+                await asyncio.wait_for(sem.acquire(), timeout)
+        finally:
+            self._count(waiting=-1)
+        self._count(in_flight=1, acquired=1)
+        try:
+            yield
+        finally:
+            self._count(in_flight=-1)
+            sem.release()
+
+    @contextmanager
+    def blocking_slot(self, timeout=None):
+        """slot() for worker threads; blocks the thread. Raises TimeoutError likewise."""
+        self._count(waiting=1)
+        try:
+            if not self._thread_sem.acquire(timeout=timeout):
+                raise TimeoutError(f"no {self.name} slot freed within {timeout:g}s")
+        finally:
+            self._count(waiting=-1)
+        self._count(in_flight=1, acquired=1)
+        try:
+            yield
+        finally:
+            self._count(in_flight=-1)
+            self._thread_sem.release()
+
+    def stats(self):
+        return {"size": self.size, "in_flight": self.in_flight,
+                "waiting": self.waiting, "acquired": self.acquired}
+
+
+LLM = _Limit("llm", LLM_CONCURRENCY)
+DB = _Limit("db", DB_CONCURRENCY)
+
+
+def llm_slot():
+    """async with llm_slot(): ... bounds concurrent LLM calls."""
+    return LLM.slot()
+
+
+def db_slot():
+    """async with db_slot(): ... bounds concurrent database operations."""
+    return DB.slot()
+
+
+def limits_stats():
+    return {"llm": LLM.stats(), "db": DB.stats()}
@@ -0,0 +1,354 @@
+# core/llm_gateway.py
+import os
+import time
+import random
+import asyncio
+import weakref
+import threading
+from dotenv import load_dotenv
+load_dotenv()
+
+from core.limits import llm_slot
+from core.metrics import counter, gauge, time_stage, STAGE_SECONDS
+
+# Try to import new OpenAI client; if not available callers use their fallbacks.
+try:
+    import openai
+    from openai import OpenAI, AsyncOpenAI
+    _has_openai_v1 = True
+except Exception:
+    _has_openai_v1 = False
+
+OPENAI_KEY = os.getenv("OPENAI_API_KEY", "") or None
+# Any OpenAI-compatible endpoint, e.g. http://127.0.0.1:8001/v1 for scripts/mock_openai.py
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "") or None
+LLM_TIMEOUT_S = float(os.getenv("LLM_TIMEOUT_S", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE_S = float(os.getenv("LLM_BACKOFF_BASE_S", "0.5"))
+LLM_BACKOFF_MAX_S = float(os.getenv("LLM_BACKOFF_MAX_S", "8"))
+# Token bucket per model: sustained requests/s and burst; "model=rate:burst,..." overrides
+LLM_RATE_PER_S = float(os.getenv("LLM_RATE_PER_S", "5"))
+LLM_RATE_BURST = float(os.getenv("LLM_RATE_BURST", "10"))
+LLM_RATE_LIMITS = os.getenv("LLM_RATE_LIMITS", "")
+# Wait at most this long for a rate-limit token before giving up
+LLM_RATE_MAX_WAIT_S = float(os.getenv("LLM_RATE_MAX_WAIT_S", "5"))
+# Open the circuit after this many consecutive failed calls, for this long
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN_S = float(os.getenv("LLM_BREAKER_COOLDOWN_S", "30"))
+
+CALLS = counter(
+    "sqlagent_llm_calls_total",
+    "LLM gateway calls by model and outcome (ok, error, retry, rate_limited, circuit_open).",
+    ("model", "outcome"),
+)
+
+
+class LLMUnavailable(Exception):
+    """Raised without calling upstream: circuit open or rate limit wait too long."""
+
+
+class TokenBucket:
+    """Classic token bucket; reserve() returns how long the caller must wait."""
+
+    def __init__(self, rate_per_s, burst):
+        self.rate = max(rate_per_s, 1e-6)
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait_s):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            if wait > max_wait_s:
+                return None
+            # take the token now (possibly going negative) so waiters queue fairly
+            self.tokens -= 1
+            return wait
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failures` consecutive failures; open -> half_open
+    after `cooldown_s`, letting one probe through; the probe closes or re-opens it.
+    """
+
+    def __init__(self, failures, cooldown_s):
+        self.max_failures = max(1, failures)
+        self.cooldown_s = cooldown_s
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probe = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown_s:
+                self.state = "half_open"
+                self._probe = False
+            if self.state == "half_open" and not self._probe:
+                self._probe = True
+                return True
+            return False
+
+    def release(self):
+        # a half-open probe was abandoned (cancelled, rate limited) without a verdict
+        with self._lock:
+            if self.state == "half_open":
+                self._probe = False
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.state = "closed"
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.max_failures:
+                if self.state != "open":
+                    self.opens += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+def _parse_rate_limits(text):
+    out = {}
+    for part in (text or "").split(","):
+        model, _, spec = part.strip().partition("=")
+        if not model or not spec:
+            continue
+        rate, _, burst = spec.partition(":")
+        try:
+            out[model] = (float(rate), float(burst or rate))
+        except ValueError:
+            pass
+    return out
+
+
+_RATE_OVERRIDES = _parse_rate_limits(LLM_RATE_LIMITS)
+_buckets = {}
+_breakers = {}
+_state_lock = threading.Lock()
+_sync_client = None
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _bucket(model):
+    with _state_lock:
+        b = _buckets.get(model)
+        if b is None:
+            rate, burst = _RATE_OVERRIDES.get(model, (LLM_RATE_PER_S, LLM_RATE_BURST))
+            b = _buckets[model] = TokenBucket(rate, burst)
+        return b
+
+
+def _breaker(model):
+    with _state_lock:
+        b = _breakers.get(model)
+        if b is None:
+            b = _breakers[model] = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN_S)
+        return b
+
+
+def enabled():
+    """True when an upstream LLM is configured; callers use their rule-based fallback otherwise."""
+    return bool(OPENAI_KEY) and _has_openai_v1
+
+
+def _client_kwargs():
+    # retries are done here (with jitter and breaker accounting), not in the SDK
+    kwargs = {"api_key": OPENAI_KEY, "timeout": LLM_TIMEOUT_S, "max_retries": 0}
+    if OPENAI_BASE_URL:
+        kwargs["base_url"] = OPENAI_BASE_URL
+    return kwargs
+
+
+def get_client():
+    """Process-wide sync client; its HTTP connection pool is reused across calls."""
+    global _sync_client
+    if _sync_client is None:
+        with _state_lock:
+            if _sync_client is None:
+                _sync_client = OpenAI(**_client_kwargs())
+    return _sync_client
+
+
+def get_async_client():
+    """Async client bound to the running event loop (its connections belong to that loop)."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncOpenAI(**_client_kwargs())
+    return client
+
+
+def _retryable(exc):
+    if not _has_openai_v1:
+        return False
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+
+def _backoff(attempt):
+    # "full jitter": uniform over [0, min(max, base * 2^attempt)]
+    return random.uniform(0, min(LLM_BACKOFF_MAX_S, LLM_BACKOFF_BASE_S * (2 ** attempt)))
+
+
+def _admit(model):
+    breaker = _breaker(model)
+    if not breaker.allow():
+        CALLS.inc(model=model, outcome="circuit_open")
+        raise LLMUnavailable(f"LLM circuit open for {model}")
+    wait = _bucket(model).reserve(LLM_RATE_MAX_WAIT_S)
+    if wait is None:
+        CALLS.inc(model=model, outcome="rate_limited")
+        # not an upstream outcome: record nothing, and give back a half-open probe
+        breaker.release()
+        raise LLMUnavailable(f"LLM rate limit for {model} exceeded")
+    return breaker, wait
+
+
+def chat(messages, model, temperature=0.0, max_tokens=400, stage="llm"):
+    """
+    chat.completions.create() through the gateway (sync). Raises LLMUnavailable
+    when the circuit is open or the rate limit cannot be met in time, else the
+    last upstream error once retries are exhausted.
+    """
+    breaker, wait = _admit(model)
+    if wait:
+        time.sleep(wait)
+    client = get_client()
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            with time_stage(stage):
+                resp = client.chat.completions.create(
+                    model=model, messages=messages, temperature=temperature, max_tokens=max_tokens,
+                )
+        except Exception as e:
+            if attempt < LLM_MAX_RETRIES and _retryable(e):
+                CALLS.inc(model=model, outcome="retry")
+                time.sleep(_backoff(attempt))
+                continue
+            CALLS.inc(model=model, outcome="error")
+            breaker.record(False)
+            raise
+        CALLS.inc(model=model, outcome="ok")
+        breaker.record(True)
+        return resp
+
+
+async def chat_async(messages, model, temperature=0.0, max_tokens=400, stage="llm"):
+    """Async chat(); concurrent upstream calls are also bounded by core.limits.llm_slot()."""
+    breaker, wait = _admit(model)
+    # cancelled anywhere before the verdict (rate-limit wait, call, backoff):
+    # give back a half-open probe, or the circuit never closes again
+    try:
+        if wait:
+            await asyncio.sleep(wait)
+        client = get_async_client()
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                async with llm_slot():
+                    with time_stage(stage):
+                        resp = await client.chat.completions.create(
+                            model=model, messages=messages, temperature=temperature, max_tokens=max_tokens,
+                        )
+            except Exception as e:
+                if attempt < LLM_MAX_RETRIES and _retryable(e):
+                    CALLS.inc(model=model, outcome="retry")
+                    await asyncio.sleep(_backoff(attempt))
+                    continue
+                CALLS.inc(model=model, outcome="error")
+                breaker.record(False)
+                raise
+            CALLS.inc(model=model, outcome="ok")
+            breaker.record(True)
+            return resp
+    except asyncio.CancelledError:
+        breaker.release()
+        raise
+
+
+async def chat_stream_async(messages, model, temperature=0.0, max_tokens=400, stage="llm"):
+    """
+    Streaming chat_async(): an async generator of content deltas as they arrive.
+    Errors before the first delta are retried like chat_async(); after that the
+    error is raised to the caller, which has already consumed part of the answer.
+    Time to first delta is recorded as the "<stage>_first_token" stage.
+    """
+    breaker, wait = _admit(model)
+    started = False
+    try:
+        if wait:
+            await asyncio.sleep(wait)
+        client = get_async_client()
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                async with llm_slot():
+                    with time_stage(stage) as timer:
+                        stream = await client.chat.completions.create(
+                            model=model, messages=messages, temperature=temperature, max_tokens=max_tokens,
+                            stream=True,
+                        )
+                        async for chunk in stream:
+                            delta = chunk.choices[0].delta.content if chunk.choices else None
+                            if not delta:
+                                continue
+                            if not started:
+                                started = True
+                                STAGE_SECONDS.observe(time.perf_counter() - timer.t0,
+                                                      stage=stage + "_first_token")
+                            yield delta
+            except Exception as e:
+                if not started and attempt < LLM_MAX_RETRIES and _retryable(e):
+                    CALLS.inc(model=model, outcome="retry")
+                    await asyncio.sleep(_backoff(attempt))
+                    continue
+                CALLS.inc(model=model, outcome="error")
+                breaker.record(False)
+                raise
+            CALLS.inc(model=model, outcome="ok")
+            breaker.record(True)
+            return
+    except (asyncio.CancelledError, GeneratorExit):
+        # the consumer went away; only a completed or failed call is a verdict,
+        # and a half-open probe not yet answered is given back
+        if started:
+            breaker.record(True)
+        else:
+            breaker.release()
+        raise
+
+
+def gateway_stats():
+    with _state_lock:
+        breakers = dict(_breakers)
+        buckets = dict(_buckets)
+    return {
+        "enabled": enabled(),
+        "base_url": OPENAI_BASE_URL,
+        "models": {
+            model: {
+                "circuit": b.state,
+                "consecutive_failures": b.failures,
+                "opens": b.opens,
+                "tokens": round(buckets[model].tokens, 3) if model in buckets else None,
+            }
+            for model, b in breakers.items()
+        },
+    }
+
+
+_STATES = {"closed": 0, "half_open": 1, "open": 2}
+gauge(
+    "sqlagent_llm_circuit_state", "LLM circuit breaker per model (0 closed, 1 half-open, 2 open).",
+    lambda: {(m,): _STATES[b.state] for m, b in list(_breakers.items())}, ("model",),
+)
@@ -0,0 +1,218 @@
+# core/logwriter.py
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import threading
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv
+load_dotenv()
+
+LOG_PATH = os.getenv("AGENT_LOG_PATH", "agent_logs.jsonl")
+# Rotate when the file grows past this size; keep this many old files (.1 is newest)
+LOG_MAX_BYTES = int(os.getenv("AGENT_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("AGENT_LOG_BACKUPS", "5"))
+LOG_FLUSH_INTERVAL_S = float(os.getenv("AGENT_LOG_FLUSH_INTERVAL_S", "0.5"))
+LOG_BATCH_SIZE = int(os.getenv("AGENT_LOG_BATCH_SIZE", "256"))
+# Records beyond this many pending ones are dropped (and counted) rather than blocking requests
+LOG_QUEUE_SIZE = int(os.getenv("AGENT_LOG_QUEUE_SIZE", "10000"))
+
+_STOP = object()
+
+
+class LogWriter:
+    """
+    Appends JSON lines to a file from a background thread. log() only puts the
+    record on a bounded queue; serialisation, batching, flushing and rotation
+    all happen on the writer thread, which keeps the file open between batches.
+    """
+
+    def __init__(self, path=LOG_PATH, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS,
+                 flush_interval_s=LOG_FLUSH_INTERVAL_S, batch_size=LOG_BATCH_SIZE,
+                 queue_size=LOG_QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval_s = flush_interval_s
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._file = None
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.rotations = 0
+        self.errors = 0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+        return self
+
+    def log(self, record):
+        """Queues a dict for writing. Never blocks; drops the record if the queue is full."""
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=5):
+        """Writes everything still queued, then stops the thread."""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        return self._file
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+
+    def _write(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(json.dumps(record, default=str, separators=(",", ":")))
+            except Exception:
+                self.errors += 1
+        if not lines:
+            return
+        try:
+            f = self._open()
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            self.written += len(lines)
+            self.batches += 1
+            if self.max_bytes and f.tell() >= self.max_bytes:
+                self._rotate()
+        except Exception:
+            self.errors += 1
+            self._file = None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                first = self._queue.get(timeout=self.flush_interval_s)
+            except queue.Empty:
+                continue
+            batch = []
+            if first is _STOP:
+                stopping = True
+            else:
+                batch.append(first)
+            # drain whatever else is already queued: up to one batch, or everything when stopping
+            while stopping or len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    continue
+                batch.append(item)
+            self._write(batch)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "rotations": self.rotations,
+            "errors": self.errors,
+        }
+
+
+LOG_WRITER = LogWriter()
+atexit.register(LOG_WRITER.close)
+
+# Per-request context: request id, endpoint, stage timings and extra fields
+_request = contextvars.ContextVar("agent_request", default=None)
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def begin_request(endpoint, request_id=None):
+    """Starts collecting a log record for the current request; returns it."""
+    ctx = {"request_id": request_id or new_request_id(), "endpoint": endpoint,
+           "started": time.perf_counter(), "stages": {}, "fields": {}}
+    _request.set(ctx)
+    return ctx
+
+
+def current_request_id():
+    ctx = _request.get()
+    return ctx["request_id"] if ctx else None
+
+
+def annotate(**fields):
+    """Adds fields (rows, cache outcome, error, ...) to the current request's record."""
+    ctx = _request.get()
+    if ctx is not None:
+        ctx["fields"].update(fields)
+
+
+@contextmanager
+def stage(name):
+    """Times a block as one stage of the current request (ms, summed if repeated)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        ctx = _request.get()
+        if ctx is not None:
+            ms = (time.perf_counter() - t0) * 1000.0
+            ctx["stages"][name] = round(ctx["stages"].get(name, 0.0) + ms, 3)
+
+
+def end_request(ctx, status):
+    """Queues the request's record: one JSON line per request."""
+    record = {
+        "ts": time.time(),
+        "request_id": ctx["request_id"],
+        "endpoint": ctx["endpoint"],
+        "status": status,
+        "duration_ms": round((time.perf_counter() - ctx["started"]) * 1000.0, 3),
+        "stages": dict(ctx["stages"]),
+    }
+    record.update(ctx["fields"])
+    LOG_WRITER.log(record)
+
+
+def log_event(event, **fields):
+    """Queues a standalone record (e.g. when a streamed response finishes)."""
+    record = {"ts": time.time(), "request_id": current_request_id(), "event": event}
+    record.update(fields)
+    LOG_WRITER.log(record)
@@ -0,0 +1,229 @@
+# core/metrics.py
+import os
+import time
+import bisect
+import functools
+import threading
+import inspect
+from dotenv import load_dotenv
+load_dotenv()
+
+# Set METRICS_ENABLED=0 to turn every observation into a no-op
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") not in ("0", "false", "False")
+
+# Histogram bucket upper bounds in seconds (Prometheus convention)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _fmt(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def _key(self, labels):
+        names = self.labelnames
+        if len(names) == 1:
+            return (labels.get(names[0], ""),)
+        return tuple([labels.get(n, "") for n in names])
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = sorted(self._series.items(), key=lambda kv: str(kv[0]))
+        for key, v in items:
+            lines.append(f"{self.name}{_labels_text(self.labelnames, key)} {_fmt(v)}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # per-bucket counts (non-cumulative; summed on render), then sum
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = sorted(((k, (list(c), s)) for k, (c, s) in self._series.items()), key=lambda kv: str(kv[0]))
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = f'le="{_fmt(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels_text(self.labelnames, key, le)} {cumulative}")
+            labels = _labels_text(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_fmt(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Value read at scrape time from fn(), which returns {label values tuple: value}."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, fn, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.fn = fn
+
+    def render(self):
+        lines = self.header()
+        try:
+            values = self.fn() or {}
+        except Exception:
+            values = {}
+        for key, v in sorted(values.items(), key=lambda kv: str(kv[0])):
+            if v is None:
+                continue
+            lines.append(f"{self.name}{_labels_text(self.labelnames, key)} {_fmt(v)}")
+        return lines
+
+
+_REGISTRY = []
+_REGISTRY_LOCK = threading.Lock()
+
+
+def _register(metric):
+    with _REGISTRY_LOCK:
+        _REGISTRY.append(metric)
+    return metric
+
+
+def counter(name, help_text, labelnames=()):
+    return _register(Counter(name, help_text, labelnames))
+
+
+def histogram(name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help_text, labelnames, buckets))
+
+
+def gauge(name, help_text, fn, labelnames=()):
+    return _register(Gauge(name, help_text, fn, labelnames))
+
+
+def render():
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    with _REGISTRY_LOCK:
+        metrics = list(_REGISTRY)
+    for m in metrics:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- metrics shared across modules ---
+
+STAGE_SECONDS = histogram(
+    "sqlagent_stage_duration_seconds",
+    "Time spent in one stage of request processing (LLM call, validation, EXPLAIN, query, ...).",
+    ("stage",),
+)
+STAGE_ERRORS = counter(
+    "sqlagent_stage_errors_total", "Stages that raised an exception.", ("stage",),
+)
+REQUEST_SECONDS = histogram(
+    "sqlagent_http_request_duration_seconds", "HTTP request latency until the response starts.",
+    ("method", "endpoint"),
+)
+REQUESTS = counter(
+    "sqlagent_http_requests_total", "HTTP requests by endpoint and status code.",
+    ("method", "endpoint", "status"),
+)
+CACHE_LOOKUPS = counter(
+    "sqlagent_cache_lookups_total", "Cache lookups by cache and outcome (hit/miss).",
+    ("cache", "outcome"),
+)
+
+
+class time_stage:
+    """with time_stage("explain"): ... records the block's duration (and failures)."""
+
+    # a plain class rather than @contextmanager: this wraps hot paths
+    __slots__ = ("stage", "t0")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            STAGE_ERRORS.inc(stage=self.stage)
+        STAGE_SECONDS.observe(time.perf_counter() - self.t0, stage=self.stage)
+        return False
+
+
+def timed(stage):
+    """Decorator form of time_stage() for plain and async functions."""
+    def wrap(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with time_stage(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with time_stage(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return wrap
+
+
+def cache_lookup(cache, hit):
+    CACHE_LOOKUPS.inc(cache=cache, outcome="hit" if hit else "miss")
@@ -2,24 +2,120 @@
 import os
 import json
 import re
+import time
+import hashlib
+import threading
 from dotenv import load_dotenv
 load_dotenv()
 
-# Try to import new OpenAI client; if not available we will still allow fallback.
-try:
-    from openai import OpenAI
-    _has_openai_v1 = True
-except Exception:
-    _has_openai_v1 = False
+import core.llm_gateway as llm
+from core.cache import LRUCache
+from core.schema_index import SchemaIndex
+from core.metrics import timed, cache_lookup
+from core.singleflight import SingleFlight
 
-OPENAI_KEY = os.getenv("OPENAI_API_KEY", "") or None
+MODEL = os.getenv("NL2SQL_MODEL", "gpt-4o")  # change model if you do not have access
+
+# Answer cache: LLM results keyed on normalized question + model params + schema hash
+CACHE_SIZE = int(os.getenv("NL2SQL_CACHE_SIZE", "1024"))
+CACHE_TTL_S = float(os.getenv("NL2SQL_CACHE_TTL_S", "3600"))
+# How often (at most) schema.json is stat()-ed for changes
+SCHEMA_CHECK_INTERVAL_S = float(os.getenv("SCHEMA_CHECK_INTERVAL_S", "2"))
+# Approximate token budget for the schema part of the prompt
+SCHEMA_PROMPT_TOKENS = int(os.getenv("SCHEMA_PROMPT_TOKENS", "1500"))
+
+ANSWER_CACHE = LRUCache(maxsize=CACHE_SIZE, ttl_s=CACHE_TTL_S)
+# Concurrent misses for the same cache key share one upstream call
+FLIGHTS = SingleFlight("nl2sql")
 
 SCHEMA_PATH = "schema.json"
-if os.path.exists(SCHEMA_PATH):
-    with open(SCHEMA_PATH, "r", encoding="utf-8") as f:
-        SCHEMA = json.load(f)
-else:
-    SCHEMA = {}
+SCHEMA_META_PATH = os.getenv("SCHEMA_META_PATH", "schema_meta.json")
+SCHEMA = {}
+SCHEMA_META = {}
+SCHEMA_HASH = ""
+SCHEMA_INDEX = SchemaIndex({})
+_schema_sig = None
+_schema_checked_at = 0.0
+_schema_lock = threading.Lock()
+
+def _schema_file_sig():
+    try:
+        st = os.stat(SCHEMA_PATH)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def set_schema(schema, meta=None, sig=None):
+    """
+    Swaps in a new schema: the prompt index is built first, then the globals are
+    replaced, so requests keep using the old schema until the new one is ready.
+    Cached answers are only dropped when tables/columns actually changed.
+    """
+    global SCHEMA, SCHEMA_META, SCHEMA_HASH, SCHEMA_INDEX, _schema_sig
+    with _schema_lock:
+        new_hash = hashlib.sha1(json.dumps(schema, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        index = SCHEMA_INDEX if new_hash == SCHEMA_HASH else SchemaIndex(schema)
+        SCHEMA_INDEX, SCHEMA, SCHEMA_META = index, schema, meta or {}
+        changed = new_hash != SCHEMA_HASH
+        SCHEMA_HASH = new_hash
+        _schema_sig = sig
+    if changed:
+        ANSWER_CACHE.clear()
+
+def load_schema():
+    """
+    (Re)loads schema.json (and schema_meta.json, if present) and swaps it in.
+    """
+    sig = _schema_file_sig()
+    schema, meta = {}, {}
+    if sig is not None:
+        with open(SCHEMA_PATH, "r", encoding="utf-8") as f:
+            schema = json.load(f)
+    try:
+        with open(SCHEMA_META_PATH, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except Exception:
+        pass
+    set_schema(schema, meta, sig)
+
+def on_schema_refreshed(schema, meta):
+    """SchemaRefresher callback: the refresher has already rewritten schema.json."""
+    set_schema(schema, meta, _schema_file_sig())
+
+def _check_schema_changed():
+    global _schema_checked_at
+    now = time.monotonic()
+    if now - _schema_checked_at < SCHEMA_CHECK_INTERVAL_S:
+        return
+    _schema_checked_at = now
+    if _schema_file_sig() != _schema_sig:
+        load_schema()
+
+load_schema()
+
+_STOP_WORDS = frozenset(
+    "a an the please show me give list tell what which is are was were of for in on "
+    "to per all i we want need can could you would like find get display return".split()
+)
+_WORD_RE = re.compile(r"[a-z0-9_]+")
+
+def normalize_question(nl_query):
+    """
+    Case/whitespace/punctuation/stop-word insensitive form of a question,
+    e.g. "Show me the total rental revenue per month!" -> "total rental revenue month".
+    """
+    words = _WORD_RE.findall((nl_query or "").lower())
+    return " ".join(w for w in words if w not in _STOP_WORDS)
+
+def _cache_key(nl_query, max_tokens, temperature):
+    _check_schema_changed()
+    return (normalize_question(nl_query), MODEL, float(temperature), int(max_tokens), SCHEMA_HASH)
+
+def cache_stats():
+    stats = ANSWER_CACHE.stats()
+    stats["schema_hash"] = SCHEMA_HASH
+    stats["singleflight"] = FLIGHTS.stats()
+    return stats
 
 SYSTEM_PROMPT = (
     "You are an assistant that converts natural language questions into syntactically "
@@ -29,20 +125,18 @@ SYSTEM_PROMPT = (
     "- Use the provided schema (table names and columns) and do not invent columns."
 )
 
-def build_prompt(nl_query, schema_sample_limit=12):
-    # Include a concise schema sample
-    sample_lines = []
-    count = 0
-    for t, cols in SCHEMA.items():
-        if count >= schema_sample_limit:
-            break
-        colnames = ", ".join(c["column"] for c in cols[:10])
-        sample_lines.append(f"{t}: {colnames}")
-        count += 1
+@timed("prompt")
+def build_prompt(nl_query, schema_sample_limit=12, token_budget=None):
+    # Include the tables most relevant to the question (and their join partners)
+    sample_lines = SCHEMA_INDEX.context(
+        nl_query,
+        token_budget=token_budget or SCHEMA_PROMPT_TOKENS,
+        max_tables=schema_sample_limit,
+    )
     schema_text = "\n".join(sample_lines) if sample_lines else "(no schema available)"
     prompt = (
         SYSTEM_PROMPT
-        + "\n\nSchema (sample):\n"
+        + "\n\nSchema (relevant tables):\n"
         + schema_text
         + "\n\nQuestion:\n"
         + nl_query
@@ -59,6 +153,50 @@ def _parse_json_from_text(text):
             return None
     return None
 
+_SQL_KEY_RE = re.compile(r'"sql"\s*:\s*"')
+
+class SqlFieldExtractor:
+    """
+    Pulls the "sql" string out of a streamed JSON answer as soon as its closing
+    quote arrives, without waiting for the rest of the object:
+    feed(delta) returns the decoded SQL once, then None.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.sql = None
+        self._start = None   # index just after the opening quote of the value
+        self._pos = 0        # scan position inside the value
+
+    def feed(self, delta):
+        if self.sql is not None:
+            self.text += delta
+            return None
+        self.text += delta
+        if self._start is None:
+            m = _SQL_KEY_RE.search(self.text)
+            if not m:
+                return None
+            self._start = self._pos = m.end()
+        text = self.text
+        i = self._pos
+        while i < len(text):
+            c = text[i]
+            if c == "\\":
+                if i + 1 >= len(text):
+                    break    # escape split across deltas
+                i += 2
+                continue
+            if c == '"':
+                try:
+                    self.sql = json.loads('"' + text[self._start:i] + '"')
+                except Exception:
+                    self.sql = text[self._start:i]
+                return self.sql
+            i += 1
+        self._pos = i
+        return None
+
 def _fallback_rule_based(nl_query):
     """Simple fallback to allow testing without API key.
     Recognizes a couple of common patterns for the Pagila DB.
@@ -84,42 +222,124 @@ def _fallback_rule_based(nl_query):
     # Generic fallback: try a safe introspection-like response
     return {"sql": "-- fallback: please provide a different or more specific question", "explain": "fallback - no rule matched"}
 
+def _choice_text(resp):
+    # New client returns choices with message
+    # Access text safely
+    choice = resp.choices[0]
+    # Some responses have .message.content, sometimes .message is a dict
+    if hasattr(choice, "message") and getattr(choice.message, "content", None) is not None:
+        return choice.message.content
+    elif isinstance(choice.get("message"), dict):
+        return choice["message"].get("content", "")
+    return str(choice)
+
+def _result_from_text(text):
+    parsed = _parse_json_from_text(text)
+    if parsed:
+        return parsed
+    # fallback: return raw text as sql if JSON not found
+    return {"sql": text, "explain": ""}
+
+def _messages(nl_query):
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": build_prompt(nl_query)},
+    ]
+
+def _ask(nl_query, key, max_tokens, temperature):
+    # one upstream call; the answer is cached before followers receive it
+    resp = llm.chat(_messages(nl_query), MODEL, temperature, max_tokens, stage="llm_nl2sql")
+    out = _result_from_text(_choice_text(resp))
+    ANSWER_CACHE.put(key, out)
+    return out
+
+async def _ask_async(nl_query, key, max_tokens, temperature):
+    resp = await llm.chat_async(_messages(nl_query), MODEL, temperature, max_tokens, stage="llm_nl2sql")
+    out = _result_from_text(_choice_text(resp))
+    ANSWER_CACHE.put(key, out)
+    return out
+
 def nl_to_sql(nl_query, max_tokens=400, temperature=0.0):
     # If no OpenAI key or client, use fallback
-    if not OPENAI_KEY or not _has_openai_v1:
+    if not llm.enabled():
         # Use simple fallback rules for common patterns so you can test without an API key.
         return _fallback_rule_based(nl_query)
 
-    client = OpenAI(api_key=OPENAI_KEY)
-    prompt = build_prompt(nl_query)
+    key = _cache_key(nl_query, max_tokens, temperature)
+    cached = ANSWER_CACHE.get(key)
+    cache_lookup("nl2sql", cached is not None)
+    if cached is not None:
+        return dict(cached)
 
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4o",  # change model if you do not have access
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=temperature,
-            max_tokens=max_tokens,
-        )
-        # New client returns choices with message
-        # Access text safely
-        choice = resp.choices[0]
-        # Some responses have .message.content, sometimes .message is a dict
-        text = ""
-        if hasattr(choice, "message") and getattr(choice.message, "content", None) is not None:
-            text = choice.message.content
-        elif isinstance(choice.get("message"), dict):
-            text = choice["message"].get("content", "")
-        else:
-            text = str(choice)
-        parsed = _parse_json_from_text(text)
-        if parsed:
-            return parsed
-        # fallback: return raw text as sql if JSON not found
-        return {"sql": text, "explain": ""}
+        out = FLIGHTS.do(key, lambda: _ask(nl_query, key, max_tokens, temperature))
     except Exception as e:
-        # On API error fallback to rule-based generator
+        # On API error (or open circuit / rate limit) fallback to rule-based generator (not cached)
+        return _fallback_rule_based(nl_query)
+    return dict(out)
+
+async def nl_to_sql_async(nl_query, max_tokens=400, temperature=0.0):
+    """
+    Async nl_to_sql(): awaits the LLM without blocking a worker thread.
+    Concurrent upstream calls are bounded by core.limits.llm_slot(), and
+    identical questions asked at the same time share a single call.
+    """
+    if not llm.enabled():
+        return _fallback_rule_based(nl_query)
+
+    key = _cache_key(nl_query, max_tokens, temperature)
+    cached = ANSWER_CACHE.get(key)
+    cache_lookup("nl2sql", cached is not None)
+    if cached is not None:
+        return dict(cached)
+
+    try:
+        out = await FLIGHTS.do_async(key, lambda: _ask_async(nl_query, key, max_tokens, temperature))
+    except Exception:
         return _fallback_rule_based(nl_query)
+    return dict(out)
+
+async def nl_to_sql_stream_async(nl_query, max_tokens=400, temperature=0.0):
+    """
+    Streaming nl_to_sql_async(), an async generator of events:
+      {"type": "token", "text": ...}    each content delta from the LLM
+      {"type": "sql", "sql": ...}       as soon as the "sql" field is complete
+      {"type": "result", "result": {"sql", "explain"}, "cached": bool, "fallback": bool}
+    Cache hits and the rule-based fallback skip straight to "sql" and "result".
+    A failure mid-stream ends with the fallback result. Streams are not shared
+    between identical questions the way nl_to_sql_async() calls are.
+    """
+    if not llm.enabled():
+        out = _fallback_rule_based(nl_query)
+        yield {"type": "sql", "sql": out["sql"]}
+        yield {"type": "result", "result": out, "cached": False, "fallback": True}
+        return
+
+    key = _cache_key(nl_query, max_tokens, temperature)
+    cached = ANSWER_CACHE.get(key)
+    cache_lookup("nl2sql", cached is not None)
+    if cached is not None:
+        yield {"type": "sql", "sql": cached.get("sql")}
+        yield {"type": "result", "result": dict(cached), "cached": True, "fallback": False}
+        return
+
+    extractor = SqlFieldExtractor()
+    try:
+        async for delta in llm.chat_stream_async(_messages(nl_query), MODEL, temperature, max_tokens,
+                                                 stage="llm_nl2sql"):
+            yield {"type": "token", "text": delta}
+            sql = extractor.feed(delta)
+            if sql is not None:
+                yield {"type": "sql", "sql": sql}
+    except Exception:
+        out = _fallback_rule_based(nl_query)
+        if extractor.sql is None:
+            yield {"type": "sql", "sql": out["sql"]}
+        yield {"type": "result", "result": out, "cached": False, "fallback": True}
+        return
 
+    out = _result_from_text(extractor.text)
+    ANSWER_CACHE.put(key, out)
+    if extractor.sql is None:
+        yield {"type": "sql", "sql": out.get("sql")}
+    yield {"type": "result", "result": dict(out), "cached": False, "fallback": False}
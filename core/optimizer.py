@@ -1,57 +1,81 @@
 # core/optimizer.py
 import json
+from core.fingerprint import significant_tokens
+from core.plan_model import parse_plan, diff_plans, SORT_TYPES
+import core.what_if as what_if
+
+# flag estimates off by more than this factor (either direction)
+MISESTIMATE_FACTOR = 10.0
 
 def analyze_plan_for_issues(plan_json):
     """
     Analyze Postgres EXPLAIN (FORMAT JSON) output and return human-friendly suggestions.
+    With ANALYZE data the suggestions also carry each node's share of the run
+    time, and a plan's hottest node is named first.
     """
     suggestions = []
-
-    # normalize to plan dict
-    root = plan_json[0]["Plan"] if isinstance(plan_json, list) else plan_json.get("Plan", plan_json)
-
-    def walk(node):
-        if not isinstance(node, dict):
-            return
-        node_type = node.get("Node Type", "") or node.get("Node Type")
-        # Seq Scan detection
-        if "Seq Scan" in str(node_type):
-            relation = node.get("Relation Name") or node.get("Relation")
-            filter_cond = node.get("Filter")
-            if relation and filter_cond:
-                suggestions.append(f"Seq Scan on table '{relation}' with filter '{filter_cond}'. Consider adding an index on the filtered column(s).")
-            else:
-                suggestions.append(f"Seq Scan detected on node: {node_type}. Investigate table size and possible indexes.")
-        # Sort detection
-        if "Sort" in str(node_type):
-            sort_key = node.get("Sort Key")
-            suggestions.append(f"Sort operation detected (keys: {sort_key}). Consider creating an index on the sort key or limiting rows early.")
-        # Nested loop / hash join hints
-        if "Nested Loop" in str(node_type):
-            suggestions.append("Nested Loop join detected — may be slow for large inputs. Consider index on join keys or reordering joins.")
-        if "Hash Join" in str(node_type):
-            suggestions.append("Hash Join detected — ensure build side is not huge; check memory usage.")
-        # Cardinality mismatch
-        try:
-            plan_rows = float(node.get("Plan Rows", 0))
-            actual_rows = float(node.get("Actual Rows", node.get("Actual Rows", 0)))
-            if plan_rows > 0 and actual_rows/plan_rows > 10:
-                suggestions.append(f"Cardinality mismatch: estimated {plan_rows} rows but actual {actual_rows} rows. Consider running ANALYZE or increasing statistics target.")
-        except Exception:
-            pass
-        # traverse children
-        for child in node.get("Plans", []) or []:
-            walk(child)
-
     try:
-        walk(root)
+        plan = parse_plan(plan_json)
     except Exception as e:
-        suggestions.append(f"Plan analysis error: {str(e)}")
+        return [f"Plan analysis error: {str(e)}"]
+
+    total = sum(n.exclusive_ms or 0.0 for n in plan.nodes) if plan.analyzed else 0.0
+
+    def share(node):
+        if not total or node.exclusive_ms is None:
+            return ""
+        return f" [{node.exclusive_ms:.1f} ms, {100.0 * node.exclusive_ms / total:.0f}% of run time]"
+
+    if total:
+        hot = max(plan.nodes, key=lambda n: n.exclusive_ms or 0.0)
+        if hot.exclusive_ms and hot.exclusive_ms / total >= 0.5 and len(plan.nodes) > 1:
+            suggestions.append(f"Most time is spent in {hot.label()}{share(hot)}.")
+
+    for node in plan.nodes:
+        node_type = node.node_type
+        if node_type == "Seq Scan":
+            filter_cond = node.raw.get("Filter")
+            if node.relation and filter_cond:
+                suggestions.append(f"Seq Scan on table '{node.relation}' with filter '{filter_cond}'. Consider adding an index on the filtered column(s).{share(node)}")
+            else:
+                suggestions.append(f"Seq Scan detected on node: {node.label()}. Investigate table size and possible indexes.{share(node)}")
+        elif node_type in SORT_TYPES:
+            sort_key = node.raw.get("Sort Key")
+            spill = " Sort spilled to disk; consider raising work_mem." if node.raw.get("Sort Space Type") == "Disk" else ""
+            suggestions.append(f"Sort operation detected (keys: {sort_key}). Consider creating an index on the sort key or limiting rows early.{spill}{share(node)}")
+        elif node_type == "Nested Loop":
+            suggestions.append(f"Nested Loop join detected — may be slow for large inputs. Consider index on join keys or reordering joins.{share(node)}")
+        elif node_type == "Hash Join":
+            suggestions.append(f"Hash Join detected — ensure build side is not huge; check memory usage.{share(node)}")
+        elif node_type == "Hash" and (node.raw.get("Hash Batches") or 1) > 1:
+            suggestions.append(f"Hash spilled to {int(node.raw['Hash Batches'])} batches; consider raising work_mem.{share(node)}")
+        # Cardinality mismatch (per loop, both directions)
+        q = node.q_error
+        if q is not None and q > MISESTIMATE_FACTOR:
+            direction = "under" if node.underestimated else "over"
+            suggestions.append(f"Cardinality mismatch on {node.label()}: estimated {node.plan_rows:g} rows but actual {node.actual_rows:g} rows per loop ({q:.0f}x {direction}estimate). Consider running ANALYZE or increasing statistics target.")
+        # cold reads
+        if node.exclusive_read and node.exclusive_read >= 1000 and node.hit_ratio is not None and node.hit_ratio < 0.5:
+            suggestions.append(f"{node.label()} read {int(node.exclusive_read)} blocks from disk (buffer hit ratio {node.hit_ratio:.0%}).")
 
     if not suggestions:
         suggestions.append("No obvious issues detected in plan.")
     return suggestions
 
+def plan_report(plan_json, hot=5):
+    """Summary of a plan: totals, buffers and the hottest nodes (see core.plan_model)."""
+    try:
+        return parse_plan(plan_json).summary(hot)
+    except Exception:
+        return None
+
+def plan_diff(before_json, after_json, top=10):
+    """Which nodes got cheaper (or costlier) between two plans; None if either cannot be parsed."""
+    try:
+        return diff_plans(before_json, after_json, top=top)
+    except Exception:
+        return None
+
 def suggest_rewrite_remove_select_star(sql_text, sample_columns=None):
     """
     Suggest replacing SELECT * with explicit columns.
@@ -69,77 +93,121 @@ def suggest_rewrite_remove_select_star(sql_text, sample_columns=None):
 
 def extract_total_time_from_analyze(plan_json):
     """
-    Extract total execution time from EXPLAIN ANALYZE JSON plan (Postgres).
+    Extract total execution time from EXPLAIN ANALYZE JSON plan (Postgres):
+    Execution Time, else the root node's actual time.
     """
     try:
-        root = plan_json[0] if isinstance(plan_json, list) else plan_json
-        # top-level Execution Time
-        if isinstance(root, dict) and "Execution Time" in root:
-            return float(root["Execution Time"])
-        plan = root.get("Plan", root) if isinstance(root, dict) else root
-        if isinstance(plan, dict) and "Actual Total Time" in plan:
-            return float(plan["Actual Total Time"])
-        # recursive search
-        def walk_for_time(node):
-            if isinstance(node, dict):
-                if "Execution Time" in node:
-                    return float(node["Execution Time"])
-                if "Actual Total Time" in node:
-                    return float(node["Actual Total Time"])
-                for child in node.get("Plans", []) or []:
-                    t = walk_for_time(child)
-                    if t:
-                        return t
-            return None
-        t = walk_for_time(plan)
-        return float(t) if t is not None else None
+        return parse_plan(plan_json).total_ms
     except Exception:
         return None
 
+def check_index_statement(stmt):
+    """
+    Accepts only a single CREATE [UNIQUE] INDEX statement (no CONCURRENTLY,
+    which cannot run inside the rolled-back transaction used for simulation).
+    Returns the statement without a trailing semicolon; raises ValueError otherwise.
+    """
+    toks = significant_tokens(stmt)
+    while toks and toks[-1] == ("punct", ";"):
+        toks.pop()
+    words = [t for k, t in toks if k == "word"]
+    if words[:2] != ["create", "index"] and words[:3] != ["create", "unique", "index"]:
+        raise ValueError("index_sql must be a CREATE INDEX statement.")
+    if ("punct", ";") in toks:
+        raise ValueError("index_sql must be a single statement.")
+    if "concurrently" in words[:4]:
+        raise ValueError("CREATE INDEX CONCURRENTLY cannot be simulated inside a transaction.")
+    return stmt.strip().rstrip(";").strip()
+
 def compare_plans_and_time(original_sql, modified_sql=None, simulate_index_stmt=None, executor_module=None):
     """
     Run EXPLAIN ANALYZE on original_sql and optionally:
      - run EXPLAIN ANALYZE on modified_sql, or
-     - create index (simulate_index_stmt), run ANALYZE, then drop index.
-    executor_module must provide explain_analyze() and get_conn().
+     - create index (simulate_index_stmt) inside a transaction, run EXPLAIN ANALYZE
+       on the same connection, then roll back so nothing is ever committed.
+       Set up like the index advisor's what-ifs (see core.what_if): the timed
+       run gets ADVISOR_TIMED_BUDGET_MS, and on the primary the index is only
+       planned ("note" says so).
+    executor_module must provide explain_analyze(), explain_query(), connection() and pinned().
     """
     if executor_module is None:
         raise ValueError("Provide executor_module (core.executor)")
 
     results = {}
-    # original plan/time
-    orig_plan = executor_module.explain_analyze(original_sql)
-    orig_time = extract_total_time_from_analyze(orig_plan)
-    results["original"] = {"time_ms": orig_time, "plan": orig_plan}
-
-    if modified_sql:
-        mod_plan = executor_module.explain_analyze(modified_sql)
-        mod_time = extract_total_time_from_analyze(mod_plan)
-        results["modified"] = {"time_ms": mod_time, "plan": mod_plan}
-        return results
+    # all plans on one node; a what-if index needs a writable (sandbox) node
+    route = "sandbox" if simulate_index_stmt and not modified_sql else "benchmark"
+    with executor_module.pinned(route) as node:
+        # original plan/time
+        orig_plan = executor_module.explain_analyze(original_sql, route=route)
+        orig_time = extract_total_time_from_analyze(orig_plan)
+        results["original"] = {"time_ms": orig_time, "plan": orig_plan, "report": plan_report(orig_plan)}
+
+        if modified_sql:
+            mod_plan = executor_module.explain_analyze(modified_sql, route=route)
+            mod_time = extract_total_time_from_analyze(mod_plan)
+            results["modified"] = {"time_ms": mod_time, "plan": mod_plan, "report": plan_report(mod_plan)}
+            results["diff"] = plan_diff(orig_plan, mod_plan)
+            return results
+
+        if simulate_index_stmt:
+            stmt = check_index_statement(simulate_index_stmt)
+            measure = what_if.can_measure(node)
+            # the index disappears with the transaction
+            with what_if.transaction(original_sql, executor_module) as cur:
+                cur.execute(stmt)
+                time_with_index, plan_with_index = (
+                    what_if.measure(cur, original_sql, 0, 1, what_if.ADVISOR_TIMED_BUDGET_MS)
+                    if measure else (None, None))
+                if plan_with_index is None:
+                    cur.execute(f"EXPLAIN (FORMAT JSON) {original_sql}")
+                    plan_with_index = cur.fetchone()[0]
+            results["with_index"] = {"time_ms": time_with_index, "plan": plan_with_index,
+                                     "report": plan_report(plan_with_index)}
+            results["diff"] = plan_diff(orig_plan, plan_with_index)
+            if not measure:
+                results["note"] = what_if.PRIMARY_NOTE
+            return results
 
-    if simulate_index_stmt:
-        conn = executor_module.get_conn()
-        cur = conn.cursor()
-        try:
-            print("Creating simulated index:", simulate_index_stmt)
-            cur.execute(simulate_index_stmt)
-            conn.commit()
-            plan_with_index = executor_module.explain_analyze(original_sql)
-            time_with_index = extract_total_time_from_analyze(plan_with_index)
-            results["with_index"] = {"time_ms": time_with_index, "plan": plan_with_index}
-        finally:
-            # attempt to drop the index by name (naive extraction)
-            try:
-                parts = simulate_index_stmt.split()
-                if len(parts) >= 3 and parts[0].lower() == "create" and parts[1].lower() == "index":
-                    idxname = parts[2]
-                    cur.execute(f"DROP INDEX IF EXISTS {idxname}")
-                    conn.commit()
-            except Exception:
-                pass
-            cur.close()
-            conn.close()
         return results
 
-    return results
+async def compare_plans_and_time_async(original_sql, modified_sql=None, simulate_index_stmt=None, executor_module=None):
+    """
+    Async compare_plans_and_time(); executor_module must provide
+    explain_analyze_async(), explain_query_async(), async_connection() and pinned().
+    """
+    if executor_module is None:
+        raise ValueError("Provide executor_module (core.executor)")
+
+    results = {}
+    # all plans on one node; a what-if index needs a writable (sandbox) node
+    route = "sandbox" if simulate_index_stmt and not modified_sql else "benchmark"
+    with executor_module.pinned(route) as node:
+        orig_plan = await executor_module.explain_analyze_async(original_sql, route=route)
+        results["original"] = {"time_ms": extract_total_time_from_analyze(orig_plan), "plan": orig_plan,
+                               "report": plan_report(orig_plan)}
+
+        if modified_sql:
+            mod_plan = await executor_module.explain_analyze_async(modified_sql, route=route)
+            results["modified"] = {"time_ms": extract_total_time_from_analyze(mod_plan), "plan": mod_plan,
+                                   "report": plan_report(mod_plan)}
+            results["diff"] = plan_diff(orig_plan, mod_plan)
+            return results
+
+        if simulate_index_stmt:
+            stmt = check_index_statement(simulate_index_stmt)
+            measure = what_if.can_measure(node)
+            async with what_if.transaction_async(original_sql, executor_module) as conn:
+                (await conn.execute(stmt)).close()
+                time_with_index, plan_with_index = (
+                    await what_if.measure_async(conn, original_sql, 0, 1, what_if.ADVISOR_TIMED_BUDGET_MS)
+                    if measure else (None, None))
+                if plan_with_index is None:
+                    plan_with_index = (await conn.fetchone(f"EXPLAIN (FORMAT JSON) {original_sql}"))[0]
+            results["with_index"] = {"time_ms": time_with_index, "plan": plan_with_index,
+                                     "report": plan_report(plan_with_index)}
+            results["diff"] = plan_diff(orig_plan, plan_with_index)
+            if not measure:
+                results["note"] = what_if.PRIMARY_NOTE
+            return results
+
+        return results
@@ -0,0 +1,481 @@
+# core/pagination.py
+import os
+import hmac
+import json
+import time
+import uuid
+import base64
+import hashlib
+import asyncio
+import datetime
+from dotenv import load_dotenv
+load_dotenv()
+
+from core.pool import connect_async
+from core.routing import ROUTER, is_node_failure
+from core.limits import db_slot
+import core.admission as admission
+from core.columnar import column_types
+from core.fingerprint import fingerprint, significant_tokens, strip_semicolons
+from core.metrics import timed, counter
+import core.executor as executor
+
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "500"))
+PAGE_MAX_SIZE = int(os.getenv("PAGE_MAX_SIZE", "10000"))
+# HMAC key for continuation tokens; without one a random key is used and
+# tokens stop working when the process restarts
+PAGE_TOKEN_SECRET = os.getenv("PAGE_TOKEN_SECRET", "").encode() or os.urandom(32)
+PAGE_TOKEN_TTL_S = float(os.getenv("PAGE_TOKEN_TTL_S", "3600"))
+# Held cursors: each keeps its own connection and an open read-only transaction
+PAGE_MAX_CURSORS = int(os.getenv("PAGE_MAX_CURSORS", "8"))
+PAGE_CURSOR_IDLE_S = float(os.getenv("PAGE_CURSOR_IDLE_S", "60"))
+
+PAGES = counter(
+    "sqlagent_pages_total", "Result pages served by mode (keyset, cursor) and position (first, next).",
+    ("mode", "position"),
+)
+
+# Key column types that can be compared against a literal cast back to the type
+_KEY_TYPES = {
+    16: "bool", 20: "int8", 21: "int2", 23: "int4", 25: "text", 1042: "bpchar", 1043: "varchar",
+    700: "float4", 701: "float8", 1082: "date", 1083: "time", 1114: "timestamp",
+    1184: "timestamptz", 1186: "interval", 1700: "numeric", 2950: "uuid",
+}
+_ORDER_BY_END = frozenset(("limit", "offset", "fetch", "for"))
+
+
+class PageError(Exception):
+    """Bad, expired or foreign page token, or a statement that cannot be paged."""
+
+
+# --- continuation tokens ---
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(body):
+    return hmac.new(PAGE_TOKEN_SECRET, body, hashlib.sha256).digest()[:16]
+
+
+def encode_token(state):
+    """Opaque token: base64 JSON state plus a truncated HMAC-SHA256 of it."""
+    state = dict(state, exp=int(time.time() + PAGE_TOKEN_TTL_S))
+    body = json.dumps(state, separators=(",", ":")).encode()
+    return f"{_b64(body)}.{_b64(_sign(body))}"
+
+
+def decode_token(token):
+    try:
+        body_part, sig_part = token.split(".")
+        body, sig = _unb64(body_part), _unb64(sig_part)
+    except ValueError:
+        raise PageError("Malformed page token.")
+    if not hmac.compare_digest(sig, _sign(body)):
+        raise PageError("Invalid page token.")
+    state = json.loads(body)
+    if state.get("exp", 0) < time.time():
+        raise PageError("Page token expired; start again without page_token.")
+    return state
+
+
+def _query_id(sql_text):
+    return fingerprint(sql_text)[:16]
+
+
+# --- keyset paging ---
+
+def _ident(kind, text):
+    return text[1:-1].replace('""', '"') if kind == "qident" else text
+
+
+def _order_item(item):
+    rest = list(item)
+    nulls_last = None
+    if len(rest) > 2 and rest[-2] == ("word", "nulls") and rest[-1] in (("word", "first"), ("word", "last")):
+        nulls_last = rest[-1][1] == "last"
+        rest = rest[:-2]
+    desc = False
+    if len(rest) > 1 and rest[-1] in (("word", "asc"), ("word", "desc")):
+        desc = rest[-1][1] == "desc"
+        rest = rest[:-1]
+    if nulls_last is None:
+        nulls_last = not desc  # PostgreSQL default: NULLs sort as the largest value
+    if len(rest) == 1 and rest[0][0] == "number" and rest[0][1].isdigit():
+        return None, int(rest[0][1]), desc, nulls_last
+    if len(rest) == 1 and rest[0][0] in ("word", "qident"):
+        return _ident(*rest[0]), None, desc, nulls_last
+    if len(rest) == 3 and rest[1] == ("punct", ".") and rest[0][0] in ("word", "qident") \
+            and rest[2][0] in ("word", "qident"):
+        return _ident(*rest[2]), None, desc, nulls_last
+    return None
+
+
+def order_by_keys(sql_text):
+    """
+    Top-level ORDER BY items as [(column_name, position, desc, nulls_last)],
+    one of column_name / position (1-based) set. None without an ORDER BY or
+    when any item is an expression rather than a column.
+    """
+    toks = significant_tokens(strip_semicolons(sql_text))
+    depth, start = 0, None
+    for i, (kind, text) in enumerate(toks):
+        if kind == "punct" and text == "(":
+            depth += 1
+        elif kind == "punct" and text == ")":
+            depth -= 1
+        elif depth == 0 and kind == "word" and text == "order" and toks[i + 1:i + 2] == [("word", "by")]:
+            start = i + 2
+    if start is None:
+        return None
+    items, current = [], []
+    for kind, text in toks[start:]:
+        if kind == "word" and text in _ORDER_BY_END:
+            break
+        if kind == "punct" and text == ",":
+            items.append(current)
+            current = []
+            continue
+        if kind == "punct" and text in "()":
+            return None
+        current.append((kind, text))
+    items.append(current)
+    keys = [_order_item(item) for item in items if item]
+    return keys if keys and all(keys) else None
+
+
+def _resolve_keys(keys, description):
+    """
+    ORDER BY items -> [[output column, cast type, desc, nulls_last]], or None.
+    The other output columns are appended as tie-breakers (the ORDER BY key
+    need not be unique), so every column must be of a comparable type.
+    """
+    names = [d[0] for d in description]
+    if len(set(names)) != len(names):
+        return None
+    out = []
+    for name, position, desc, nulls_last in keys:
+        if position is not None:
+            idx = position - 1 if 0 < position <= len(names) else None
+        else:
+            matches = [i for i, n in enumerate(names) if n == name]
+            idx = matches[0] if len(matches) == 1 else None
+        if idx is None:
+            return None
+        out.append([names[idx], desc, nulls_last])
+    used = {name for name, _, _ in out}
+    out += [[name, False, True] for name in names if name not in used]
+    spec = []
+    for name, desc, nulls_last in out:
+        cast = _KEY_TYPES.get(description[names.index(name)].type_code)
+        if cast is None:
+            return None
+        spec.append([name, cast, desc, nulls_last])
+    return spec
+
+
+def _key_value(v):
+    # JSON-safe and castable back with CAST('...' AS type)
+    if v is None or isinstance(v, (bool, int, float, str)):
+        return v
+    if isinstance(v, datetime.timedelta):
+        return f"{v.total_seconds()} seconds"
+    if isinstance(v, (datetime.date, datetime.time)):
+        return v.isoformat()
+    return str(v)  # Decimal, UUID
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _at_or_after(cols, spec, after, params):
+    """Predicate: key columns at or after `after` in ORDER BY order (ties included)."""
+    if not spec:
+        return "TRUE"
+    _, cast, desc, nulls_last = spec[0]
+    col, v = cols[0], after[0]
+    rest_params = []
+    rest = _at_or_after(cols[1:], spec[1:], after[1:], rest_params)
+    if v is None:
+        params.extend(rest_params)
+        # NULL sorts before every value (NULLS FIRST) or after all of them (NULLS LAST)
+        beyond = "FALSE" if nulls_last else f"{col} IS NOT NULL"
+        return f"({beyond} OR ({col} IS NULL AND {rest}))"
+    params.extend([v, v] + rest_params)
+    op = "<" if desc else ">"
+    beyond = f"{col} {op} CAST(%s AS {cast})"
+    if nulls_last:
+        beyond = f"({beyond} OR {col} IS NULL)"
+    return f"({beyond} OR ({col} = CAST(%s AS {cast}) AND {rest}))"
+
+
+def _keyset_segments(spec, after):
+    """
+    (where, params) parts that together return the rows at or after `after`,
+    in order. The leading key gets a plain range condition (col >= value), so
+    an index on it can start the scan at the last row sent; rows with a NULL
+    leading key, which sort outside that range, come in a second segment.
+    """
+    cols = [f"subq.{_quote(name)}" for name, _, _, _ in spec]
+    if after is None:
+        return [("", [])]
+    _, cast, desc, nulls_last = spec[0]
+    col, v = cols[0], after[0]
+    params = []
+    rest = _at_or_after(cols[1:], spec[1:], after[1:], params)
+    if v is None:
+        first = (f" WHERE {col} IS NULL AND {rest}", params)
+        return [first] if nulls_last else [first, (f" WHERE {col} IS NOT NULL", [])]
+    op = "<" if desc else ">"
+    first = (f" WHERE {col} {op}= CAST(%s AS {cast}) AND ({col} {op} CAST(%s AS {cast}) OR {rest})",
+             [v, v] + params)
+    return [first, (f" WHERE {col} IS NULL", [])] if nulls_last else [first]
+
+
+def _keyset_sql(raw, spec, where, limit, skip=0, escape=True):
+    cols = [f"subq.{_quote(name)}" for name, _, _, _ in spec]
+    order = ", ".join(f"{c} {'DESC' if desc else 'ASC'} NULLS {'LAST' if nulls_last else 'FIRST'}"
+                      for c, (_, _, desc, nulls_last) in zip(cols, spec))
+    # params are always passed, so literal % signs in the statement must be doubled
+    body = raw.replace("%", "%%") if escape else raw
+    sql = f"SELECT * FROM ({body}) AS subq{where} ORDER BY {order} LIMIT {int(limit)}"
+    if skip:
+        sql += f" OFFSET {int(skip)}"
+    return sql
+
+
+async def _keyset_page(raw, spec, state, page_size, timeout_ms):
+    after = state["k"] if state else None
+    skip = state["s"] if state else 0
+    rows = []
+    # admitted by the estimate for a page without the key bound (run without
+    # params, so unescaped), which every page of the query shares
+    probe = _keyset_sql(raw, spec, "", page_size + 1, escape=False)
+    async with admission.admitted(probe, executor.explain_query_async):
+        async with db_slot():
+            async with executor.async_connection(timeout_ms, "read") as conn:
+                for n, (where, params) in enumerate(_keyset_segments(spec, after)):
+                    # skip the rows tied with `after` that were already sent (first segment only)
+                    sql = _keyset_sql(raw, spec, where, page_size + 1 - len(rows), skip if n == 0 else 0)
+                    cur = await conn.execute(sql, params)
+                    columns = [d[0] for d in cur.description]
+                    types = column_types(cur.description)
+                    rows.extend(cur.fetchall())
+                    cur.close()
+                    if len(rows) > page_size:
+                        break
+    page, more = rows[:page_size], len(rows) > page_size
+    next_state = None
+    if more:
+        idx = [columns.index(name) for name, _, _, _ in spec]
+        last = [_key_value(page[-1][i]) for i in idx]
+        tied = 0
+        for row in reversed(page):
+            if [_key_value(row[i]) for i in idx] != last:
+                break
+            tied += 1
+        if tied == len(page) and after is not None and last == after:
+            tied += skip  # the tie group started on an earlier page
+        next_state = {"m": "keyset", "c": spec, "k": last, "s": tied}
+    return {"columns": columns, "types": types, "rows": page}, next_state
+
+
+# --- held server-side cursors ---
+
+class _HeldCursor:
+    __slots__ = ("id", "conn", "query_id", "offset", "pending", "columns", "types", "last_used", "lock")
+
+    def __init__(self, query_id):
+        self.id = uuid.uuid4().hex
+        self.conn = None
+        self.query_id = query_id
+        self.offset = 0
+        self.pending = []
+        self.columns = []
+        self.types = []
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()
+
+
+_cursors = {}
+
+
+def _close(held):
+    _cursors.pop(held.id, None)
+    if held.conn is not None:
+        try:
+            # ends the transaction and with it the cursor
+            held.conn.conn.close()
+        except Exception:
+            pass
+
+
+def expire_cursors():
+    """Closes held cursors idle for longer than PAGE_CURSOR_IDLE_S."""
+    now = time.monotonic()
+    for held in list(_cursors.values()):
+        if now - held.last_used > PAGE_CURSOR_IDLE_S and not held.lock.locked():
+            _close(held)
+
+
+def close_all_cursors():
+    for held in list(_cursors.values()):
+        _close(held)
+
+
+async def _run(ac, sql):
+    cur = await ac.execute(sql)
+    cur.close()
+
+
+async def _connect_read_node():
+    # a dedicated session on a node serving reads, trying the next node if one is down
+    tried = []
+    while True:
+        node = ROUTER.pick("read", tried)
+        try:
+            return await connect_async(node.dsn)
+        except Exception as e:
+            tried.append(node)
+            if not is_node_failure(e):
+                raise
+            node.mark_failed(e)
+            if not ROUTER.has_more("read", tried):
+                raise
+
+
+async def _fetch(held, page_size):
+    need = page_size + 1 - len(held.pending)
+    async with db_slot():
+        cur = await held.conn.execute(f"FETCH FORWARD {int(need)} FROM c_{held.id}")
+        if not held.columns:
+            held.columns = [d[0] for d in cur.description]
+            held.types = column_types(cur.description)
+        rows = held.pending + cur.fetchall()
+        cur.close()
+    held.pending = rows[page_size:]
+    return rows[:page_size], bool(held.pending)
+
+
+async def _open_cursor(raw, query_id, timeout_ms):
+    expire_cursors()
+    if len(_cursors) >= PAGE_MAX_CURSORS:
+        raise PageError("Too many open result cursors; retry later, or add an ORDER BY on "
+                        "output columns to page by key instead.")
+    held = _HeldCursor(query_id)
+    _cursors[held.id] = held
+    try:
+        held.conn = await _connect_read_node()
+        await _run(held.conn, f"SET statement_timeout = {int(timeout_ms)}")
+        # server-side backstop in case this process dies with the transaction open
+        await _run(held.conn, f"SET idle_in_transaction_session_timeout = {int((PAGE_CURSOR_IDLE_S + 30) * 1000)}")
+        await _run(held.conn, "BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        await _run(held.conn, f"DECLARE c_{held.id} NO SCROLL CURSOR FOR {raw}")
+    except BaseException:
+        _close(held)
+        raise
+    return held
+
+
+async def _cursor_page(held, page_size):
+    async with held.lock:
+        try:
+            rows, more = await _fetch(held, page_size)
+        except BaseException:
+            _close(held)
+            raise
+        held.offset += len(rows)
+        held.last_used = time.monotonic()
+    if not more:
+        _close(held)
+        return {"columns": held.columns, "types": held.types, "rows": rows}, None
+    return ({"columns": held.columns, "types": held.types, "rows": rows},
+            {"m": "cursor", "id": held.id})
+
+
+def cursor_stats():
+    return {"open": len(_cursors), "max": PAGE_MAX_CURSORS, "idle_s": PAGE_CURSOR_IDLE_S}
+
+
+# --- entry point ---
+
+@timed("page")
+async def fetch_page(sql_text, page_size=None, page_token=None, mode="auto", timeout_ms=20000):
+    """
+    One page of a query's result, and a token for the next one.
+
+    The first page (no page_token) picks how later pages are fetched:
+    "keyset" re-runs the query with a WHERE on the top-level ORDER BY columns
+    (then the remaining columns, as tie-breakers) starting after the last row
+    sent, so each page costs one page of work when an index matches the order; "cursor" keeps a server-side cursor open in a
+    read-only transaction and FETCHes from it, closing it after
+    PAGE_CURSOR_IDLE_S without a request. "auto" uses keyset when the ORDER BY
+    is made of plain output columns and every column has a comparable type,
+    else a cursor.
+
+    Returns (result, next_token, info); next_token is None on the last page.
+    Raises PageError for bad/expired tokens and statements that cannot be paged.
+    """
+    page_size = max(1, min(page_size or PAGE_SIZE, PAGE_MAX_SIZE))
+    raw = strip_semicolons(sql_text)
+    if raw.lower().startswith("explain"):
+        raise PageError("EXPLAIN output cannot be paged.")
+    query_id = _query_id(raw)
+    expire_cursors()
+
+    if page_token:
+        state = decode_token(page_token)
+        if state.get("q") != query_id:
+            raise PageError("Page token belongs to a different query.")
+        offset = state.get("o", 0)
+        if state.get("m") == "keyset":
+            used = "keyset"
+            res, next_state = await _keyset_page(raw, state["c"], state, page_size, timeout_ms)
+        elif state.get("m") == "cursor":
+            held = _cursors.get(state.get("id"))
+            if held is None:
+                raise PageError(f"Page token expired (result cursors close after {PAGE_CURSOR_IDLE_S:g}s idle); "
+                                "start again without page_token.")
+            if held.offset != offset:
+                raise PageError("Page token was already used; cursor pages can only be read once, in order.")
+            used = "cursor"
+            res, next_state = await _cursor_page(held, page_size)
+        else:
+            raise PageError("Invalid page token.")
+        position = "next"
+    else:
+        if mode not in ("auto", "keyset", "cursor"):
+            raise PageError("page_mode must be auto, keyset or cursor.")
+        offset = 0
+        spec = None
+        keys = order_by_keys(raw) if mode != "cursor" else None
+        if keys:
+            # resolve ORDER BY items against the output columns (plans only, reads no rows)
+            async with db_slot():
+                async with executor.async_connection(timeout_ms, "read") as conn:
+                    cur = await conn.execute(f"SELECT * FROM ({raw}) AS subq LIMIT 0")
+                    spec = _resolve_keys(keys, cur.description)
+                    cur.close()
+        if spec is None and mode == "keyset":
+            raise PageError("Keyset paging needs a top-level ORDER BY on output columns of sortable types.")
+        used = "keyset" if spec is not None else "cursor"
+        if spec is not None:
+            res, next_state = await _keyset_page(raw, spec, None, page_size, timeout_ms)
+        else:
+            # a cursor runs the whole statement; later FETCHes continue admitted work
+            async with admission.admitted(raw, executor.explain_query_async):
+                held = await _open_cursor(raw, query_id, timeout_ms)
+                res, next_state = await _cursor_page(held, page_size)
+        position = "first"
+
+    PAGES.inc(mode=used, position=position)
+    next_token = None
+    if next_state is not None:
+        next_token = encode_token({**next_state, "q": query_id, "o": offset + len(res["rows"])})
+    return res, next_token, {"mode": used, "offset": offset, "rows": len(res["rows"]),
+                             "has_more": next_token is not None}
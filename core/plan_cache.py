@@ -0,0 +1,55 @@
+# core/plan_cache.py
+import os
+import time
+from dotenv import load_dotenv
+load_dotenv()
+
+import core.executor as executor
+from core.cache import LRUCache
+from core.fingerprint import fingerprint, referenced_tables
+from core.optimizer import analyze_plan_for_issues
+from core.metrics import cache_lookup
+
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", "512"))
+PLAN_CACHE_TTL_S = float(os.getenv("PLAN_CACHE_TTL_S", "300"))
+
+# fingerprint -> {"plan", "suggestions", "versions", "created_at"}
+PLAN_CACHE = LRUCache(maxsize=PLAN_CACHE_SIZE, ttl_s=PLAN_CACHE_TTL_S)
+_stale = {"count": 0}
+
+
+async def explain_with_suggestions_async(sql_text):
+    """
+    EXPLAIN (FORMAT JSON) + analyze_plan_for_issues(), cached by SQL fingerprint.
+    Entries are dropped when a referenced table is re-ANALYZEd or gains/loses
+    an index, or after PLAN_CACHE_TTL_S. Returns (plan, suggestions, cached).
+    """
+    key = fingerprint(sql_text)
+    tables = referenced_tables(sql_text)
+    versions = await executor.table_plan_versions_async() if tables else {}
+    current = {t: versions.get(t) for t in tables}
+
+    entry = PLAN_CACHE.get(key)
+    if entry is not None:
+        if entry["versions"] == current:
+            cache_lookup("plan", True)
+            return entry["plan"], list(entry["suggestions"]), True
+        PLAN_CACHE.pop(key)
+        _stale["count"] += 1
+    cache_lookup("plan", False)
+
+    plan = await executor.explain_query_async(sql_text)
+    suggestions = analyze_plan_for_issues(plan)
+    PLAN_CACHE.put(key, {
+        "plan": plan,
+        "suggestions": suggestions,
+        "versions": current,
+        "created_at": time.time(),
+    })
+    return plan, list(suggestions), False
+
+
+def plan_cache_stats():
+    stats = PLAN_CACHE.stats()
+    stats["stats_invalidations"] = _stale["count"]
+    return stats
@@ -0,0 +1,336 @@
+# core/plan_model.py
+import json
+
+# node types that read a relation directly; a change between them is an access-path change
+SCAN_TYPES = frozenset((
+    "Seq Scan", "Index Scan", "Index Only Scan", "Bitmap Heap Scan", "Bitmap Index Scan",
+    "Tid Scan", "Tid Range Scan", "Sample Scan",
+))
+JOIN_TYPES = frozenset(("Nested Loop", "Hash Join", "Merge Join"))
+SORT_TYPES = frozenset(("Sort", "Incremental Sort"))
+_PARALLEL_ROOTS = frozenset(("Gather", "Gather Merge"))
+
+
+def _num(node, key, default=None):
+    v = node.get(key)
+    if v is None:
+        return default
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return default
+
+
+class PlanNode:
+    """
+    One node of an EXPLAIN (FORMAT JSON) plan. Times are in ms. Fields that
+    depend on ANALYZE / BUFFERS are None for a plain EXPLAIN.
+
+    - rows / total_ms: actual rows and time summed over loops (per-loop
+      averages in the raw JSON are multiplied back out); inside Gather the
+      loop count includes workers, so time is divided by the process count.
+    - exclusive_ms / exclusive_cost: this node's own share, children removed.
+    - q_error: max(actual/estimated, estimated/actual) rows per loop, >= 1.
+    """
+
+    __slots__ = (
+        "node_type", "relation", "schema", "alias", "index_name", "parent_relationship",
+        "startup_cost", "total_cost", "plan_rows", "plan_width",
+        "actual_startup_ms", "actual_total_ms", "actual_rows", "loops",
+        "shared_hit", "shared_read", "temp_read", "temp_written",
+        "children", "parent", "depth", "id", "raw",
+        "total_ms", "exclusive_ms", "exclusive_cost", "exclusive_hit", "exclusive_read",
+        "_parallel",
+    )
+
+    def __init__(self, raw, parent=None, depth=0, parallel=1.0):
+        self.raw = raw
+        self.parent = parent
+        self.depth = depth
+        self.id = 0
+        self.node_type = raw.get("Node Type", "")
+        self.relation = raw.get("Relation Name") or raw.get("CTE Name") or raw.get("Function Name")
+        self.schema = raw.get("Schema")
+        self.alias = raw.get("Alias")
+        self.index_name = raw.get("Index Name")
+        self.parent_relationship = raw.get("Parent Relationship")
+        self.startup_cost = _num(raw, "Startup Cost", 0.0)
+        self.total_cost = _num(raw, "Total Cost", 0.0)
+        self.plan_rows = _num(raw, "Plan Rows", 0.0)
+        self.plan_width = _num(raw, "Plan Width", 0.0)
+        self.actual_startup_ms = _num(raw, "Actual Startup Time")
+        self.actual_total_ms = _num(raw, "Actual Total Time")
+        self.actual_rows = _num(raw, "Actual Rows")
+        self.loops = _num(raw, "Actual Loops")
+        self.shared_hit = _num(raw, "Shared Hit Blocks")
+        self.shared_read = _num(raw, "Shared Read Blocks")
+        self.temp_read = _num(raw, "Temp Read Blocks")
+        self.temp_written = _num(raw, "Temp Written Blocks")
+        self._parallel = parallel
+        if self.node_type in _PARALLEL_ROOTS:
+            # the leader plus workers run everything below Gather
+            parallel = 1.0 + _num(raw, "Workers Launched", _num(raw, "Workers Planned", 0.0))
+        self.children = [PlanNode(c, self, depth + 1, parallel)
+                         for c in raw.get("Plans", []) or [] if isinstance(c, dict)]
+        self.total_ms = None
+        if self.actual_total_ms is not None:
+            loops = self.loops if self.loops is not None else 1.0
+            self.total_ms = self.actual_total_ms * loops / (self._parallel if loops >= self._parallel else 1.0)
+
+    @property
+    def analyzed(self):
+        return self.actual_total_ms is not None
+
+    @property
+    def rows(self):
+        """Actual rows over all loops (EXPLAIN reports a per-loop average)."""
+        if self.actual_rows is None:
+            return None
+        return self.actual_rows * (self.loops if self.loops is not None else 1.0)
+
+    @property
+    def q_error(self):
+        if self.actual_rows is None or not self.loops:
+            return None
+        actual = max(self.actual_rows, 1.0)
+        est = max(self.plan_rows, 1.0)
+        return max(actual / est, est / actual)
+
+    @property
+    def underestimated(self):
+        return self.actual_rows is not None and self.actual_rows > self.plan_rows
+
+    @property
+    def hit_ratio(self):
+        """Shared buffer hit ratio of this node's own block accesses, None without BUFFERS or I/O."""
+        if self.exclusive_hit is None:
+            return None
+        total = self.exclusive_hit + self.exclusive_read
+        return self.exclusive_hit / total if total else None
+
+    def label(self):
+        out = self.node_type
+        if self.index_name:
+            out += f" using {self.index_name}"
+        if self.relation:
+            out += f" on {self.relation}"
+            if self.alias and self.alias != self.relation:
+                out += f" {self.alias}"
+        return out
+
+    def walk(self):
+        yield self
+        for c in self.children:
+            yield from c.walk()
+
+    def relations(self):
+        """Relation (or alias) names read anywhere in this subtree."""
+        return frozenset(n.alias or n.relation for n in self.walk() if n.relation)
+
+    def summary(self):
+        out = {"id": self.id, "node": self.label(), "exclusive_cost": round(self.exclusive_cost, 2),
+               "plan_rows": self.plan_rows}
+        if self.analyzed:
+            q = self.q_error
+            out.update({
+                "exclusive_ms": round(self.exclusive_ms, 3),
+                "total_ms": round(self.total_ms, 3),
+                "rows": self.rows,
+                "loops": self.loops,
+                "q_error": round(q, 2) if q is not None else None,
+            })
+        if self.shared_hit is not None:
+            ratio = self.hit_ratio
+            out.update({
+                "shared_hit": self.exclusive_hit,
+                "shared_read": self.exclusive_read,
+                "hit_ratio": round(ratio, 4) if ratio is not None else None,
+            })
+        return out
+
+
+class Plan:
+    """
+    A parsed EXPLAIN (FORMAT JSON) result: nodes in pre-order (ids are indexes
+    into `nodes`) with exclusive times, costs and buffers computed once.
+    """
+
+    __slots__ = ("root", "nodes", "planning_ms", "execution_ms", "raw")
+
+    def __init__(self, plan_json):
+        if isinstance(plan_json, (str, bytes)):
+            plan_json = json.loads(plan_json)
+        top = plan_json[0] if isinstance(plan_json, list) else plan_json
+        self.raw = plan_json
+        self.planning_ms = _num(top, "Planning Time")
+        self.execution_ms = _num(top, "Execution Time")
+        self.root = PlanNode(top.get("Plan", top))
+        self.nodes = list(self.root.walk())
+        for i, n in enumerate(self.nodes):
+            n.id = i
+            kids = n.children
+            n.exclusive_cost = max(0.0, n.total_cost - sum(c.total_cost for c in kids))
+            if n.total_ms is not None:
+                n.exclusive_ms = max(0.0, n.total_ms - sum(c.total_ms or 0.0 for c in kids))
+            else:
+                n.exclusive_ms = None
+            if n.shared_hit is not None:
+                n.exclusive_hit = max(0.0, n.shared_hit - sum(c.shared_hit or 0.0 for c in kids))
+                n.exclusive_read = max(0.0, (n.shared_read or 0.0) - sum(c.shared_read or 0.0 for c in kids))
+            else:
+                n.exclusive_hit = n.exclusive_read = None
+
+    @property
+    def analyzed(self):
+        return self.root.analyzed
+
+    @property
+    def total_ms(self):
+        """Execution Time if present, else the root node's time (None without ANALYZE)."""
+        if self.execution_ms is not None:
+            return self.execution_ms
+        return self.root.total_ms
+
+    @property
+    def total_cost(self):
+        return self.root.total_cost
+
+    def buffers(self):
+        if self.root.shared_hit is None:
+            return None
+        hit, read = self.root.shared_hit, self.root.shared_read or 0.0
+        return {"shared_hit": hit, "shared_read": read,
+                "hit_ratio": round(hit / (hit + read), 4) if hit + read else None}
+
+    def hot_nodes(self, n=5):
+        """
+        The n nodes with the most exclusive time (exclusive cost without
+        ANALYZE), each with its share of the total.
+        """
+        if self.analyzed:
+            weight = lambda node: node.exclusive_ms or 0.0
+        else:
+            weight = lambda node: node.exclusive_cost
+        total = sum(weight(node) for node in self.nodes) or 0.0
+        out = []
+        for node in sorted(self.nodes, key=weight, reverse=True)[:n]:
+            s = node.summary()
+            s["share"] = round(weight(node) / total, 4) if total else 0.0
+            out.append(s)
+        return out
+
+    def summary(self, hot=5):
+        out = {"total_ms": self.total_ms, "planning_ms": self.planning_ms,
+               "total_cost": self.total_cost, "nodes": len(self.nodes),
+               "hot_nodes": self.hot_nodes(hot)}
+        buffers = self.buffers()
+        if buffers:
+            out["buffers"] = buffers
+        return out
+
+
+def parse_plan(plan_json):
+    """Plan from EXPLAIN JSON (list, dict or text); Plan instances are returned as-is."""
+    if isinstance(plan_json, Plan):
+        return plan_json
+    return Plan(plan_json)
+
+
+def _exact_key(node):
+    return (node.node_type, node.relation, node.alias or node.relation, node.index_name, node.relations())
+
+
+def _scan_key(node):
+    return (node.relation, node.alias or node.relation) if node.node_type in SCAN_TYPES and node.relation else None
+
+
+def _match(before, after, key_fn, matched_b, matched_a):
+    pending = {}
+    for node in after.nodes:
+        if node.id in matched_a:
+            continue
+        key = key_fn(node)
+        if key is not None:
+            pending.setdefault(key, []).append(node)
+    pairs = []
+    for node in before.nodes:
+        if node.id in matched_b:
+            continue
+        key = key_fn(node)
+        if key is None or not pending.get(key):
+            continue
+        other = pending[key].pop(0)
+        matched_b.add(node.id)
+        matched_a.add(other.id)
+        pairs.append((node, other))
+    return pairs
+
+
+def diff_plans(before, after, top=None):
+    """
+    Node-by-node comparison of two plans of the same query (original vs
+    rewrite, or without vs with an index). Nodes are paired by type and
+    relation first, then scans of the same relation are paired even if the
+    access path changed ("replaced"). Each change is measured in exclusive ms
+    when both plans have ANALYZE data, else in exclusive cost.
+    Returns {"metric", "before", "after", "delta", "speedup", "nodes": [...]}
+    with nodes sorted by delta, largest saving first; top limits them.
+    """
+    before, after = parse_plan(before), parse_plan(after)
+    timed = before.analyzed and after.analyzed
+    metric = "ms" if timed else "cost"
+    value = (lambda n: n.exclusive_ms) if timed else (lambda n: n.exclusive_cost)
+
+    matched_b, matched_a = set(), set()
+    pairs = _match(before, after, _exact_key, matched_b, matched_a)
+    replaced = _match(before, after, _scan_key, matched_b, matched_a)
+
+    rows = []
+
+    def row(b, a, change):
+        vb = value(b) if b is not None else 0.0
+        va = value(a) if a is not None else 0.0
+        delta = va - vb
+        if change is None:
+            tolerance = max(0.05 * max(vb, va), 0.01)
+            change = "unchanged" if abs(delta) <= tolerance else ("cheaper" if delta < 0 else "costlier")
+        entry = {
+            "before": b.label() if b is not None else None,
+            "after": a.label() if a is not None else None,
+            "before_" + metric: round(vb, 3),
+            "after_" + metric: round(va, 3),
+            "delta_" + metric: round(delta, 3),
+            "change": change,
+        }
+        if timed and b is not None and a is not None and b.rows is not None and a.rows is not None and b.rows != a.rows:
+            entry["rows"] = [b.rows, a.rows]
+        rows.append(entry)
+
+    for b, a in pairs:
+        row(b, a, None)
+    for b, a in replaced:
+        row(b, a, "replaced")
+    for n in before.nodes:
+        if n.id not in matched_b:
+            row(n, None, "removed")
+    for n in after.nodes:
+        if n.id not in matched_a:
+            row(None, n, "added")
+    rows.sort(key=lambda r: r["delta_" + metric])
+    if top is not None:
+        rows = [r for r in rows if r["change"] != "unchanged"][:top]
+
+    total_b = before.total_ms if timed else before.total_cost
+    total_a = after.total_ms if timed else after.total_cost
+    out = {
+        "metric": metric,
+        "before": round(total_b, 3) if total_b is not None else None,
+        "after": round(total_a, 3) if total_a is not None else None,
+        "delta": round(total_a - total_b, 3) if total_a is not None and total_b is not None else None,
+        "speedup": round(total_b / total_a, 3) if total_a and total_b is not None else None,
+        "nodes": rows,
+    }
+    bb, ba = before.buffers(), after.buffers()
+    if bb and ba:
+        out["buffers"] = {"before": bb, "after": ba}
+    return out
@@ -0,0 +1,657 @@
+# core/pool.py
+import os
+import sys
+import time
+import asyncio
+import threading
+import weakref
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from urllib.parse import urlparse
+
+import psycopg2
+import psycopg2.extensions
+from dotenv import load_dotenv
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+POOL_TIMEOUT_S = float(os.getenv("DB_POOL_TIMEOUT_S", "30"))
+POOL_MAX_IDLE_S = float(os.getenv("DB_POOL_MAX_IDLE_S", "300"))
+POOL_MAX_LIFETIME_S = float(os.getenv("DB_POOL_MAX_LIFETIME_S", "3600"))
+# Connections idle for longer than this are pinged with SELECT 1 before reuse.
+POOL_HEALTHCHECK_AFTER_S = float(os.getenv("DB_POOL_HEALTHCHECK_AFTER_S", "30"))
+# 0 means "no limit", which is the PostgreSQL default.
+DEFAULT_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def connect_kwargs(dsn=None):
+    """
+    Turns a postgresql:// URL into psycopg2.connect() keyword arguments.
+    """
+    url = urlparse(dsn or DATABASE_URL)
+    return {
+        "dbname": url.path[1:],
+        "user": url.username,
+        "password": url.password,
+        "host": url.hostname,
+        "port": url.port or 5432,
+    }
+
+
+def connect(dsn=None):
+    """
+    Opens a new, unpooled psycopg2 connection.
+    """
+    return psycopg2.connect(**connect_kwargs(dsn))
+
+
+def _set_statement(changed):
+    # one round trip for all changed settings; SET cannot take bind parameters
+    return " ".join(
+        f"SET {k} = {psycopg2.extensions.adapt(str(v)).getquoted().decode()};"
+        for k, v in changed.items()
+    )
+
+
+class _PooledConn:
+    __slots__ = ("conn", "created_at", "last_used", "settings")
+
+    def __init__(self, conn):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+        # session settings (GUCs) currently in effect on this connection
+        self.settings = {}
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections.
+
+    Connections are handed out in autocommit mode so read-only statements
+    do not pay for an implicit BEGIN; callers that need a transaction can
+    switch autocommit off, the pool rolls back and restores it on return.
+    Session settings are tracked per connection and only re-sent when a
+    checkout asks for a different value.
+    """
+
+    def __init__(self, dsn=None, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 timeout_s=POOL_TIMEOUT_S, max_idle_s=POOL_MAX_IDLE_S,
+                 max_lifetime_s=POOL_MAX_LIFETIME_S,
+                 healthcheck_after_s=POOL_HEALTHCHECK_AFTER_S,
+                 default_settings=None):
+        self.dsn = dsn or DATABASE_URL
+        self.min_size = max(0, min(min_size, max_size))
+        self.max_size = max(1, max_size)
+        self.timeout_s = timeout_s
+        self.max_idle_s = max_idle_s
+        self.max_lifetime_s = max_lifetime_s
+        self.healthcheck_after_s = healthcheck_after_s
+        self.default_settings = {"statement_timeout": DEFAULT_STATEMENT_TIMEOUT_MS}
+        self.default_settings.update(default_settings or {})
+
+        self._cond = threading.Condition()
+        self._idle = deque()   # most recently returned connection on the right
+        self._size = 0         # idle + checked out + currently connecting
+        self._in_use = 0
+        self._closed = False
+        self._warmed = False
+        self._stats = {
+            "checkouts": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "recycled": 0,
+            "healthcheck_failures": 0,
+            "settings_applied": 0,
+            "peak_in_use": 0,
+        }
+
+    # --- connection lifecycle ---
+
+    def _open(self):
+        conn = psycopg2.connect(**connect_kwargs(self.dsn))
+        conn.autocommit = True
+        with self._cond:
+            self._stats["created"] += 1
+        return _PooledConn(conn)
+
+    def _discard(self, pc):
+        try:
+            pc.conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats["recycled"] += 1
+            self._cond.notify()
+
+    def _expired(self, pc, now):
+        if pc.conn.closed:
+            return True
+        if self.max_lifetime_s and now - pc.created_at > self.max_lifetime_s:
+            return True
+        return False
+
+    def _healthy(self, pc, now):
+        if now - pc.last_used < self.healthcheck_after_s:
+            return True
+        try:
+            cur = pc.conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            return True
+        except Exception:
+            with self._cond:
+                self._stats["healthcheck_failures"] += 1
+            return False
+
+    def _prune_idle_locked(self, now):
+        """Removes idle connections past max_idle_s, keeping at least min_size open."""
+        stale = []
+        while self._idle and self._size - len(stale) > self.min_size:
+            pc = self._idle[0]
+            if now - pc.last_used <= self.max_idle_s:
+                break
+            stale.append(self._idle.popleft())
+        return stale
+
+    def _warm(self):
+        with self._cond:
+            if self._warmed:
+                return
+            self._warmed = True
+            missing = self.min_size - self._size
+            self._size += max(0, missing)
+        for _ in range(max(0, missing)):
+            try:
+                pc = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                continue
+            with self._cond:
+                self._idle.append(pc)
+                self._cond.notify()
+
+    def _apply_settings(self, pc, settings):
+        wanted = dict(self.default_settings)
+        if settings:
+            wanted.update(settings)
+        changed = {k: v for k, v in wanted.items() if pc.settings.get(k) != v}
+        if not changed:
+            return
+        cur = pc.conn.cursor()
+        cur.execute(_set_statement(changed))
+        cur.close()
+        pc.settings.update(changed)
+        with self._cond:
+            self._stats["settings_applied"] += 1
+
+    # --- public API ---
+
+    def getconn(self, settings=None, timeout_s=None):
+        """
+        Checks out a connection, waiting up to timeout_s for one to free up.
+        Returns a _PooledConn; hand it back with putconn().
+        """
+        if not self._warmed:
+            self._warm()
+        timeout_s = self.timeout_s if timeout_s is None else timeout_s
+        start = time.monotonic()
+        deadline = start + timeout_s
+        while True:
+            pc = None
+            stale = []
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed.")
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No database connection available within {timeout_s:.1f}s "
+                            f"(pool max_size={self.max_size})."
+                        )
+                    self._cond.wait(remaining)
+                now = time.monotonic()
+                stale = self._prune_idle_locked(now)
+                if self._idle:
+                    pc = self._idle.pop()
+                else:
+                    self._size += 1
+            for s in stale:
+                self._discard(s)
+
+            if pc is None:
+                try:
+                    pc = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif self._expired(pc, now) or not self._healthy(pc, now):
+                self._discard(pc)
+                continue
+
+            try:
+                self._apply_settings(pc, settings)
+            except Exception:
+                self._discard(pc)
+                raise
+
+            waited_ms = (time.monotonic() - start) * 1000.0
+            with self._cond:
+                self._in_use += 1
+                st = self._stats
+                st["checkouts"] += 1
+                st["wait_ms_total"] += waited_ms
+                st["wait_ms_max"] = max(st["wait_ms_max"], waited_ms)
+                st["peak_in_use"] = max(st["peak_in_use"], self._in_use)
+            return pc
+
+    def putconn(self, pc, discard=False):
+        """
+        Returns a connection to the pool. Open transactions are rolled back.
+        """
+        with self._cond:
+            self._in_use -= 1
+        conn = pc.conn
+        if not discard and not conn.closed:
+            try:
+                status = conn.info.transaction_status
+                if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if not conn.autocommit:
+                    conn.autocommit = True
+            except Exception:
+                discard = True
+        if discard or conn.closed or self._closed:
+            self._discard(pc)
+            return
+        pc.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(pc)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, settings=None, timeout_s=None):
+        """
+        Context manager yielding a pooled psycopg2 connection.
+        Connections that raised a psycopg2 OperationalError/InterfaceError are not reused.
+        """
+        pc = self.getconn(settings=settings, timeout_s=timeout_s)
+        broken = False
+        try:
+            yield pc.conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(pc, discard=broken)
+
+    def stats(self):
+        with self._cond:
+            st = dict(self._stats)
+            st["size"] = self._size
+            st["idle"] = len(self._idle)
+            st["in_use"] = self._in_use
+            st["min_size"] = self.min_size
+            st["max_size"] = self.max_size
+        st["utilisation"] = round(st["in_use"] / st["max_size"], 3)
+        st["wait_ms_avg"] = round(st["wait_ms_total"] / st["checkouts"], 3) if st["checkouts"] else 0.0
+        st["wait_ms_total"] = round(st["wait_ms_total"], 3)
+        st["wait_ms_max"] = round(st["wait_ms_max"], 3)
+        return st
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+        for pc in idle:
+            self._discard(pc)
+
+
+# --- asyncio support ---
+
+def native_async_supported(loop=None):
+    """
+    psycopg2 async connections need loop.add_reader(), which the Windows
+    proactor loop does not implement; there we fall back to worker threads.
+    """
+    loop = loop or asyncio.get_running_loop()
+    proactor = getattr(asyncio, "ProactorEventLoop", None)
+    return not (sys.platform == "win32" and proactor is not None and isinstance(loop, proactor))
+
+
+async def _wait(conn):
+    """Drives a psycopg2 async connection until the pending operation completes."""
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        fd = conn.fileno()
+        fut = loop.create_future()
+
+        def ready():
+            if not fut.done():
+                fut.set_result(None)
+
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, ready)
+            try:
+                await fut
+            finally:
+                loop.remove_reader(fd)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fd, ready)
+            try:
+                await fut
+            finally:
+                loop.remove_writer(fd)
+        else:
+            raise psycopg2.OperationalError(f"Unexpected poll state: {state}")
+
+
+class AsyncConnection:
+    """
+    Awaitable wrapper around a pooled connection. Uses a psycopg2 async
+    connection on the event loop when possible, otherwise a regular pooled
+    connection driven from a worker thread.
+    """
+    __slots__ = ("conn", "created_at", "last_used", "settings", "native")
+
+    def __init__(self, conn, native=True):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+        self.settings = {}
+        self.native = native
+
+    async def execute(self, sql, params=None):
+        """
+        Executes sql and returns the (already completed) cursor, ready for fetch*().
+        """
+        cur = self.conn.cursor()
+        if self.native:
+            cur.execute(sql, params)
+            await _wait(self.conn)
+        else:
+            await asyncio.to_thread(cur.execute, sql, params)
+        return cur
+
+    async def fetchone(self, sql, params=None):
+        cur = await self.execute(sql, params)
+        row = cur.fetchone()
+        cur.close()
+        return row
+
+
+async def connect_async(dsn=None):
+    """
+    Opens a new, unpooled AsyncConnection (autocommit), for sessions that
+    outlive a request, such as held result cursors. Close it with ac.conn.close().
+    """
+    if native_async_supported():
+        conn = psycopg2.connect(async_=True, **connect_kwargs(dsn or DATABASE_URL))
+        try:
+            await _wait(conn)
+        except BaseException:
+            conn.close()
+            raise
+        return AsyncConnection(conn)
+    conn = await asyncio.to_thread(connect, dsn or DATABASE_URL)
+    conn.autocommit = True
+    return AsyncConnection(conn, native=False)
+
+
+class AsyncConnectionPool:
+    """
+    asyncio counterpart of ConnectionPool. Pools are bound to one event loop;
+    use get_async_pool() to get the pool for the running loop.
+    """
+
+    def __init__(self, dsn=None, max_size=POOL_MAX_SIZE, timeout_s=POOL_TIMEOUT_S,
+                 max_idle_s=POOL_MAX_IDLE_S, max_lifetime_s=POOL_MAX_LIFETIME_S,
+                 healthcheck_after_s=POOL_HEALTHCHECK_AFTER_S, default_settings=None, sync_pool=None):
+        self.dsn = dsn or DATABASE_URL
+        self.max_size = max(1, max_size)
+        # threaded fallback (no native async support) borrows from this pool
+        self.sync_pool = sync_pool
+        self.timeout_s = timeout_s
+        self.max_idle_s = max_idle_s
+        self.max_lifetime_s = max_lifetime_s
+        self.healthcheck_after_s = healthcheck_after_s
+        self.default_settings = {"statement_timeout": DEFAULT_STATEMENT_TIMEOUT_MS}
+        self.default_settings.update(default_settings or {})
+        self._cond = asyncio.Condition()
+        self._idle = deque()
+        self._size = 0
+        self._in_use = 0
+        self._native = None
+        self._stats = {
+            "checkouts": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "recycled": 0,
+            "healthcheck_failures": 0,
+            "settings_applied": 0,
+            "peak_in_use": 0,
+        }
+
+    async def _open(self):
+        conn = psycopg2.connect(async_=True, **connect_kwargs(self.dsn))
+        try:
+            await _wait(conn)
+        except BaseException:
+            conn.close()
+            raise
+        self._stats["created"] += 1
+        return AsyncConnection(conn)
+
+    async def _discard(self, ac):
+        try:
+            ac.conn.close()
+        except Exception:
+            pass
+        async with self._cond:
+            self._size -= 1
+            self._stats["recycled"] += 1
+            self._cond.notify()
+
+    async def _usable(self, ac, now):
+        if ac.conn.closed:
+            return False
+        if self.max_lifetime_s and now - ac.created_at > self.max_lifetime_s:
+            return False
+        if now - ac.last_used < self.healthcheck_after_s:
+            return True
+        try:
+            await ac.fetchone("SELECT 1")
+            return True
+        except Exception:
+            self._stats["healthcheck_failures"] += 1
+            return False
+
+    async def _checkout(self, settings):
+        start = time.monotonic()
+        deadline = start + self.timeout_s
+        while True:
+            ac = None
+            stale = []
+            async with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No database connection available within {self.timeout_s:.1f}s "
+                            f"(async pool max_size={self.max_size})."
+                        )
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                now = time.monotonic()
+                while self._idle and now - self._idle[0].last_used > self.max_idle_s:
+                    stale.append(self._idle.popleft())
+                if self._idle:
+                    ac = self._idle.pop()
+                else:
+                    self._size += 1
+            for s in stale:
+                await self._discard(s)
+
+            if ac is None:
+                try:
+                    ac = await self._open()
+                except BaseException:
+                    async with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not await self._usable(ac, now):
+                await self._discard(ac)
+                continue
+
+            wanted = dict(self.default_settings)
+            wanted.update(settings or {})
+            changed = {k: v for k, v in wanted.items() if ac.settings.get(k) != v}
+            if changed:
+                try:
+                    cur = await ac.execute(_set_statement(changed))
+                    cur.close()
+                except BaseException:
+                    await self._discard(ac)
+                    raise
+                ac.settings.update(changed)
+                self._stats["settings_applied"] += 1
+
+            waited_ms = (time.monotonic() - start) * 1000.0
+            self._in_use += 1
+            st = self._stats
+            st["checkouts"] += 1
+            st["wait_ms_total"] += waited_ms
+            st["wait_ms_max"] = max(st["wait_ms_max"], waited_ms)
+            st["peak_in_use"] = max(st["peak_in_use"], self._in_use)
+            return ac
+
+    async def _release(self, ac, discard=False):
+        self._in_use -= 1
+        if not discard:
+            # async connections are always autocommit; an explicit BEGIN left open must be closed
+            status = ac.conn.info.transaction_status
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    cur = await ac.execute("ROLLBACK")
+                    cur.close()
+                except BaseException:
+                    discard = True
+        if discard or ac.conn.closed:
+            await self._discard(ac)
+            return
+        ac.last_used = time.monotonic()
+        async with self._cond:
+            self._idle.append(ac)
+            self._cond.notify()
+
+    @asynccontextmanager
+    async def connection(self, settings=None):
+        """
+        Async context manager yielding an AsyncConnection. A connection whose
+        operation failed at the driver level or was cancelled mid-query is closed.
+        """
+        if self._native is None:
+            self._native = native_async_supported()
+        if not self._native:
+            # borrow from the threaded pool for the duration of the block
+            sync_pool = self.sync_pool or get_pool()
+            pc = await asyncio.to_thread(sync_pool.getconn, settings)
+            broken = False
+            try:
+                yield AsyncConnection(pc.conn, native=False)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, asyncio.CancelledError):
+                broken = True
+                raise
+            finally:
+                await asyncio.to_thread(sync_pool.putconn, pc, broken)
+            return
+
+        ac = await self._checkout(settings)
+        broken = False
+        try:
+            yield ac
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, asyncio.CancelledError):
+            broken = True
+            raise
+        finally:
+            await self._release(ac, discard=broken)
+
+    def stats(self):
+        st = dict(self._stats)
+        st["size"] = self._size
+        st["idle"] = len(self._idle)
+        st["in_use"] = self._in_use
+        st["max_size"] = self.max_size
+        st["native"] = self._native
+        st["utilisation"] = round(st["in_use"] / st["max_size"], 3)
+        st["wait_ms_avg"] = round(st["wait_ms_total"] / st["checkouts"], 3) if st["checkouts"] else 0.0
+        st["wait_ms_total"] = round(st["wait_ms_total"], 3)
+        st["wait_ms_max"] = round(st["wait_ms_max"], 3)
+        return st
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+_ASYNC_POOLS = weakref.WeakKeyDictionary()
+
+
+def get_pool():
+    """
+    Returns the process-wide pool for DATABASE_URL, creating it on first use.
+    """
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = ConnectionPool()
+    return _POOL
+
+
+def get_async_pool():
+    """
+    Returns the AsyncConnectionPool bound to the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _ASYNC_POOLS.get(loop)
+    if pool is None:
+        pool = AsyncConnectionPool()
+        _ASYNC_POOLS[loop] = pool
+    return pool
+
+
+def pool_stats():
+    stats = get_pool().stats()
+    try:
+        stats["async"] = get_async_pool().stats()
+    except RuntimeError:
+        # not called from inside an event loop
+        pass
+    return stats
@@ -0,0 +1,150 @@
+# core/result_cache.py
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+load_dotenv()
+
+from core.fingerprint import fingerprint, referenced_tables, uses_volatile_functions
+
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Hard upper bound on entry age, even if no table change was observed
+RESULT_CACHE_TTL_S = float(os.getenv("RESULT_CACHE_TTL_S", "600"))
+
+
+def estimate_size(result):
+    """
+    Rough in-memory size of a {"columns": [...], "rows": [...]} result in bytes.
+    """
+    size = sys.getsizeof(result) + sys.getsizeof(result.get("columns", []))
+    rows = result.get("rows", [])
+    size += sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for v in row:
+            size += sys.getsizeof(v)
+    return size
+
+
+def cacheable_tables(sql_text):
+    """
+    Tables a query reads, or None when its result must not be cached
+    (no table references, or volatile functions such as now()/random()).
+    """
+    tables = referenced_tables(sql_text)
+    if not tables or uses_volatile_functions(sql_text):
+        return None
+    return tables
+
+
+class _Entry:
+    __slots__ = ("result", "tables", "versions", "created_at", "size")
+
+    def __init__(self, result, tables, versions, size):
+        self.result = result
+        self.tables = tables
+        self.versions = versions
+        self.created_at = time.time()
+        self.size = size
+
+
+class ResultCache:
+    """
+    Query result cache with a byte budget. Each entry remembers the
+    modification counters of the tables it read; a lookup with newer
+    counters is a miss and drops the entry. Least recently used entries
+    are evicted until the budget is met.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES, ttl_s=RESULT_CACHE_TTL_S):
+        self.max_bytes = max_bytes
+        # a single result may use at most a quarter of the budget
+        self.max_entry_bytes = max_bytes // 4
+        self.ttl_s = ttl_s
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    @staticmethod
+    def key(sql_text, row_limit):
+        return (fingerprint(sql_text), row_limit)
+
+    def _remove_locked(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def get(self, key, versions):
+        """
+        Returns (result, age_s) or None. versions maps table name -> current
+        modification counter (see executor.table_versions_async()).
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stale = self.ttl_s and now - entry.created_at > self.ttl_s
+            if not stale:
+                stale = any(versions.get(t) != v for t, v in entry.versions.items())
+            if stale:
+                self._remove_locked(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry.result, now - entry.created_at
+
+    def put(self, key, result, tables, versions):
+        size = estimate_size(result)
+        if size > self.max_entry_bytes:
+            self.rejected += 1
+            return False
+        entry = _Entry(result, tables, {t: versions.get(t) for t in tables}, size)
+        with self._lock:
+            self._remove_locked(key)
+            self._data[key] = entry
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._data:
+                _, old = self._data.popitem(last=False)
+                self._bytes -= old.size
+                self.evictions += 1
+        return True
+
+    def invalidate_tables(self, tables):
+        tables = set(tables)
+        with self._lock:
+            for key in [k for k, e in self._data.items() if e.tables & tables]:
+                self._remove_locked(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+            "rejected": self.rejected,
+        }
+
+
+RESULT_CACHE = ResultCache()
@@ -3,14 +3,12 @@ import os, re, json
 from dotenv import load_dotenv
 load_dotenv()
 
-# Try new OpenAI client if available
-try:
-    from openai import OpenAI
-    _has_openai_v1 = True
-except Exception:
-    _has_openai_v1 = False
+import core.llm_gateway as llm
+from core.fingerprint import fingerprint
+from core.singleflight import SingleFlight
 
-OPENAI_KEY = os.getenv("OPENAI_API_KEY") or None
+# Concurrent rewrite requests for the same statement share one upstream call
+FLIGHTS = SingleFlight("rewrite")
 
 SYSTEM_PROMPT = (
     "You are a SQL rewrite assistant. Given an input SELECT SQL for Postgres, "
@@ -19,44 +17,81 @@ SYSTEM_PROMPT = (
     "Do not use DDL or change semantics. If unsure, return an empty candidates list."
 )
 
+def _fallback_rewrites(sql_text, max_candidates):
+    # Fallback heuristics: remove unnecessary ORDER BY when not needed, expand SELECT * -> explicit (if small), push predicates
+    cands = []
+    low = sql_text.lower()
+    if "select *" in low:
+        cands.append({"sql": sql_text.replace("*", "payment_date, amount"), "note": "Replace SELECT * with explicit columns (fallback sample)."})
+    if "order by" in low and "limit" not in low:
+        # rewrite removing ORDER BY (may be faster if ordering unnecessary)
+        cands.append({"sql": re.sub(r"order\s+by[\s\S]*$", "", sql_text, flags=re.I).strip().rstrip(";"), "note": "Removed ORDER BY (fallback)."})
+    return {"candidates": cands[:max_candidates]}
+
+def _messages(sql_text):
+    prompt = SYSTEM_PROMPT + "\n\nInput SQL:\n" + sql_text + "\n\nReturn JSON only."
+    return [{"role":"system","content":SYSTEM_PROMPT},{"role":"user","content":prompt}]
+
+def _parse_candidates(resp):
+    choice = resp.choices[0]
+    text = ""
+    if hasattr(choice, "message") and getattr(choice.message, "content", None) is not None:
+        text = choice.message.content
+    elif isinstance(choice.get("message"), dict):
+        text = choice["message"].get("content","")
+    else:
+        text = str(choice)
+    # try to parse JSON blob
+    m = re.search(r"\{.*\}", text, re.DOTALL)
+    if m:
+        return json.loads(m.group(0))
+    # fallback: empty
+    return {"candidates":[]}
+
+def _flight_key(sql_text, max_candidates, model, temperature):
+    # comments/whitespace/keyword case do not change the request; literals do
+    return (fingerprint(sql_text), max_candidates, model, float(temperature))
+
+def _copy(result):
+    # each caller gets its own candidate dicts
+    return {**result, "candidates": [dict(c) for c in result.get("candidates", [])]}
+
 def ask_llm_for_rewrites(sql_text, max_candidates=3, model="gpt-4o", temperature=0.0):
     """
-    Ask LLM to produce candidate rewrites. Uses OpenAI v1 client if available.
-    Falls back to simple rule-based rewrites if no key.
+    Ask LLM to produce candidate rewrites through core.llm_gateway.
+    Falls back to simple rule-based rewrites if no key or the circuit is open.
     """
-    if not OPENAI_KEY or not _has_openai_v1:
-        # Fallback heuristics: remove unnecessary ORDER BY when not needed, expand SELECT * -> explicit (if small), push predicates
-        cands = []
-        low = sql_text.lower()
-        if "select *" in low:
-            cands.append({"sql": sql_text.replace("*", "payment_date, amount"), "note": "Replace SELECT * with explicit columns (fallback sample)."})
-        if "order by" in low and "limit" not in low:
-            # rewrite removing ORDER BY (may be faster if ordering unnecessary)
-            cands.append({"sql": re.sub(r"order\s+by[\s\S]*$", "", sql_text, flags=re.I).strip().rstrip(";"), "note": "Removed ORDER BY (fallback)."})
-        return {"candidates": cands[:max_candidates]}
-
-    client = OpenAI(api_key=OPENAI_KEY)
-    prompt = SYSTEM_PROMPT + "\n\nInput SQL:\n" + sql_text + "\n\nReturn JSON only."
-    try:
-        resp = client.chat.completions.create(
-            model=model,
-            messages=[{"role":"system","content":SYSTEM_PROMPT},{"role":"user","content":prompt}],
-            temperature=temperature,
-            max_tokens=600
-        )
-        choice = resp.choices[0]
-        text = ""
-        if hasattr(choice, "message") and getattr(choice.message, "content", None) is not None:
-            text = choice.message.content
-        elif isinstance(choice.get("message"), dict):
-            text = choice["message"].get("content","")
-        else:
-            text = str(choice)
-        # try to parse JSON blob
-        m = re.search(r"\{.*\}", text, re.DOTALL)
-        if m:
-            return json.loads(m.group(0))
-        # fallback: empty
-        return {"candidates":[]}
-    except Exception:
-        return {"candidates":[]}
+    if not llm.enabled():
+        return _fallback_rewrites(sql_text, max_candidates)
+
+    def call():
+        try:
+            resp = llm.chat(_messages(sql_text), model, temperature, 600, stage="llm_rewrite")
+            return _parse_candidates(resp)
+        except llm.LLMUnavailable:
+            return _fallback_rewrites(sql_text, max_candidates)
+        except Exception:
+            return {"candidates":[]}
+
+    key = _flight_key(sql_text, max_candidates, model, temperature)
+    return _copy(FLIGHTS.do(key, call))
+
+async def ask_llm_for_rewrites_async(sql_text, max_candidates=3, model="gpt-4o", temperature=0.0):
+    """
+    Async ask_llm_for_rewrites(); concurrent upstream calls are bounded by llm_slot(),
+    and identical statements submitted at the same time share a single call.
+    """
+    if not llm.enabled():
+        return _fallback_rewrites(sql_text, max_candidates)
+
+    async def call():
+        try:
+            resp = await llm.chat_async(_messages(sql_text), model, temperature, 600, stage="llm_rewrite")
+            return _parse_candidates(resp)
+        except llm.LLMUnavailable:
+            return _fallback_rewrites(sql_text, max_candidates)
+        except Exception:
+            return {"candidates":[]}
+
+    key = _flight_key(sql_text, max_candidates, model, temperature)
+    return _copy(await FLIGHTS.do_async(key, call))
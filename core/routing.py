@@ -0,0 +1,360 @@
+# core/routing.py
+import os
+import logging
+import sys
+import time
+import random
+import asyncio
+import weakref
+import threading
+import contextvars
+from contextlib import contextmanager, asynccontextmanager
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+load_dotenv()
+
+import psycopg2
+import psycopg2.errors
+
+from core.pool import (ConnectionPool, AsyncConnectionPool, PoolTimeout, get_pool, get_async_pool,
+                       DATABASE_URL)
+from core.metrics import counter, gauge
+
+logger = logging.getLogger(__name__)
+
+# Database nodes as "role=dsn" entries separated by whitespace or commas, e.g.
+# "primary=postgresql://db1/app replica=postgresql://db2/app benchmark=postgresql://db3/app".
+# Roles: primary, replica, benchmark. Without it DATABASE_URL is the only node.
+DATABASE_URLS = os.getenv("DATABASE_URLS", "")
+# Roles tried in order for each kind of work; the first role with a healthy node wins
+DB_ROUTE_READ = os.getenv("DB_ROUTE_READ", "replica,primary")
+DB_ROUTE_BENCHMARK = os.getenv("DB_ROUTE_BENCHMARK", "benchmark,replica,primary")
+# What-if indexes need a writable node; replicas cannot run CREATE INDEX
+DB_ROUTE_SANDBOX = os.getenv("DB_ROUTE_SANDBOX", "benchmark,primary")
+# A node that failed at the connection level is skipped for this long
+DB_NODE_COOLDOWN_S = float(os.getenv("DB_NODE_COOLDOWN_S", "10"))
+
+ROLES = ("primary", "replica", "benchmark")
+
+NODE_ERRORS = counter(
+    "sqlagent_db_node_errors_total", "Connection-level failures per database node.", ("node", "role"),
+)
+FAILOVERS = counter(
+    "sqlagent_db_failovers_total", "Operations moved to another node after a node failure, by route.",
+    ("route",),
+)
+
+
+class NoNodeAvailable(Exception):
+    pass
+
+
+# Server errors that mean the node itself is going away or not accepting connections
+_NODE_DOWN_ERRORS = (psycopg2.errors.AdminShutdown, psycopg2.errors.CrashShutdown,
+                     psycopg2.errors.CannotConnectNow)
+
+
+def is_node_failure(exc):
+    """
+    True for failures of the node itself (unreachable, connection lost, pool
+    exhausted, shutting down), where another node may succeed. Errors the
+    server raises for the statement (timeouts, serialization and recovery
+    conflicts, out of memory or disk, lock timeouts) are not: the same query
+    would fail or be as heavy elsewhere.
+    """
+    if isinstance(exc, (psycopg2.InterfaceError, PoolTimeout, psycopg2.errors.ConnectionException)
+                  + _NODE_DOWN_ERRORS):
+        return True
+    pgcode = getattr(exc, "pgcode", None)
+    if pgcode:
+        return pgcode.startswith("08")
+    # a plain OperationalError without SQLSTATE comes from libpq itself
+    # (connection refused, server closed the connection unexpectedly)
+    return type(exc) is psycopg2.OperationalError
+
+
+class Node:
+    """One PostgreSQL server with its own sync pool and per-loop async pools."""
+
+    def __init__(self, name, role, dsn):
+        self.name = name
+        self.role = role
+        self.dsn = dsn
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.down_until = 0.0
+        self.last_error = None
+        self._pool = None
+        self._async_pools = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def healthy(self, now=None):
+        return (now or time.monotonic()) >= self.down_until
+
+    def pool(self):
+        if self.dsn == DATABASE_URL:
+            return get_pool()
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(dsn=self.dsn)
+        return self._pool
+
+    def async_pool(self):
+        if self.dsn == DATABASE_URL:
+            return get_async_pool()
+        loop = asyncio.get_running_loop()
+        pool = self._async_pools.get(loop)
+        if pool is None:
+            pool = self._async_pools[loop] = AsyncConnectionPool(dsn=self.dsn, sync_pool=self.pool())
+        return pool
+
+    def _begin(self):
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+
+    def _end(self, exc):
+        with self._lock:
+            self.in_flight -= 1
+        if exc is not None and is_node_failure(exc) and not isinstance(exc, PoolTimeout):
+            self.mark_failed(exc)
+
+    def mark_failed(self, exc):
+        with self._lock:
+            self.errors += 1
+            self.down_until = time.monotonic() + DB_NODE_COOLDOWN_S
+            self.last_error = str(exc).strip().splitlines()[0] if str(exc).strip() else repr(exc)
+        NODE_ERRORS.inc(node=self.name, role=self.role)
+
+    @contextmanager
+    def connection(self, settings=None):
+        self._begin()
+        error = None
+        try:
+            with self.pool().connection(settings=settings) as conn:
+                yield conn
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._end(error)
+
+    @asynccontextmanager
+    async def async_connection(self, settings=None):
+        self._begin()
+        error = None
+        try:
+            async with self.async_pool().connection(settings=settings) as conn:
+                yield conn
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._end(error)
+
+    def stats(self):
+        u = urlparse(self.dsn or "")
+        return {
+            "role": self.role,
+            "server": f"{u.hostname}:{u.port or 5432}{u.path}",
+            "healthy": self.healthy(),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "down_for_s": round(max(0.0, self.down_until - time.monotonic()), 3),
+        }
+
+
+def _parse_nodes(text, default_dsn):
+    nodes, counts = [], {}
+    for entry in text.replace(",", " ").split():
+        role, sep, dsn = entry.partition("=")
+        role = role.strip().lower()
+        if not sep or role not in ROLES or not dsn:
+            logger.warning("ignoring DATABASE_URLS entry %r", entry.split("=")[0])
+            continue
+        counts[role] = counts.get(role, 0) + 1
+        nodes.append(Node(f"{role}{counts[role]}" if role != "primary" else "primary", role, dsn))
+    if not any(n.role == "primary" for n in nodes) and default_dsn:
+        nodes.insert(0, Node("primary", "primary", default_dsn))
+    return nodes
+
+
+def _roles(text):
+    return tuple(r for r in (p.strip().lower() for p in text.split(",")) if r in ROLES)
+
+
+class Router:
+    """
+    Picks a node for each kind of work ("route"): the least busy healthy node
+    of the first role in the route's preference list that has one.
+    """
+
+    def __init__(self, nodes, routes):
+        self.nodes = nodes
+        self.routes = routes
+
+    def _members(self, route):
+        roles = self.routes.get(route)
+        if roles is None:
+            raise ValueError(f"Unknown database route {route!r}")
+        return [[n for n in self.nodes if n.role == role] for role in roles]
+
+    def pick(self, route, exclude=()):
+        pinned = (_pinned.get() or {}).get(route)
+        now = time.monotonic()
+        if pinned is not None and pinned not in exclude and pinned.healthy(now):
+            return pinned
+        members = self._members(route)
+        for nodes in members:
+            up = [n for n in nodes if n not in exclude and n.healthy(now)]
+            if up:
+                low = min(n.in_flight for n in up)
+                return random.choice([n for n in up if n.in_flight == low])
+        # every candidate is cooling down: try the one that failed longest ago
+        rest = [n for nodes in members for n in nodes if n not in exclude]
+        if not rest:
+            raise NoNodeAvailable(f"No database node available for {route!r} work.")
+        return min(rest, key=lambda n: n.down_until)
+
+    def primary_only(self, route):
+        """True when every node that can serve `route` is the primary."""
+        return all(n.role == "primary" for nodes in self._members(route) for n in nodes)
+
+    def has_more(self, route, exclude):
+        return any(n not in exclude for nodes in self._members(route) for n in nodes)
+
+    def stats(self):
+        return {
+            "nodes": {n.name: n.stats() for n in self.nodes},
+            "routes": {route: list(roles) for route, roles in self.routes.items()},
+        }
+
+
+ROUTER = Router(
+    _parse_nodes(DATABASE_URLS, DATABASE_URL),
+    {
+        "primary": ("primary",),
+        "read": _roles(DB_ROUTE_READ) or ("primary",),
+        "benchmark": _roles(DB_ROUTE_BENCHMARK) or ("primary",),
+        "sandbox": _roles(DB_ROUTE_SANDBOX) or ("primary",),
+    },
+)
+
+_pinned = contextvars.ContextVar("db_pinned_nodes", default=None)
+
+
+@contextmanager
+def pinned(route):
+    """
+    Sends `route` work inside the block (including tasks it starts) to one
+    node while that node stays healthy, e.g. every run of a benchmark, so
+    timings are not compared across machines.
+    """
+    node = ROUTER.pick(route)
+    token = _pinned.set({**(_pinned.get() or {}), route: node})
+    try:
+        yield node
+    finally:
+        _pinned.reset(token)
+
+
+def run(route, settings, fn):
+    """
+    Returns fn(conn) on a node serving `route`. After a node failure the call
+    is repeated on the next node, so fn must be safe to re-run (reads).
+    """
+    tried = []
+    while True:
+        node = ROUTER.pick(route, tried)
+        try:
+            with node.connection(settings) as conn:
+                return fn(conn)
+        except Exception as e:
+            tried.append(node)
+            if not is_node_failure(e) or not ROUTER.has_more(route, tried):
+                raise
+            FAILOVERS.inc(route=route)
+
+
+async def run_async(route, settings, fn):
+    """Async run(); fn(conn) is a coroutine function."""
+    tried = []
+    while True:
+        node = ROUTER.pick(route, tried)
+        try:
+            async with node.async_connection(settings) as conn:
+                return await fn(conn)
+        except Exception as e:
+            tried.append(node)
+            if not is_node_failure(e) or not ROUTER.has_more(route, tried):
+                raise
+            FAILOVERS.inc(route=route)
+
+
+@contextmanager
+def connection(route="primary", settings=None):
+    """
+    Pooled connection on a node serving `route`. Fails over when a node
+    cannot hand out a connection; errors inside the block are not retried.
+    """
+    tried = []
+    while True:
+        node = ROUTER.pick(route, tried)
+        cm = node.connection(settings)
+        try:
+            conn = cm.__enter__()
+            break
+        except Exception as e:
+            tried.append(node)
+            if not is_node_failure(e) or not ROUTER.has_more(route, tried):
+                raise
+            FAILOVERS.inc(route=route)
+    try:
+        yield conn
+    except BaseException:
+        if not cm.__exit__(*sys.exc_info()):
+            raise
+    else:
+        cm.__exit__(None, None, None)
+
+
+@asynccontextmanager
+async def async_connection(route="primary", settings=None):
+    """Async connection(): checks out from the node's pool bound to the running loop."""
+    tried = []
+    while True:
+        node = ROUTER.pick(route, tried)
+        cm = node.async_connection(settings)
+        try:
+            conn = await cm.__aenter__()
+            break
+        except Exception as e:
+            tried.append(node)
+            if not is_node_failure(e) or not ROUTER.has_more(route, tried):
+                raise
+            FAILOVERS.inc(route=route)
+    try:
+        yield conn
+    except BaseException:
+        if not await cm.__aexit__(*sys.exc_info()):
+            raise
+    else:
+        await cm.__aexit__(None, None, None)
+
+
+def routing_stats():
+    return ROUTER.stats()
+
+
+gauge(
+    "sqlagent_db_node_in_flight", "Operations in flight per database node.",
+    lambda: {(n.name, n.role): n.in_flight for n in ROUTER.nodes}, ("node", "role"),
+)
+gauge(
+    "sqlagent_db_node_up", "Database node health (1 healthy, 0 cooling down after a failure).",
+    lambda: {(n.name, n.role): int(n.healthy()) for n in ROUTER.nodes}, ("node", "role"),
+)
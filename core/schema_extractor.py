@@ -1,39 +1,249 @@
 import os, json
-import psycopg2
-from urllib.parse import urlparse
+import tempfile
+import threading
 from dotenv import load_dotenv
 load_dotenv()
 
+from core.pool import connect, get_pool
+
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Background catalog polling interval; 0 disables the refresher
+SCHEMA_REFRESH_INTERVAL_S = float(os.getenv("SCHEMA_REFRESH_INTERVAL_S", "30"))
+SCHEMA_META_PATH = os.getenv("SCHEMA_META_PATH", "schema_meta.json")
 
 def get_conn():
-    result = urlparse(DATABASE_URL)
-    dbname = result.path[1:]
-    user = result.username
-    password = result.password
-    host = result.hostname
-    port = result.port or 5432
-    conn = psycopg2.connect(dbname=dbname, user=user, password=password, host=host, port=port)
-    return conn
+    return connect(DATABASE_URL)
+
+# One row per visible relation with a change marker built from the xmin of the
+# catalog rows that describe it. DDL (new/altered/dropped columns, indexes,
+# constraints, renames) rewrites one of those rows, so the marker changes;
+# ANALYZE updates reltuples in place and does not.
+_MARKERS_SQL = """
+SELECT c.oid, n.nspname, c.relname, c.reltuples,
+       md5(concat_ws('|', c.xmin::text, n.nspname, c.relname,
+           (SELECT string_agg(a.attnum::text || ':' || a.xmin::text, ',' ORDER BY a.attnum)
+              FROM pg_attribute a WHERE a.attrelid = c.oid AND a.attnum > 0),
+           (SELECT string_agg(i.indexrelid::text || ':' || i.xmin::text, ',' ORDER BY i.indexrelid)
+              FROM pg_index i WHERE i.indrelid = c.oid),
+           (SELECT string_agg(co.oid::text || ':' || co.xmin::text, ',' ORDER BY co.oid)
+              FROM pg_constraint co WHERE co.conrelid = c.oid))) AS marker
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind IN ('r', 'p', 'v', 'm', 'f')
+  AND NOT c.relispartition
+  AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+  AND n.nspname NOT LIKE 'pg_toast%'
+  AND has_table_privilege(c.oid, 'SELECT')
+"""
+
+_COLUMNS_SQL = """
+SELECT a.attrelid, a.attname, format_type(a.atttypid, a.atttypmod), a.attnotnull
+FROM pg_attribute a
+WHERE a.attrelid = ANY(%s) AND a.attnum > 0 AND NOT a.attisdropped
+ORDER BY a.attrelid, a.attnum
+"""
+
+_KEYS_SQL = """
+SELECT co.conrelid, co.conname, co.contype, a.attname, co.confrelid, ra.attname
+FROM pg_constraint co
+CROSS JOIN LATERAL unnest(co.conkey, co.confkey) WITH ORDINALITY AS k(attnum, fattnum, ord)
+JOIN pg_attribute a ON a.attrelid = co.conrelid AND a.attnum = k.attnum
+LEFT JOIN pg_attribute ra ON ra.attrelid = co.confrelid AND ra.attnum = k.fattnum
+WHERE co.conrelid = ANY(%s) AND co.contype IN ('p', 'f')
+ORDER BY co.conrelid, co.conname, k.ord
+"""
+
+_INDEXES_SQL = """
+SELECT i.indrelid, ic.relname, i.indisunique, i.indisprimary,
+       ARRAY(SELECT a.attname
+               FROM unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+               JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+              ORDER BY k.ord),
+       pg_get_indexdef(i.indexrelid)
+FROM pg_index i
+JOIN pg_class ic ON ic.oid = i.indexrelid
+WHERE i.indrelid = ANY(%s)
+ORDER BY i.indrelid, ic.relname
+"""
+
+
+def _row_estimate(reltuples):
+    # -1 (PG14+) means the table was never vacuumed/analyzed
+    if reltuples is None or reltuples < 0:
+        return None
+    return int(reltuples)
+
+
+def _write_json(path, data, indent=2):
+    # write-then-rename so readers never see a half written file; the temp name
+    # is unique because several server processes may refresh at the same time
+    directory, base = os.path.split(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory, prefix=f".{base}.",
+                                     suffix=".tmp", delete=False) as f:
+        tmp = f.name
+        try:
+            json.dump(data, f, indent=indent)
+        except BaseException:
+            f.close()
+            os.unlink(tmp)
+            raise
+    os.replace(tmp, path)
+
+
+class SchemaRefresher:
+    """
+    Keeps an enriched copy of the database schema up to date.
+
+    refresh() reads one marker per relation and only re-reads columns, keys and
+    indexes for relations whose marker changed (or that are new). The result:
+      schema: {"schema.table": [{"column", "type", "nullable", "pk"?, "references"?}]}
+      meta:   {"schema.table": {"rows_estimate", "primary_key", "indexes": [...]}}
+    on_change(schema, meta) is called after every refresh that changed a relation.
+    Row estimates move with every ANALYZE; a change there only rewrites the meta file.
+    """
+
+    def __init__(self, on_change=None, interval_s=SCHEMA_REFRESH_INTERVAL_S,
+                 out_path="schema.json", meta_path=SCHEMA_META_PATH):
+        self.on_change = on_change
+        self.interval_s = interval_s
+        self.out_path = out_path
+        self.meta_path = meta_path
+        self.schema = {}
+        self.meta = {}
+        self.refreshes = 0
+        self.relations_reloaded = 0
+        self.last_error = None
+        self._markers = {}     # oid -> marker
+        self._names = {}       # oid -> "schema.table"
+        self._details = {}     # oid -> {"columns", "keys", "indexes"}
+        self._rows = None      # oid -> row estimate; None until the first pass
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _load_details(self, cur, oids):
+        details = {oid: {"columns": [], "keys": [], "indexes": []} for oid in oids}
+        cur.execute(_COLUMNS_SQL, (oids,))
+        for relid, name, type_name, notnull in cur.fetchall():
+            details[relid]["columns"].append({"column": name, "type": type_name, "nullable": not notnull})
+        cur.execute(_KEYS_SQL, (oids,))
+        for relid, conname, contype, column, ref_oid, ref_column in cur.fetchall():
+            details[relid]["keys"].append((conname, contype, column, ref_oid, ref_column))
+        cur.execute(_INDEXES_SQL, (oids,))
+        for relid, name, unique, primary, columns, definition in cur.fetchall():
+            details[relid]["indexes"].append({
+                "name": name, "columns": list(columns), "unique": unique,
+                "primary": primary, "definition": definition,
+            })
+        return details
+
+    def _assemble(self):
+        schema, meta = {}, {}
+        for oid in sorted(self._names, key=lambda o: self._names[o]):
+            name = self._names[oid]
+            d = self._details[oid]
+            pk = [k[2] for k in d["keys"] if k[1] == "p"]
+            # only single-column foreign keys map cleanly onto one column
+            fk_cols = {}
+            for conname, contype, column, ref_oid, ref_column in d["keys"]:
+                if contype == "f":
+                    fk_cols.setdefault(conname, []).append((column, ref_oid, ref_column))
+            refs = {}
+            for parts in fk_cols.values():
+                if len(parts) == 1 and parts[0][1] in self._names:
+                    column, ref_oid, ref_column = parts[0]
+                    refs[column] = f"{self._names[ref_oid]}.{ref_column}"
+            cols = []
+            for c in d["columns"]:
+                c = dict(c)
+                if c["column"] in pk:
+                    c["pk"] = True
+                if c["column"] in refs:
+                    c["references"] = refs[c["column"]]
+                cols.append(c)
+            schema[name] = cols
+            meta[name] = {
+                "rows_estimate": self._rows.get(oid),
+                "primary_key": pk,
+                "indexes": d["indexes"],
+            }
+        return schema, meta
+
+    def refresh(self):
+        """
+        One incremental pass. Returns True when the schema or metadata changed
+        (always on the first pass). schema.json and on_change only follow
+        relation changes; new row estimates just rewrite the meta file.
+        """
+        with self._lock:
+            with get_pool().connection() as conn:
+                cur = conn.cursor()
+                cur.execute(_MARKERS_SQL)
+                rows = cur.fetchall()
+                markers, names, est = {}, {}, {}
+                for oid, nsp, rel, reltuples, marker in rows:
+                    markers[oid] = marker
+                    names[oid] = f"{nsp}.{rel}"
+                    est[oid] = _row_estimate(reltuples)
+                changed = [oid for oid, m in markers.items() if self._markers.get(oid) != m]
+                dropped = set(self._markers) - set(markers)
+                details = self._load_details(cur, changed) if changed else {}
+                cur.close()
+
+            relations_changed = bool(changed or dropped)
+            if not relations_changed and est == self._rows:
+                return False
+            for oid in dropped:
+                self._details.pop(oid, None)
+            self._details.update(details)
+            self._markers, self._names, self._rows = markers, names, est
+            self.schema, self.meta = self._assemble()
+            self.refreshes += 1
+            self.relations_reloaded += len(changed)
+            schema, meta = self.schema, self.meta
+
+        if self.out_path and relations_changed:
+            _write_json(self.out_path, schema)
+        if self.meta_path:
+            _write_json(self.meta_path, meta)
+        if self.on_change is not None and relations_changed:
+            self.on_change(schema, meta)
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+            self._stop.wait(self.interval_s)
+
+    def start(self):
+        if self._thread is None and self.interval_s > 0:
+            self._thread = threading.Thread(target=self._run, name="schema-refresher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self):
+        return {
+            "relations": len(self._markers),
+            "refreshes": self.refreshes,
+            "relations_reloaded": self.relations_reloaded,
+            "interval_s": self.interval_s,
+            "running": self._thread is not None,
+            "last_error": self.last_error,
+        }
+
 
 def export_schema_json(out_path="schema.json"):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-    SELECT table_schema, table_name, column_name, data_type
-    FROM information_schema.columns
-    WHERE table_schema NOT IN ('pg_catalog','information_schema')
-    ORDER BY table_schema, table_name, ordinal_position;
-    """)
-    rows = cur.fetchall()
-    schema = {}
-    for schema_name, table_name, column_name, data_type in rows:
-        key = f"{schema_name}.{table_name}"
-        schema.setdefault(key, []).append({"column": column_name, "type": data_type})
-    with open(out_path, "w") as f:
-        json.dump(schema, f, indent=2)
-    cur.close()
-    conn.close()
+    SchemaRefresher(out_path=out_path).refresh()
     print("Schema exported to", out_path)
 
 if __name__ == "__main__":
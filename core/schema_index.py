@@ -0,0 +1,231 @@
+# core/schema_index.py
+import os
+import re
+import json
+import math
+import heapq
+from collections import defaultdict
+from dotenv import load_dotenv
+load_dotenv()
+
+# Extra domain synonyms can be supplied as {"word": ["synonym", ...]} in this file.
+SYNONYMS_PATH = os.getenv("SCHEMA_SYNONYMS_PATH", "schema_synonyms.json")
+
+_BUILTIN_SYNONYMS = {
+    "revenue": ["amount", "payment", "sales", "price"],
+    "sales": ["amount", "payment", "order", "revenue"],
+    "income": ["amount", "payment"],
+    "spend": ["amount", "payment"],
+    "paid": ["payment", "amount"],
+    "money": ["amount", "payment"],
+    "cost": ["amount", "price", "cost"],
+    "client": ["customer"],
+    "user": ["customer", "account"],
+    "buyer": ["customer"],
+    "movie": ["film"],
+    "title": ["film", "title", "name"],
+    "employee": ["staff"],
+    "worker": ["staff"],
+    "shop": ["store"],
+    "location": ["address", "city", "country"],
+    "when": ["date", "time"],
+    "month": ["date"],
+    "year": ["date"],
+    "day": ["date"],
+    "rent": ["rental"],
+    "rented": ["rental"],
+    "rentals": ["rental"],
+    "stock": ["inventory"],
+    "genre": ["category"],
+    "actor": ["actor", "cast"],
+}
+
+_STOP = frozenset(
+    "a an the of for in on to per by with and or is are was were be show me give list "
+    "tell what which who how many much number count total all each every top from "
+    "please i we want need find get display return".split()
+)
+
+_CAMEL_RE = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+_SPLIT_RE = re.compile(r"[^A-Za-z0-9]+")
+
+
+def _stem(word):
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("ses", "xes")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def name_terms(name):
+    """payment_date -> ["payment", "date"]; rentalID -> ["rental", "id"]."""
+    out = []
+    for part in _SPLIT_RE.split(_CAMEL_RE.sub("_", name or "")):
+        if part:
+            out.append(_stem(part.lower()))
+    return out
+
+
+def _load_synonyms():
+    syn = {k: list(v) for k, v in _BUILTIN_SYNONYMS.items()}
+    try:
+        if os.path.exists(SYNONYMS_PATH):
+            with open(SYNONYMS_PATH, "r", encoding="utf-8") as f:
+                for k, v in json.load(f).items():
+                    syn.setdefault(k.lower(), []).extend(v)
+    except Exception:
+        pass
+    return {_stem(k): [_stem(w.lower()) for w in v] for k, v in syn.items()}
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for English/SQL identifiers
+    return len(text) // 4 + 1
+
+
+class SchemaIndex:
+    """
+    BM25 index over tables (table name terms weighted up, plus column name
+    terms), with foreign-key neighbour expansion. Build once per schema;
+    context() is read-only and safe to call from many threads.
+    """
+
+    K1 = 1.2
+    B = 0.75
+    TABLE_NAME_WEIGHT = 3
+    NEIGHBOUR_DECAY = 0.5
+
+    def __init__(self, schema):
+        self.tables = list(schema.keys())
+        self.columns = [schema[t] for t in self.tables]
+        self.synonyms = _load_synonyms()
+        self._postings = defaultdict(list)   # term -> [(table_idx, bm25 weight)]
+        self._col_terms = []                  # per table: [set(terms) per column]
+        self._doc_len = []
+        by_name = defaultdict(list)           # bare table name -> [table_idx]
+
+        for i, (table, cols) in enumerate(zip(self.tables, self.columns)):
+            bare = table.split(".")[-1]
+            by_name[bare.lower()].append(i)
+            tf = defaultdict(int)
+            for term in name_terms(bare):
+                tf[term] += self.TABLE_NAME_WEIGHT
+            col_terms = []
+            for c in cols:
+                terms = set(name_terms(c.get("column", "")))
+                col_terms.append(terms)
+                for term in terms:
+                    tf[term] += 1
+            self._col_terms.append(col_terms)
+            self._doc_len.append(sum(tf.values()))
+            for term, n in tf.items():
+                self._postings[term].append((i, n))
+
+        # fold idf and length normalisation into the postings so a query is just sums
+        n_docs = len(self.tables)
+        avg_len = (sum(self._doc_len) / n_docs) if n_docs else 1.0
+        for term, postings in self._postings.items():
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            self._postings[term] = [
+                (i, idf * tf * (self.K1 + 1) / (tf + self.K1 * (1 - self.B + self.B * self._doc_len[i] / avg_len)))
+                for i, tf in postings
+            ]
+        self._postings = dict(self._postings)
+        self._neighbours = self._build_neighbours(by_name)
+        self._lines = [self._render(i, None) for i in range(n_docs)]
+
+    def _build_neighbours(self, by_name):
+        """Table graph from explicit "references" entries, else the <table>_id naming convention."""
+        index_of = {t: i for i, t in enumerate(self.tables)}
+        neighbours = defaultdict(set)
+        for i, cols in enumerate(self.columns):
+            for c in cols:
+                targets = []
+                ref = c.get("references")
+                if ref:
+                    ref_table = ref.rsplit(".", 1)[0]
+                    if ref_table in index_of:
+                        targets.append(index_of[ref_table])
+                    else:
+                        targets.extend(by_name.get(ref_table.split(".")[-1].lower(), []))
+                else:
+                    name = (c.get("column") or "").lower()
+                    if name.endswith("_id"):
+                        targets.extend(by_name.get(name[:-3], []))
+                for j in targets:
+                    if j != i:
+                        neighbours[i].add(j)
+                        neighbours[j].add(i)
+        return neighbours
+
+    def query_terms(self, question):
+        terms = []
+        for word in _SPLIT_RE.split((question or "").lower()):
+            if not word or word in _STOP or word.isdigit():
+                continue
+            w = _stem(word)
+            terms.append(w)
+            terms.extend(self.synonyms.get(w, ()))
+        return terms
+
+    def score(self, question):
+        """{table_idx: score} for tables matching the question, incl. FK neighbours."""
+        scores = {}
+        get = scores.get
+        terms = set(self.query_terms(question))
+        for term in terms:
+            for i, w in self._postings.get(term, ()):
+                scores[i] = get(i, 0.0) + w
+        # pull in join partners of the best matches
+        for i, s in heapq.nlargest(10, scores.items(), key=lambda kv: kv[1]):
+            bonus = s * self.NEIGHBOUR_DECAY
+            for j in self._neighbours.get(i, ()):
+                if get(j, 0.0) < bonus:
+                    scores[j] = bonus
+        return scores, terms
+
+    def _render(self, i, terms, max_columns=None):
+        cols = self.columns[i]
+        order = range(len(cols))
+        if terms:
+            # matching columns first, then key columns, then the rest in table order
+            def rank(k):
+                c = cols[k]
+                hit = bool(self._col_terms[i][k] & terms)
+                key = c.get("pk") or c.get("references") or (c.get("column") or "").endswith("_id")
+                return (not hit, not key, k)
+            order = sorted(order, key=rank)
+        picked = [cols[k]["column"] for k in order][:max_columns]
+        if max_columns is not None and len(cols) > max_columns and terms:
+            # keep schema order for readability
+            pos = {c["column"]: k for k, c in enumerate(cols)}
+            picked.sort(key=lambda c: pos[c])
+        return f"{self.tables[i]}: {', '.join(picked)}"
+
+    def context(self, question, token_budget=1500, max_tables=12, max_columns=25):
+        """
+        Schema lines for the prompt, best matches first, under token_budget.
+        Falls back to the first tables in schema order when nothing matches.
+        """
+        if not self.tables:
+            return []
+        scores, terms = self.score(question)
+        ranked = heapq.nlargest(max_tables, scores, key=scores.get)
+        if not ranked:
+            ranked = range(min(max_tables, len(self.tables)))
+            terms = None
+        lines, used = [], 0
+        for i in ranked:
+            line = self._render(i, terms, max_columns) if terms else self._lines[i]
+            cost = estimate_tokens(line)
+            if used + cost > token_budget:
+                if lines:
+                    continue
+                line = line[: token_budget * 4]
+                cost = estimate_tokens(line)
+            lines.append(line)
+            used += cost
+        return lines
@@ -0,0 +1,103 @@
+# core/singleflight.py
+import asyncio
+import threading
+
+from core.metrics import counter
+
+CALLS = counter(
+    "sqlagent_singleflight_calls_total",
+    "Calls through a single-flight group: leader = made the upstream call, follower = shared a leader's result.",
+    ("group", "role"),
+)
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one: the first caller
+    (leader) runs the function, callers arriving while it is in flight
+    (followers) wait for and share its result or exception. Nothing is kept
+    once the call finishes; caching is left to the caller.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._sync = {}      # key -> _Call
+        self._async = {}     # key -> asyncio.Task
+        self.leaders = 0
+        self.followers = 0
+
+    def _count(self, leader):
+        with self._lock:
+            if leader:
+                self.leaders += 1
+            else:
+                self.followers += 1
+        CALLS.inc(group=self.name, role="leader" if leader else "follower")
+
+    def do(self, key, fn):
+        """Runs fn() once per key among concurrent threads; returns its result."""
+        with self._lock:
+            call = self._sync.get(key)
+            leader = call is None
+            if leader:
+                call = self._sync[key] = _Call()
+        self._count(leader)
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._sync.pop(key, None)
+            call.done.set()
+        return call.result
+
+    async def do_async(self, key, coro_fn):
+        """
+        Awaits coro_fn() once per key among concurrent tasks on this event loop.
+        The shared call runs as its own task, so a cancelled waiter (leader
+        included) does not cancel it for the others.
+        """
+        loop = asyncio.get_running_loop()
+        task = self._async.get(key)
+        if task is not None and (task.done() or task.get_loop() is not loop):
+            task = None
+        leader = task is None
+        if leader:
+            task = loop.create_task(coro_fn())
+            self._async[key] = task
+            task.add_done_callback(lambda t, k=key: self._finished(k, t))
+        self._count(leader)
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self._async.get(key) is task:
+            self._async.pop(key, None)
+        # mark the exception retrieved even if every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        calls = self.leaders + self.followers
+        return {
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "collapsed_rate": round(self.followers / calls, 4) if calls else 0.0,
+            "in_flight": len(self._sync) + len(self._async),
+        }
@@ -1,38 +1,92 @@
 # core/validator.py
-import sqlparse
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+load_dotenv()
+
+from core.fingerprint import tokenize
+from core.metrics import timed
 
 ALLOWED_STATEMENTS = {"select", "with", "explain"}
+# Keywords that modify data or schema anywhere in the statement (e.g. a
+# data-modifying CTE or EXPLAIN ANALYZE DELETE), matched as whole words only.
+BLACKLIST = ("insert", "update", "delete", "drop", "alter", "create", "truncate")
+_BLACKLIST = frozenset(BLACKLIST)
+
+VALIDATOR_CACHE_SIZE = int(os.getenv("VALIDATOR_CACHE_SIZE", "4096"))
+
+# LRU of verdicts keyed on a SHA-1 digest of the SQL text, so large generated
+# statements are not kept in memory just to remember that they were safe
+_verdicts = OrderedDict()
+_verdicts_lock = threading.Lock()
+_cache_hits = 0
+_cache_misses = 0
+
+def _check(sql_text):
+    global _cache_hits, _cache_misses
+    key = hashlib.sha1(sql_text.encode("utf-8", "surrogatepass")).digest()
+    with _verdicts_lock:
+        verdict = _verdicts.get(key)
+        if verdict is not None:
+            _verdicts.move_to_end(key)
+            _cache_hits += 1
+            return verdict
+        _cache_misses += 1
+    verdict = _scan(sql_text)
+    with _verdicts_lock:
+        _verdicts[key] = verdict
+        while len(_verdicts) > VALIDATOR_CACHE_SIZE:
+            _verdicts.popitem(last=False)
+    return verdict
+
+def _scan(sql_text):
+    first_word = None
+    semicolon = False
+    for kind, text in tokenize(sql_text):
+        if kind in ("ws", "comment"):
+            continue
+        if semicolon:
+            # only trailing semicolons are allowed
+            if text != ";":
+                return False, "Semicolons not allowed (possible multiple statements)."
+            continue
+        if kind == "punct" and text == ";":
+            semicolon = True
+            continue
+        if first_word is None:
+            first_word = text.lower()
+            if kind != "word" or first_word not in ALLOWED_STATEMENTS:
+                return False, f"Only SELECT/EXPLAIN allowed. Found: {first_word}"
+            continue
+        # string literals, quoted identifiers and longer words such as
+        # last_update are separate tokens, so they never match here
+        if kind == "word" and text.lower() in _BLACKLIST:
+            return False, f"Disallowed keyword detected: {text.lower()}"
+    if first_word is None:
+        return False, "SQL parse error (empty)."
+    return True, "safe"
 
+@timed("validate")
 def is_safe_sql(sql_text: str):
     """
     Basic rule-based validator to prevent dangerous SQL.
     - Only SELECT / WITH / EXPLAIN allowed.
     - No INSERT, UPDATE, DELETE, DROP, ALTER, CREATE, etc.
     - No semicolon chaining.
+    Single pass over core.fingerprint tokens; verdicts are cached per SQL text digest.
     """
     if not sql_text or not isinstance(sql_text, str):
         return False, "SQL is empty or invalid."
+    return _check(sql_text)
 
-    # Parse
-    parsed = sqlparse.parse(sql_text)
-    if not parsed:
-        return False, "SQL parse error (empty)."
-
-    # Check first keyword
-    first = parsed[0].tokens[0].value.strip().lower()
-    first_word = first.split()[0]
-    if first_word not in ALLOWED_STATEMENTS:
-        return False, f"Only SELECT/EXPLAIN allowed. Found: {first_word}"
-
-    # Block semicolons (multiple statements)
-    if ";" in sql_text.strip().rstrip(";"):
-        return False, "Semicolons not allowed (possible multiple statements)."
-
-    # Block dangerous keywords
-    blacklist = ["insert ", "update ", "delete ", "drop ", "alter ", "create ", "truncate "]
-    low = sql_text.lower()
-    for b in blacklist:
-        if b in low:
-            return False, f"Disallowed keyword detected: {b.strip()}"
-
-    return True, "safe"
+def validator_cache_stats():
+    lookups = _cache_hits + _cache_misses
+    return {
+        "entries": len(_verdicts),
+        "maxsize": VALIDATOR_CACHE_SIZE,
+        "hits": _cache_hits,
+        "misses": _cache_misses,
+        "hit_rate": round(_cache_hits / lookups, 4) if lookups else 0.0,
+    }
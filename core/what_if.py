@@ -0,0 +1,134 @@
+# core/what_if.py
+import os
+import time
+import statistics
+from contextlib import asynccontextmanager, contextmanager
+import psycopg2
+from dotenv import load_dotenv
+load_dotenv()
+
+from core.limits import db_slot
+import core.admission as admission
+from core.plan_model import parse_plan
+
+# CREATE INDEX takes a SHARE lock; give up quickly instead of queueing behind writers
+ADVISOR_LOCK_TIMEOUT_MS = int(os.getenv("ADVISOR_LOCK_TIMEOUT_MS", "2000"))
+ADVISOR_STATEMENT_TIMEOUT_MS = int(os.getenv("ADVISOR_STATEMENT_TIMEOUT_MS", "120000"))
+# The lock is held until the rollback, so the timed runs after building a
+# what-if index (warm-up included) share this budget and stop once it is spent
+ADVISOR_TIMED_BUDGET_MS = int(os.getenv("ADVISOR_TIMED_BUDGET_MS", "10000"))
+
+PRIMARY_NOTE = ("No benchmark node is available, so what-if indexes are built on the primary: "
+                "only estimated costs are reported, to keep the table lock short.")
+
+
+def can_measure(node):
+    """
+    Timed runs hold the what-if index's SHARE lock on its table, which blocks
+    writers; they only run on a node other than the primary.
+    """
+    return node.role != "primary"
+
+
+def _time_ms(plan):
+    try:
+        return parse_plan(plan).total_ms
+    except Exception:
+        return None
+
+
+@asynccontextmanager
+async def transaction_async(sql_text, executor_module):
+    """
+    async with transaction_async(sql, executor) as conn: a sandbox connection
+    inside a transaction that is always rolled back, admitted in sql's cost
+    class, with a short lock_timeout for CREATE INDEX.
+    """
+    async with admission.admitted(sql_text, executor_module.explain_query_async):
+        async with db_slot():
+            async with executor_module.async_connection(ADVISOR_STATEMENT_TIMEOUT_MS, "sandbox") as conn:
+                (await conn.execute("BEGIN")).close()
+                try:
+                    (await conn.execute(f"SET LOCAL lock_timeout = {int(ADVISOR_LOCK_TIMEOUT_MS)}")).close()
+                    yield conn
+                finally:
+                    (await conn.execute("ROLLBACK")).close()
+
+
+@contextmanager
+def transaction(sql_text, executor_module):
+    """Sync transaction_async(); yields a cursor."""
+    with admission.admitted_blocking(sql_text, lambda s: executor_module.explain_query(s, "sandbox")):
+        with executor_module.connection(ADVISOR_STATEMENT_TIMEOUT_MS, "sandbox") as conn:
+            conn.autocommit = False
+            cur = conn.cursor()
+            try:
+                cur.execute(f"SET LOCAL lock_timeout = {int(ADVISOR_LOCK_TIMEOUT_MS)}")
+                yield cur
+            finally:
+                conn.rollback()
+                cur.close()
+
+
+async def measure_async(conn, sql_text, warmup, runs, budget_ms=None):
+    """
+    EXPLAIN ANALYZE on conn: `warmup` discarded runs, then the median time of
+    `runs` more. Returns (median_ms, plan of the last run); (None, None) when
+    no run finished. With budget_ms the runs share that much time: each one
+    runs under a savepoint with the rest as its statement_timeout, and a run
+    that overruns ends the measuring without aborting the transaction.
+    """
+    deadline = time.monotonic() + budget_ms / 1000.0 if budget_ms is not None else None
+    times, plan = [], None
+    for i in range(warmup + max(1, runs)):
+        explain = f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql_text}"
+        if deadline is None:
+            plan = (await conn.fetchone(explain))[0]
+        else:
+            left_ms = int((deadline - time.monotonic()) * 1000.0)
+            if left_ms <= 0:
+                break
+            (await conn.execute("SAVEPOINT what_if_run")).close()
+            (await conn.execute(f"SET LOCAL statement_timeout = {left_ms}")).close()
+            try:
+                plan = (await conn.fetchone(explain))[0]
+            except psycopg2.errors.QueryCanceled:
+                (await conn.execute("ROLLBACK TO SAVEPOINT what_if_run")).close()
+                break
+            (await conn.execute("RELEASE SAVEPOINT what_if_run")).close()
+        t = _time_ms(plan)
+        if i >= warmup and t is not None:
+            times.append(t)
+    if deadline is not None:
+        (await conn.execute(f"SET LOCAL statement_timeout = {int(ADVISOR_STATEMENT_TIMEOUT_MS)}")).close()
+    return (round(statistics.median(times), 3) if times else None), (plan if times else None)
+
+
+def measure(cur, sql_text, warmup, runs, budget_ms=None):
+    """Sync measure_async() on a cursor."""
+    deadline = time.monotonic() + budget_ms / 1000.0 if budget_ms is not None else None
+    times, plan = [], None
+    for i in range(warmup + max(1, runs)):
+        explain = f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql_text}"
+        if deadline is None:
+            cur.execute(explain)
+            plan = cur.fetchone()[0]
+        else:
+            left_ms = int((deadline - time.monotonic()) * 1000.0)
+            if left_ms <= 0:
+                break
+            cur.execute("SAVEPOINT what_if_run")
+            cur.execute(f"SET LOCAL statement_timeout = {left_ms}")
+            try:
+                cur.execute(explain)
+                plan = cur.fetchone()[0]
+            except psycopg2.errors.QueryCanceled:
+                cur.execute("ROLLBACK TO SAVEPOINT what_if_run")
+                break
+            cur.execute("RELEASE SAVEPOINT what_if_run")
+        t = _time_ms(plan)
+        if i >= warmup and t is not None:
+            times.append(t)
+    if deadline is not None:
+        cur.execute(f"SET LOCAL statement_timeout = {int(ADVISOR_STATEMENT_TIMEOUT_MS)}")
+    return (round(statistics.median(times), 3) if times else None), (plan if times else None)
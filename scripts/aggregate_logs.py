@@ -1,13 +1,495 @@
 # scripts/aggregate_logs.py
-import csv
+"""
+Streaming report over agent logs: per-endpoint throughput and latency
+percentiles, per-stage latency, slowest SQL shapes, rewrite/index win rates
+and time-bucketed trends.
+
+Reads JSON-lines logs (core.logwriter) as well as the older pipe-delimited
+agent_logs.csv, plain or compressed (.gz, .bz2, .xz). Files are processed in
+parallel, one worker per file, in constant memory: latencies go into
+mergeable DDSketch-style quantile sketches and the SQL shape table is capped.
+
+    python -m scripts.aggregate_logs [paths ...] [--bucket 1h] [--top 10] [--workers N] [--json]
+
+Without paths, agent_logs.jsonl and its rotated/compressed siblings are read.
+"""
+import os
+import io
+import sys
+import bz2
+import glob
+import gzip
+import json
+import lzma
+import math
+import time
+import argparse
+import multiprocessing
+from functools import lru_cache
 from collections import defaultdict
-rows = defaultdict(list)
-with open("agent_logs.csv","r",encoding="utf-8") as f:
-    for ln in f:
-        parts = ln.strip().split("|")
-        if len(parts) < 4: continue
-        ts, action, q, flag = parts[:4]
-        rows[action].append((ts,q,flag))
-# simple print
-for k,v in rows.items():
-    print(k, len(v))
+
+from core.fingerprint import normalize_sql
+
+
+@lru_cache(maxsize=8192)
+def sql_shape(sql):
+    # logs repeat the same statements a lot; tokenizing is the expensive part
+    return normalize_sql(sql, strip_literals=True)
+
+
+class QuantileSketch:
+    """
+    Log-bucketed quantile sketch (DDSketch): every estimate is within
+    `relative_accuracy` of the true value, memory is bounded by max_bins, and
+    two sketches merge by adding bucket counts.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.alpha = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        value = float(value)
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if value <= 1e-9:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[key] = self.bins.get(key, 0) + 1
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self):
+        # fold the lowest buckets together; only the smallest quantiles lose accuracy
+        keys = sorted(self.bins)
+        extra = len(keys) - self.max_bins
+        folded = sum(self.bins.pop(k) for k in keys[:extra + 1])
+        self.bins[keys[extra]] = self.bins.get(keys[extra], 0) + folded
+
+    def merge(self, other):
+        for k, c in other.bins.items():
+            self.bins[k] = self.bins.get(k, 0) + c
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for k in sorted(self.bins):
+            seen += self.bins[k]
+            if seen > rank:
+                return min(self.max, max(self.min, 2 * self.gamma ** k / (self.gamma + 1)))
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return {"n": 0}
+        return {
+            "n": self.count,
+            "mean_ms": round(self.total / self.count, 3),
+            "p50_ms": round(self.quantile(0.50), 3),
+            "p95_ms": round(self.quantile(0.95), 3),
+            "p99_ms": round(self.quantile(0.99), 3),
+            "max_ms": round(self.max, 3),
+        }
+
+
+class _Endpoint:
+    __slots__ = ("count", "errors", "first_ts", "last_ts", "latency", "cache_hits", "cache_lookups", "rows")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.first_ts = None
+        self.last_ts = None
+        self.latency = QuantileSketch()
+        self.cache_hits = 0
+        self.cache_lookups = 0
+        self.rows = 0
+
+    def merge(self, o):
+        self.count += o.count
+        self.errors += o.errors
+        for ts in (o.first_ts, o.last_ts):
+            if ts is not None:
+                self.first_ts = ts if self.first_ts is None else min(self.first_ts, ts)
+                self.last_ts = ts if self.last_ts is None else max(self.last_ts, ts)
+        self.latency.merge(o.latency)
+        self.cache_hits += o.cache_hits
+        self.cache_lookups += o.cache_lookups
+        self.rows += o.rows
+
+
+class LogStats:
+    """Everything the report needs, accumulated line by line; merge() combines workers."""
+
+    # distinct SQL shapes tracked; beyond this the cheapest ones are dropped
+    MAX_SHAPES = 5000
+
+    def __init__(self, bucket_s=3600):
+        self.bucket_s = bucket_s
+        self.lines = 0
+        self.bad_lines = 0
+        self.endpoints = defaultdict(_Endpoint)
+        self.stages = defaultdict(QuantileSketch)
+        self.shapes = {}   # normalized sql -> [count, total_ms, max_ms]
+        self.rewrite = {"requests": 0, "with_faster": 0, "candidates": 0, "faster": 0}
+        self.optimize = {"requests": 0, "measured": 0, "improved": 0, "speedups": QuantileSketch()}
+        self.buckets = defaultdict(lambda: {"count": 0, "errors": 0, "latency": QuantileSketch()})
+
+    # --- input ---
+
+    def add_line(self, line):
+        line = line.strip()
+        if not line:
+            return
+        self.lines += 1
+        if line.startswith("{"):
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                self.bad_lines += 1
+                return
+        else:
+            rec = _legacy_record(line)
+            if rec is None:
+                self.bad_lines += 1
+                return
+        self.add_record(rec)
+
+    def add_record(self, rec):
+        endpoint = rec.get("endpoint")
+        if rec.get("event") == "stream_done":
+            # the request line already counted this call; keep the full stream time per stage
+            if rec.get("duration_ms") is not None:
+                self.stages["stream"].add(rec["duration_ms"])
+            return
+        if not endpoint:
+            return
+        ts = rec.get("ts")
+        ms = rec.get("duration_ms")
+        failed = rec.get("ok") is False or (rec.get("status") or 200) >= 500
+
+        e = self.endpoints[endpoint]
+        e.count += 1
+        e.errors += failed
+        if ts is not None:
+            e.first_ts = ts if e.first_ts is None else min(e.first_ts, ts)
+            e.last_ts = ts if e.last_ts is None else max(e.last_ts, ts)
+        if ms is not None:
+            e.latency.add(ms)
+        if rec.get("cache") in ("hit", "miss"):
+            e.cache_lookups += 1
+            e.cache_hits += rec["cache"] == "hit"
+        e.rows += rec.get("rows") or 0
+
+        for name, stage_ms in (rec.get("stages") or {}).items():
+            self.stages[name].add(stage_ms)
+
+        if ts is not None:
+            b = self.buckets[int(ts // self.bucket_s) * self.bucket_s]
+            b["count"] += 1
+            b["errors"] += failed
+            if ms is not None:
+                b["latency"].add(ms)
+
+        # time spent actually running the statement
+        sql_ms = None
+        if endpoint == "/execute":
+            sql_ms = (rec.get("stages") or {}).get("query")
+        elif endpoint == "/optimize":
+            sql_ms = rec.get("original_ms")
+        if rec.get("sql") and sql_ms is not None and not failed:
+            self._add_shape(rec["sql"], sql_ms)
+
+        if endpoint == "/rewrite_and_test" and not failed:
+            self.rewrite["requests"] += 1
+            self.rewrite["candidates"] += rec.get("candidates") or 0
+            self.rewrite["faster"] += rec.get("faster") or 0
+            self.rewrite["with_faster"] += bool(rec.get("faster"))
+        if endpoint == "/optimize" and not failed:
+            self.optimize["requests"] += 1
+            orig, idx = rec.get("original_ms"), rec.get("with_index_ms")
+            if orig and idx:
+                self.optimize["measured"] += 1
+                self.optimize["improved"] += idx < orig
+                self.optimize["speedups"].add(orig / idx)
+
+    def _add_shape(self, sql, ms):
+        try:
+            shape = sql_shape(sql)
+        except Exception:
+            return
+        s = self.shapes.get(shape)
+        if s is None:
+            if len(self.shapes) >= self.MAX_SHAPES:
+                self._prune_shapes()
+            s = self.shapes[shape] = [0, 0.0, 0.0]
+        s[0] += 1
+        s[1] += ms
+        s[2] = max(s[2], ms)
+
+    def _prune_shapes(self):
+        # keep the most expensive half (by total time)
+        keep = sorted(self.shapes.items(), key=lambda kv: -kv[1][1])[: self.MAX_SHAPES // 2]
+        self.shapes = dict(keep)
+
+    def merge(self, other):
+        self.lines += other.lines
+        self.bad_lines += other.bad_lines
+        for k, e in other.endpoints.items():
+            self.endpoints[k].merge(e)
+        for k, s in other.stages.items():
+            self.stages[k].merge(s)
+        for shape, (n, total, mx) in other.shapes.items():
+            s = self.shapes.get(shape)
+            if s is None:
+                self.shapes[shape] = [n, total, mx]
+            else:
+                s[0] += n
+                s[1] += total
+                s[2] = max(s[2], mx)
+        if len(self.shapes) > self.MAX_SHAPES:
+            self._prune_shapes()
+        for k in self.rewrite:
+            self.rewrite[k] += other.rewrite[k]
+        for k in ("requests", "measured", "improved"):
+            self.optimize[k] += other.optimize[k]
+        self.optimize["speedups"].merge(other.optimize["speedups"])
+        for k, b in other.buckets.items():
+            mine = self.buckets[k]
+            mine["count"] += b["count"]
+            mine["errors"] += b["errors"]
+            mine["latency"].merge(b["latency"])
+        return self
+
+    def __getstate__(self):
+        # defaultdict(lambda) does not pickle; send plain dicts between processes
+        state = dict(self.__dict__)
+        state["endpoints"] = dict(self.endpoints)
+        state["stages"] = dict(self.stages)
+        state["buckets"] = dict(self.buckets)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.endpoints = defaultdict(_Endpoint, state["endpoints"])
+        self.stages = defaultdict(QuantileSketch, state["stages"])
+        buckets = defaultdict(lambda: {"count": 0, "errors": 0, "latency": QuantileSketch()})
+        buckets.update(state["buckets"])
+        self.buckets = buckets
+
+    # --- output ---
+
+    def report(self, top=10):
+        endpoints = {}
+        for name, e in sorted(self.endpoints.items()):
+            span = (e.last_ts - e.first_ts) if e.first_ts is not None else 0
+            endpoints[name] = {
+                "requests": e.count,
+                "errors": e.errors,
+                "req_per_min": round(e.count / (span / 60.0), 3) if span > 0 else None,
+                "cache_hit_rate": round(e.cache_hits / e.cache_lookups, 4) if e.cache_lookups else None,
+                "rows": e.rows,
+                "latency": e.latency.summary(),
+            }
+        shapes = sorted(self.shapes.items(), key=lambda kv: -kv[1][1])[:top]
+        rw = self.rewrite
+        op = self.optimize
+        return {
+            "lines": self.lines,
+            "bad_lines": self.bad_lines,
+            "endpoints": endpoints,
+            "stages": {k: s.summary() for k, s in sorted(self.stages.items())},
+            "slowest_sql": [
+                {"sql": shape, "count": n, "total_ms": round(total, 3),
+                 "mean_ms": round(total / n, 3), "max_ms": round(mx, 3)}
+                for shape, (n, total, mx) in shapes
+            ],
+            "rewrites": {
+                "requests": rw["requests"],
+                "request_win_rate": round(rw["with_faster"] / rw["requests"], 4) if rw["requests"] else None,
+                "candidates": rw["candidates"],
+                "candidate_win_rate": round(rw["faster"] / rw["candidates"], 4) if rw["candidates"] else None,
+            },
+            "optimize": {
+                "requests": op["requests"],
+                "measured": op["measured"],
+                "win_rate": round(op["improved"] / op["measured"], 4) if op["measured"] else None,
+                "median_speedup": round(op["speedups"].quantile(0.5), 3) if op["measured"] else None,
+            },
+            "buckets": [
+                {"start": k, "requests": b["count"], "errors": b["errors"],
+                 "p50_ms": _round(b["latency"].quantile(0.5)), "p95_ms": _round(b["latency"].quantile(0.95))}
+                for k, b in sorted(self.buckets.items())
+            ],
+        }
+
+
+def _round(v):
+    return round(v, 3) if v is not None else None
+
+
+_LEGACY_ENDPOINTS = {
+    "nl2sql": "/nl2sql", "execute": "/execute", "execute_stream": "/execute/stream",
+    "optimize": "/optimize", "rewrite": "/rewrite_and_test",
+}
+
+
+def _legacy_record(line):
+    """ts|action|sql or question|key:value|... lines written before JSON logging."""
+    parts = line.split("|")
+    if len(parts) < 4:
+        return None
+    try:
+        ts = float(parts[0])
+    except ValueError:
+        return None
+    endpoint = _LEGACY_ENDPOINTS.get(parts[1])
+    if endpoint is None:
+        return None
+    rec = {"ts": ts, "endpoint": endpoint, "sql": parts[2]}
+    for kv in parts[3:]:
+        k, _, v = kv.partition(":")
+        if k == "rows":
+            rec["rows"] = _num(v)
+        elif k == "cached":
+            rec["cache"] = "hit" if v == "True" else "miss"
+        elif k == "orig":
+            rec["original_ms"] = _num(v)
+        elif k == "with_idx":
+            rec["with_index_ms"] = _num(v)
+        elif k == "cands":
+            rec["candidates"] = _num(v)
+    return rec
+
+
+def _num(v):
+    try:
+        return float(v) if "." in v else int(v)
+    except ValueError:
+        return None
+
+
+def open_log(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rt", encoding="utf-8", errors="replace")
+    if path.endswith((".xz", ".lzma")):
+        return lzma.open(path, "rt", encoding="utf-8", errors="replace")
+    return io.open(path, "r", encoding="utf-8", errors="replace")
+
+
+def process_file(args):
+    path, bucket_s = args
+    stats = LogStats(bucket_s)
+    with open_log(path) as f:
+        for line in f:
+            stats.add_line(line)
+    return stats
+
+
+def default_paths():
+    base = os.getenv("AGENT_LOG_PATH", "agent_logs.jsonl")
+    paths = [p for p in glob.glob(base + "*") if not p.endswith(".tmp")]
+    if os.path.exists("agent_logs.csv"):
+        paths.append("agent_logs.csv")
+    return sorted(paths)
+
+
+def parse_duration(text):
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    text = text.strip().lower()
+    if text[-1:] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def analyze(paths, bucket_s=3600, workers=None):
+    jobs = [(p, bucket_s) for p in paths]
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+    total = LogStats(bucket_s)
+    if workers == 1:
+        for job in jobs:
+            total.merge(process_file(job))
+        return total
+    with multiprocessing.Pool(workers) as pool:
+        for stats in pool.imap_unordered(process_file, jobs):
+            total.merge(stats)
+    return total
+
+
+def print_report(r):
+    print(f"lines: {r['lines']} (unparsable: {r['bad_lines']})\n")
+    print(f"{'endpoint':<20} {'reqs':>7} {'err':>5} {'req/min':>8} {'hit%':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for name, e in r["endpoints"].items():
+        lat = e["latency"]
+        hit = f"{e['cache_hit_rate'] * 100:.0f}" if e["cache_hit_rate"] is not None else "-"
+        print(f"{name:<20} {e['requests']:>7} {e['errors']:>5} {e['req_per_min'] or '-':>8} {hit:>6} "
+              f"{lat.get('p50_ms', '-'):>9} {lat.get('p95_ms', '-'):>9} {lat.get('p99_ms', '-'):>9}")
+    if r["stages"]:
+        print(f"\n{'stage':<20} {'n':>7} {'p50':>9} {'p95':>9} {'p99':>9}")
+        for name, s in r["stages"].items():
+            print(f"{name:<20} {s['n']:>7} {s['p50_ms']:>9} {s['p95_ms']:>9} {s['p99_ms']:>9}")
+    if r["slowest_sql"]:
+        print("\nslowest SQL shapes (by total time):")
+        for s in r["slowest_sql"]:
+            print(f"  {s['total_ms']:>10.1f} ms total  {s['count']:>5}x  mean {s['mean_ms']:.1f}  max {s['max_ms']:.1f}  {s['sql'][:100]}")
+    rw, op = r["rewrites"], r["optimize"]
+    print(f"\nrewrites: {rw['requests']} requests, win rate {rw['request_win_rate']}, "
+          f"{rw['candidates']} candidates, candidate win rate {rw['candidate_win_rate']}")
+    print(f"optimize: {op['requests']} requests, {op['measured']} measured, win rate {op['win_rate']}, "
+          f"median speedup {op['median_speedup']}")
+    if r["buckets"]:
+        print(f"\n{'bucket start (UTC)':<20} {'reqs':>7} {'err':>5} {'p50':>9} {'p95':>9}")
+        for b in r["buckets"]:
+            start = time.strftime("%Y-%m-%d %H:%M", time.gmtime(b["start"]))
+            print(f"{start:<20} {b['requests']:>7} {b['errors']:>5} {b['p50_ms'] or '-':>9} {b['p95_ms'] or '-':>9}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("paths", nargs="*", help="log files (default: agent_logs.jsonl* and agent_logs.csv)")
+    ap.add_argument("--bucket", default="1h", help="trend bucket width, e.g. 5m, 1h, 1d (default 1h)")
+    ap.add_argument("--top", type=int, default=10, help="number of SQL shapes to list")
+    ap.add_argument("--workers", type=int, default=None, help="parallel file workers (default: CPU count)")
+    ap.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = ap.parse_args(argv)
+
+    paths = args.paths or default_paths()
+    if not paths:
+        print("no log files found", file=sys.stderr)
+        return 1
+    report = analyze(paths, parse_duration(args.bucket), args.workers).report(top=args.top)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+# scripts/bench_result_encoding.py
+"""
+Bytes on the wire and encode/decode time of /execute result formats:
+today's row JSON (as FastAPI serialises it, decoded into per-row dicts like
+the Streamlit UI does), columnar JSON and Arrow IPC.
+
+    python -m scripts.bench_result_encoding [rows ...]
+"""
+import sys
+import json
+import time
+import datetime
+import decimal
+from collections import namedtuple
+
+from fastapi.encoders import jsonable_encoder
+
+import core.columnar as columnar
+
+Desc = namedtuple("Desc", "name type_code precision scale")
+DESCRIPTION = [
+    Desc("payment_id", 23, None, None),
+    Desc("customer_id", 23, None, None),
+    Desc("amount", 1700, 5, 2),
+    Desc("payment_date", 1114, None, None),
+    Desc("first_name", 25, None, None),
+    Desc("active", 16, None, None),
+]
+
+
+def make_rows(n):
+    start = datetime.datetime(2005, 5, 24, 22, 53, 30)
+    return [
+        (i, 1 + i % 599, decimal.Decimal(i % 11) + decimal.Decimal("0.99"),
+         start + datetime.timedelta(minutes=17 * i), f"name{i % 599}", i % 7 != 0)
+        for i in range(n)
+    ]
+
+
+def best_of(fn, repeat=5):
+    best = None
+    out = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        dt = (time.perf_counter() - t0) * 1000.0
+        best = dt if best is None else min(best, dt)
+    return best, out
+
+
+def bench(n):
+    cols = [d.name for d in DESCRIPTION]
+    types = columnar.column_types(DESCRIPTION)
+    rows = make_rows(n)
+
+    def row_json():
+        body = jsonable_encoder({"ok": True, "result": {"columns": cols, "rows": rows}})
+        return json.dumps(body, separators=(",", ":")).encode("utf-8")
+
+    def row_json_decode(b):
+        res = json.loads(b)["result"]
+        return [dict(zip(res["columns"], row)) for row in res["rows"]]
+
+    def col_json():
+        return columnar.encode_columnar_json(cols, types, columnar.batched(rows, 500))
+
+    def col_json_decode(b):
+        doc = json.loads(b)
+        return dict(zip(doc["columns"], doc["data"]))
+
+    results = []
+    enc_ms, body = best_of(row_json)
+    dec_ms, _ = best_of(lambda: row_json_decode(body))
+    results.append(("row JSON (today)", len(body), enc_ms, dec_ms))
+
+    enc_ms, body = best_of(col_json)
+    dec_ms, _ = best_of(lambda: col_json_decode(body))
+    results.append(("columnar JSON", len(body), enc_ms, dec_ms))
+
+    if columnar._has_pyarrow:
+        import pyarrow as pa
+        enc_ms, body = best_of(lambda: columnar.encode_arrow(cols, types, columnar.batched(rows, 500)))
+        dec_ms, _ = best_of(lambda: pa.ipc.open_stream(body).read_all())
+        results.append(("Arrow IPC", len(body), enc_ms, dec_ms))
+
+    print(f"\n{n} rows")
+    print(f"{'format':<18}{'bytes':>12}{'encode ms':>12}{'decode ms':>12}")
+    for name, size, enc_ms, dec_ms in results:
+        print(f"{name:<18}{size:>12}{enc_ms:>12.2f}{dec_ms:>12.2f}")
+
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 5000, 50000]
+    for n in sizes:
+        bench(n)
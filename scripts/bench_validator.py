@@ -0,0 +1,112 @@
+# scripts/bench_validator.py
+"""
+Time per is_safe_sql() call: the previous sqlparse + substring implementation
+against the token-level validator, uncached (first sight of a query) and
+cached (the same query validated again, as /rewrite_and_test does).
+Also lists queries on which the two disagree.
+
+    python -m scripts.bench_validator [repeats]
+"""
+import sys
+import time
+
+import sqlparse
+
+import core.validator as validator
+
+
+def legacy_is_safe_sql(sql_text):
+    # the implementation core.validator replaced, kept verbatim for comparison
+    if not sql_text or not isinstance(sql_text, str):
+        return False, "SQL is empty or invalid."
+    parsed = sqlparse.parse(sql_text)
+    if not parsed:
+        return False, "SQL parse error (empty)."
+    first = parsed[0].tokens[0].value.strip().lower()
+    first_word = first.split()[0]
+    if first_word not in validator.ALLOWED_STATEMENTS:
+        return False, f"Only SELECT/EXPLAIN allowed. Found: {first_word}"
+    if ";" in sql_text.strip().rstrip(";"):
+        return False, "Semicolons not allowed (possible multiple statements)."
+    blacklist = ["insert ", "update ", "delete ", "drop ", "alter ", "create ", "truncate "]
+    low = sql_text.lower()
+    for b in blacklist:
+        if b in low:
+            return False, f"Disallowed keyword detected: {b.strip()}"
+    return True, "safe"
+
+
+SHORT = "SELECT customer_id, first_name, email FROM customer WHERE active = 1 ORDER BY last_name LIMIT 10;"
+
+
+def long_query(n_ctes):
+    ctes = ",\n".join(
+        f"c{i} AS (\n  SELECT p.customer_id, date_trunc('month', p.payment_date) AS m, SUM(p.amount) AS s{i}\n"
+        f"  FROM payment p JOIN rental r ON r.rental_id = p.rental_id\n"
+        f"  WHERE p.amount > {i} AND r.return_date IS NOT NULL -- bucket {i}\n"
+        f"  GROUP BY 1, 2\n)"
+        for i in range(n_ctes)
+    )
+    joins = "\n".join(f"LEFT JOIN c{i} USING (customer_id, m)" for i in range(1, n_ctes))
+    return f"WITH {ctes}\nSELECT * FROM c0\n{joins}\nORDER BY customer_id, m;"
+
+
+CASES = {
+    "short": SHORT,
+    "2 KB": long_query(8),
+    "8 KB": long_query(32),
+    "32 KB": long_query(128),
+}
+
+# differences in verdict are expected here; printed for review
+EDGE_CASES = [
+    "SELECT last_update FROM film",
+    "SELECT * FROM t WHERE note = 'drop table x; --'",
+    "WITH d AS (DELETE FROM t RETURNING *) SELECT * FROM d",
+    "EXPLAIN ANALYZE DELETE FROM t",
+    "SELECT 1; DROP TABLE t",
+    "/* header */ SELECT 1",
+    "SELECT * FROM t FOR UPDATE",
+    'SELECT "update" FROM t',
+]
+
+
+def per_call_us(fn, sql, repeats):
+    t0 = time.perf_counter()
+    try:
+        for _ in range(repeats):
+            fn(sql)
+    except Exception:
+        return None
+    return (time.perf_counter() - t0) / repeats * 1e6
+
+
+def uncached(sql):
+    validator._verdicts.clear()
+    return validator.is_safe_sql(sql)
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f"{'query':<8} {'bytes':>7} {'legacy us':>11} {'token us':>10} {'cached us':>10} {'speedup':>8}")
+    for name, sql in CASES.items():
+        legacy = per_call_us(legacy_is_safe_sql, sql, max(1, repeats // 10))
+        token = per_call_us(uncached, sql, repeats)
+        validator.is_safe_sql(sql)
+        cached = per_call_us(validator.is_safe_sql, sql, repeats * 10)
+        if legacy is None:
+            # sqlparse gives up on very long statements instead of returning a verdict
+            print(f"{name:<8} {len(sql):>7} {'error':>11} {token:>10.1f} {cached:>10.2f} {'-':>8}")
+            continue
+        print(f"{name:<8} {len(sql):>7} {legacy:>11.1f} {token:>10.1f} {cached:>10.2f} {legacy / token:>7.1f}x")
+        assert legacy_is_safe_sql(sql) == validator.is_safe_sql(sql), name
+
+    print("\nverdict differences:")
+    for sql in EDGE_CASES:
+        old, new = legacy_is_safe_sql(sql), validator.is_safe_sql(sql)
+        if old != new:
+            print(f"  {sql!r}\n    legacy: {old}\n    token:  {new}")
+
+
+if __name__ == "__main__":
+    main()
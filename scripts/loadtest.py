@@ -0,0 +1,392 @@
+# scripts/loadtest.py
+"""
+Replays a workload against the API and reports throughput and latency:
+req/s, error rate and p50/p95/p99 per endpoint, and p50/p95/p99 per stage
+from the Server-Timing header the API adds to every response.
+
+The workload is a JSON-lines file. Each line is either a request
+({"method": "POST", "path": "/nl2sql", "body": {...}}) or an agent log
+record (core.logwriter), which is turned back into the request that produced
+it; log records without enough to rebuild the request are skipped. Without
+--workload a small built-in Pagila workload is used.
+
+Two load models:
+  --concurrency N   closed loop: N clients, each sends its next request when
+                    the previous one finishes.
+  --rate R          open loop: requests start at R/s (Poisson arrivals by
+                    default) however slow the server is; latency is measured
+                    from the scheduled start, so queueing shows up in it.
+
+    python -m scripts.loadtest --url http://127.0.0.1:8000 --concurrency 16 --duration 30
+    python -m scripts.loadtest --workload agent_logs.jsonl --rate 20 --requests 2000 --json > run.json
+    python -m scripts.loadtest --baseline run.json --max-regression 0.2   # exit 1 on p95 regressions
+
+--spawn starts scripts/mock_openai.py and the API locally (against
+DATABASE_URL) for the duration of the run, so no OpenAI key is needed; the
+mock's latency is set with --mock-latency-ms / --mock-token-ms /
+--mock-error-rate. With docker compose, `docker compose --profile bench up`
+runs the same pair against the compose Postgres (API on port 8010).
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from collections import defaultdict
+
+import httpx
+
+DEFAULT_WORKLOAD = [
+    {"method": "POST", "path": "/nl2sql", "body": {"question": "top 10 customers by number of rentals"}},
+    {"method": "POST", "path": "/nl2sql", "body": {"question": "total rental revenue per month"}},
+    {"method": "POST", "path": "/nl2sql/stream", "body": {"question": "top 10 customers by number of rentals"}},
+    {"method": "POST", "path": "/execute", "body": {"sql": "SELECT customer_id, first_name, last_name FROM customer ORDER BY last_name LIMIT 50"}},
+    {"method": "POST", "path": "/execute", "body": {"sql": "SELECT customer_id, count(*) AS rentals FROM rental GROUP BY customer_id ORDER BY rentals DESC LIMIT 10"}},
+    {"method": "POST", "path": "/execute", "body": {"sql": "SELECT date_trunc('month', payment_date) AS month, sum(amount) FROM payment GROUP BY 1 ORDER BY 1"}},
+    {"method": "POST", "path": "/execute/stream", "body": {"sql": "SELECT * FROM rental"}},
+    {"method": "POST", "path": "/optimize", "body": {"sql": "SELECT * FROM rental WHERE customer_id = 42"}},
+    {"method": "GET", "path": "/pool_stats"},
+]
+
+# log record endpoint -> fields that rebuild its request body
+_LOG_BODIES = {
+    "/nl2sql": ("question",),
+    "/nl2sql/stream": ("question",),
+    "/execute": ("sql",),
+    "/execute/stream": ("sql",),
+    "/optimize": ("sql", "index_sql"),
+    "/rewrite_and_test": ("sql",),
+}
+_LOG_GETS = ("/pool_stats", "/cache_stats", "/metrics")
+
+
+def _from_log(rec):
+    if rec.get("event"):
+        return None
+    endpoint = rec.get("endpoint")
+    if endpoint in _LOG_GETS:
+        return {"method": "GET", "path": endpoint}
+    fields = _LOG_BODIES.get(endpoint)
+    if not fields or not rec.get(fields[0]):
+        return None
+    return {"method": "POST", "path": endpoint, "body": {f: rec[f] for f in fields if rec.get(f)}}
+
+
+def load_workload(path):
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if "path" in rec:
+                item = {"method": rec.get("method") or ("POST" if rec.get("body") is not None else "GET"),
+                        "path": rec["path"], "body": rec.get("body")}
+            else:
+                item = _from_log(rec)
+            if item:
+                items.append(item)
+    return items
+
+
+def parse_server_timing(header):
+    """'llm;dur=12.5, validate;dur=0.3' -> {"llm": 12.5, "validate": 0.3}"""
+    out = {}
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        for p in params.split(";"):
+            key, _, value = p.strip().partition("=")
+            if name and key == "dur":
+                try:
+                    out[name] = float(value)
+                except ValueError:
+                    pass
+    return out
+
+
+def percentile(sorted_values, q):
+    # linear interpolation between closest ranks
+    if not sorted_values:
+        return None
+    pos = (len(sorted_values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+def _summary(values):
+    values = sorted(values)
+    return {"count": len(values), **{k: round(percentile(values, q), 3) if values else None
+                                     for k, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))}}
+
+
+async def send(client, item, scheduled=None):
+    """One request; the body is read to the end. Returns a sample dict."""
+    t0 = scheduled if scheduled is not None else time.perf_counter()
+    sample = {"endpoint": item["path"], "status": None, "error": None, "ttfb_ms": None, "stages": {}}
+    try:
+        async with client.stream(item["method"], item["path"], json=item.get("body")) as resp:
+            sample["status"] = resp.status_code
+            sample["stages"] = parse_server_timing(resp.headers.get("server-timing"))
+            async for _ in resp.aiter_raw():
+                if sample["ttfb_ms"] is None:
+                    sample["ttfb_ms"] = (time.perf_counter() - t0) * 1000.0
+    except Exception as e:
+        sample["error"] = f"{type(e).__name__}: {e}"
+    sample["latency_ms"] = (time.perf_counter() - t0) * 1000.0
+    sample["ok"] = sample["error"] is None and sample["status"] is not None and sample["status"] < 400
+    return sample
+
+
+async def run_closed(client, workload, concurrency, stop):
+    samples = []
+    started = 0
+    picker = _picker(workload)
+
+    async def user():
+        nonlocal started
+        while not stop(started):
+            started += 1
+            samples.append(await send(client, next(picker)))
+
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    return samples
+
+
+async def run_open(client, workload, rate, stop, poisson=True):
+    samples = []
+    tasks = set()
+    picker = _picker(workload)
+    started = 0
+    next_at = time.perf_counter()
+
+    async def one(item, at):
+        samples.append(await send(client, item, scheduled=at))
+
+    while not stop(started):
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        t = asyncio.ensure_future(one(next(picker), next_at))
+        tasks.add(t)
+        t.add_done_callback(tasks.discard)
+        started += 1
+        next_at += random.expovariate(rate) if poisson else 1.0 / rate
+    if tasks:
+        await asyncio.gather(*tasks)
+    return samples
+
+
+def _picker(workload):
+    # shuffled passes over the workload, so every item is sent equally often
+    while True:
+        order = list(workload)
+        random.shuffle(order)
+        yield from order
+
+
+def report(samples, elapsed_s, config):
+    by_endpoint = defaultdict(list)
+    for s in samples:
+        by_endpoint[s["endpoint"]].append(s)
+    endpoints = {}
+    for ep, rows in sorted(by_endpoint.items()):
+        errors = [r for r in rows if not r["ok"]]
+        endpoints[ep] = {
+            "requests": len(rows),
+            "errors": len(errors),
+            "req_per_s": round(len(rows) / elapsed_s, 3) if elapsed_s else None,
+            "latency_ms": _summary([r["latency_ms"] for r in rows]),
+            "ttfb_ms": _summary([r["ttfb_ms"] for r in rows if r["ttfb_ms"] is not None]),
+            "sample_error": (errors[0]["error"] or f"HTTP {errors[0]['status']}") if errors else None,
+        }
+    stage_values = defaultdict(list)
+    for s in samples:
+        for name, ms in s["stages"].items():
+            if name != "total":
+                stage_values[name].append(ms)
+    errors = sum(1 for s in samples if not s["ok"])
+    return {
+        "config": config,
+        "requests": len(samples),
+        "errors": errors,
+        "elapsed_s": round(elapsed_s, 3),
+        "req_per_s": round(len(samples) / elapsed_s, 3) if elapsed_s else None,
+        "latency_ms": _summary([s["latency_ms"] for s in samples]),
+        "endpoints": endpoints,
+        "stages": {name: _summary(v) for name, v in sorted(stage_values.items())},
+    }
+
+
+def compare(current, baseline, max_regression):
+    """Endpoints whose p95 latency grew by more than max_regression (a fraction) since baseline."""
+    regressions = []
+    for ep, cur in current["endpoints"].items():
+        base = baseline.get("endpoints", {}).get(ep)
+        if not base:
+            continue
+        b, c = base["latency_ms"]["p95"], cur["latency_ms"]["p95"]
+        if b and c and c > b * (1 + max_regression):
+            regressions.append({"endpoint": ep, "baseline_p95_ms": b, "p95_ms": c,
+                                "change": round(c / b - 1, 3)})
+    return regressions
+
+
+def _fmt(v):
+    return "-" if v is None else f"{v:.1f}"
+
+
+def print_report(r):
+    print(f"{r['requests']} requests in {r['elapsed_s']:.1f}s: {_fmt(r['req_per_s'])} req/s, "
+          f"{r['errors']} errors, p50 {_fmt(r['latency_ms']['p50'])} ms, "
+          f"p95 {_fmt(r['latency_ms']['p95'])} ms, p99 {_fmt(r['latency_ms']['p99'])} ms")
+    print()
+    print(f"{'endpoint':<22}{'reqs':>7}{'errs':>6}{'req/s':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'ttfb p50':>10}")
+    for ep, e in r["endpoints"].items():
+        lat = e["latency_ms"]
+        print(f"{ep:<22}{e['requests']:>7}{e['errors']:>6}{_fmt(e['req_per_s']):>9}"
+              f"{_fmt(lat['p50']):>10}{_fmt(lat['p95']):>10}{_fmt(lat['p99']):>10}{_fmt(e['ttfb_ms']['p50']):>10}")
+    if r["stages"]:
+        print()
+        print(f"{'stage (Server-Timing)':<22}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}")
+        for name, s in r["stages"].items():
+            print(f"{name:<22}{s['count']:>7}{_fmt(s['p50']):>10}{_fmt(s['p95']):>10}{_fmt(s['p99']):>10}")
+    errors = [(ep, e["sample_error"]) for ep, e in r["endpoints"].items() if e["sample_error"]]
+    if errors:
+        print()
+        for ep, err in errors:
+            print(f"first error on {ep}: {err}")
+
+
+def _wait_ready(url, timeout_s=60):
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=2).status_code < 500:
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.25)
+    return False
+
+
+def spawn(args):
+    """Starts the mock LLM and the API as child processes; returns (api_url, processes)."""
+    mock = subprocess.Popen([
+        sys.executable, "-m", "scripts.mock_openai", "--port", str(args.mock_port),
+        "--latency-ms", str(args.mock_latency_ms), "--token-ms", str(args.mock_token_ms),
+        "--error-rate", str(args.mock_error_rate),
+    ])
+    env = dict(os.environ, OPENAI_API_KEY="mock", OPENAI_BASE_URL=f"http://127.0.0.1:{args.mock_port}/v1")
+    api = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(args.api_port), "--log-level", "warning",
+    ], env=env)
+    url = f"http://127.0.0.1:{args.api_port}"
+    procs = [api, mock]
+    if not (_wait_ready(f"http://127.0.0.1:{args.mock_port}/admin/stats") and _wait_ready(url + "/pool_stats")):
+        stop_processes(procs)
+        raise SystemExit("spawned mock LLM / API did not become ready")
+    return url, procs
+
+
+def stop_processes(procs):
+    for p in procs:
+        p.terminate()
+    for p in procs:
+        try:
+            p.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+async def main_async(args, url, workload):
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=args.concurrency or 100)
+    async with httpx.AsyncClient(base_url=url, timeout=args.timeout, limits=limits) as client:
+        if args.warmup:
+            # one pass over the workload, not measured (caches, pools, plan cache)
+            await asyncio.gather(*(send(client, item) for item in workload))
+        deadline = time.perf_counter() + args.duration if args.duration else None
+
+        def stop(n):
+            if args.requests and n >= args.requests:
+                return True
+            return deadline is not None and time.perf_counter() >= deadline
+
+        t0 = time.perf_counter()
+        if args.rate:
+            samples = await run_open(client, workload, args.rate, stop, poisson=args.arrival == "poisson")
+        else:
+            samples = await run_closed(client, workload, args.concurrency, stop)
+        return samples, time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--url", default="http://127.0.0.1:8000")
+    ap.add_argument("--workload", help="JSON-lines requests or agent log records")
+    ap.add_argument("--concurrency", type=int, default=8, help="closed-loop clients")
+    ap.add_argument("--rate", type=float, default=0.0, help="open-loop arrivals per second (overrides --concurrency)")
+    ap.add_argument("--arrival", choices=("poisson", "uniform"), default="poisson")
+    ap.add_argument("--duration", type=float, default=30.0, help="seconds to run (0: until --requests)")
+    ap.add_argument("--requests", type=int, default=0, help="stop after this many requests")
+    ap.add_argument("--warmup", action="store_true", help="send the workload once before measuring")
+    ap.add_argument("--timeout", type=float, default=60.0)
+    ap.add_argument("--seed", type=int, default=None)
+    ap.add_argument("--json", action="store_true", help="print the report as JSON")
+    ap.add_argument("--baseline", help="earlier --json report to compare p95 latencies against")
+    ap.add_argument("--max-regression", type=float, default=0.2, help="allowed p95 growth vs the baseline")
+    ap.add_argument("--spawn", action="store_true", help="start the mock LLM and the API locally")
+    ap.add_argument("--api-port", type=int, default=8010)
+    ap.add_argument("--mock-port", type=int, default=8001)
+    ap.add_argument("--mock-latency-ms", type=float, default=300.0)
+    ap.add_argument("--mock-token-ms", type=float, default=10.0)
+    ap.add_argument("--mock-error-rate", type=float, default=0.0)
+    args = ap.parse_args()
+    if not args.duration and not args.requests:
+        ap.error("give --duration or --requests")
+    random.seed(args.seed)
+
+    workload = load_workload(args.workload) if args.workload else DEFAULT_WORKLOAD
+    if not workload:
+        raise SystemExit(f"no replayable requests in {args.workload}")
+
+    url, procs = spawn(args) if args.spawn else (args.url, [])
+    try:
+        samples, elapsed = asyncio.run(main_async(args, url, workload))
+    finally:
+        stop_processes(procs)
+
+    config = {"url": url, "workload": args.workload or "builtin", "items": len(workload),
+              "mode": f"open {args.rate}/s {args.arrival}" if args.rate else f"closed x{args.concurrency}"}
+    if args.spawn:
+        config["mock_latency_ms"] = args.mock_latency_ms
+    r = report(samples, elapsed, config)
+    regressions = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = r["regressions"] = compare(r, json.load(f), args.max_regression)
+
+    if args.json:
+        print(json.dumps(r, indent=2))
+    else:
+        print_report(r)
+        if regressions is not None:
+            print()
+            if not regressions:
+                print(f"no p95 regressions over {args.max_regression:.0%} against {args.baseline}")
+            for g in regressions:
+                print(f"REGRESSION {g['endpoint']}: p95 {g['baseline_p95_ms']:.1f} -> {g['p95_ms']:.1f} ms "
+                      f"({g['change']:+.0%})")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# scripts/mock_openai.py
+"""
+Minimal OpenAI-compatible /v1/chat/completions server for exercising the LLM
+gateway (keep-alive, rate limits, retries, circuit breaker) without a real key.
+NL->SQL prompts are answered with the rule-based fallback, rewrite prompts
+with the input SQL as its only candidate. "stream": true requests get SSE
+chunks of a few characters each, --token-ms apart.
+
+    python -m scripts.mock_openai --port 8001 --latency-ms 300 --token-ms 20 --error-rate 0.1
+    OPENAI_API_KEY=mock OPENAI_BASE_URL=http://127.0.0.1:8001/v1 uvicorn app.main:app
+
+Error modes: --error-rate answers a fraction of requests with --error-status
+(500 by default; 429 to test rate limiting); --down answers every request that
+way until POST /admin/up (POST /admin/down switches it back).
+"""
+import re
+import json
+import time
+import random
+import asyncio
+import argparse
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+from core.nl2sql import _fallback_rule_based
+
+app = FastAPI(title="mock OpenAI")
+CONFIG = {"latency_ms": 0.0, "jitter_ms": 0.0, "token_ms": 0.0, "error_rate": 0.0, "error_status": 500,
+          "down": False}
+STATS = {"requests": 0, "errors": 0}
+
+
+def _answer(messages):
+    system = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+    user = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+    if "rewrite" in system.lower():
+        m = re.search(r"Input SQL:\n(.*?)\n\nReturn JSON only", user, re.DOTALL)
+        sql = m.group(1).strip() if m else ""
+        return {"candidates": [{"sql": sql, "note": "mock: unchanged"}] if sql else []}
+    m = re.search(r"Question:\n(.*?)\n\nReturn JSON only", user, re.DOTALL)
+    return _fallback_rule_based(m.group(1).strip() if m else user)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    STATS["requests"] += 1
+    delay = CONFIG["latency_ms"] + random.uniform(0, CONFIG["jitter_ms"])
+    if delay:
+        await asyncio.sleep(delay / 1000.0)
+    if CONFIG["down"] or random.random() < CONFIG["error_rate"]:
+        STATS["errors"] += 1
+        return JSONResponse(status_code=CONFIG["error_status"],
+                            content={"error": {"message": "mock failure", "type": "server_error"}})
+    content = json.dumps(_answer(body.get("messages", [])))
+    if body.get("stream"):
+        return StreamingResponse(_stream(content, body.get("model", "mock")), media_type="text/event-stream")
+    return {
+        "id": f"chatcmpl-mock-{STATS['requests']}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+async def _stream(content, model, piece=4):
+    base = {"id": f"chatcmpl-mock-{STATS['requests']}", "object": "chat.completion.chunk",
+            "created": int(time.time()), "model": model}
+    for i in range(0, len(content), piece):
+        if CONFIG["token_ms"] and i:
+            await asyncio.sleep(CONFIG["token_ms"] / 1000.0)
+        delta = {"content": content[i:i + piece]}
+        if i == 0:
+            delta["role"] = "assistant"
+        chunk = {**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+        yield f"data: {json.dumps(chunk)}\n\n"
+    done = {**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+    yield f"data: {json.dumps(done)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/admin/down")
+async def admin_down():
+    CONFIG["down"] = True
+    return CONFIG
+
+
+@app.post("/admin/up")
+async def admin_up():
+    CONFIG["down"] = False
+    return CONFIG
+
+
+@app.get("/admin/stats")
+async def admin_stats():
+    return {**STATS, "config": CONFIG}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8001)
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="added to every response")
+    ap.add_argument("--jitter-ms", type=float, default=0.0, help="uniform random extra latency")
+    ap.add_argument("--token-ms", type=float, default=0.0, help="delay between streamed chunks")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    ap.add_argument("--error-status", type=int, default=500)
+    ap.add_argument("--down", action="store_true", help="fail every request until POST /admin/up")
+    args = ap.parse_args()
+    CONFIG.update(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, token_ms=args.token_ms,
+                  error_rate=args.error_rate, error_status=args.error_status, down=args.down)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+
+import pytest
+
+from core import admission
+from core.limits import _Limit
+
+
+def test_classify():
+    assert admission.classify(10, 1) == "cheap"
+    assert admission.classify(admission.ADMISSION_CHEAP_COST, 1) == "cheap"
+    assert admission.classify(admission.ADMISSION_CHEAP_COST + 1, 1) == "medium"
+    assert admission.classify(admission.ADMISSION_EXPENSIVE_COST + 1, 1) == "expensive"
+
+
+def test_classify_over_limits():
+    assert admission.classify(admission.ADMISSION_MAX_COST + 1, 1) is None
+    assert admission.classify(1, admission.ADMISSION_MAX_ROWS + 1) is None
+
+
+def test_planned_statement():
+    assert admission._planned_statement("select 1") == "select 1"
+    # a plain EXPLAIN only plans, so there is nothing to admit
+    assert admission._planned_statement("explain select 1") is None
+    assert admission._planned_statement("EXPLAIN (FORMAT JSON) select 1") is None
+    assert admission._planned_statement("explain analyze select 1") == "select 1"
+    assert admission._planned_statement("explain (analyze, format json) select 1") == "select 1"
+
+
+def test_plan_estimates():
+    plan = [{"Plan": {"Node Type": "Seq Scan", "Total Cost": 123.5, "Plan Rows": 42}}]
+    assert admission.plan_estimates(plan) == (123.5, 42.0)
+
+
+def test_parse_slots():
+    slots = admission._parse_slots("cheap=4, expensive=2 bogus medium=x", 10)
+    assert slots == {"cheap": 4, "medium": 3, "expensive": 2}
+    assert admission._default_slots(10) == {"cheap": 6, "medium": 3, "expensive": 1}
+
+
+def _explain(cost):
+    return lambda sql: [{"Plan": {"Total Cost": cost, "Plan Rows": 10}}]
+
+
+@pytest.fixture
+def one_slot(monkeypatch):
+    slots = {name: _Limit(f"test_{name}", 1) for name in admission.CLASSES}
+    monkeypatch.setattr(admission, "SLOTS", slots)
+    monkeypatch.setattr(admission, "ADMISSION_ENABLED", True)
+    monkeypatch.setattr(admission, "ADMISSION_MAX_WAIT_S", 0.05)
+    return slots
+
+
+def test_blocking_slot_held_until_release(one_slot):
+    explain = _explain(admission.ADMISSION_EXPENSIVE_COST + 1)
+    decision, release = admission.acquire_blocking("select 'blocking 1'", explain)
+    assert decision["class"] == "expensive" and one_slot["expensive"].in_flight == 1
+    with pytest.raises(admission.AdmissionRejected, match="retry later"):
+        with admission.admitted_blocking("select 'blocking 2'", explain):
+            pass
+    # other classes are not affected
+    with admission.admitted_blocking("select 'blocking 3'", _explain(1)) as cheap:
+        assert cheap["class"] == "cheap"
+    release()
+    with admission.admitted_blocking("select 'blocking 2'", explain):
+        # queries inside an admitted block share its slot
+        with admission.admitted_blocking("select 'blocking 4'", explain):
+            assert one_slot["expensive"].in_flight == 1
+    assert one_slot["expensive"].in_flight == 0
+
+
+def test_waiting_thread_gets_the_freed_slot(one_slot, monkeypatch):
+    explain = _explain(admission.ADMISSION_EXPENSIVE_COST + 1)
+    _, release = admission.acquire_blocking("select 'wait 1'", explain)
+    got = []
+    monkeypatch.setattr(admission, "ADMISSION_MAX_WAIT_S", 5)
+    t = threading.Thread(target=lambda: got.append(admission.acquire_blocking("select 'wait 2'", explain)))
+    t.start()
+    release()
+    t.join(5)
+    assert got and one_slot["expensive"].in_flight == 1
+    got[0][1]()
+    assert one_slot["expensive"].in_flight == 0
+
+
+def test_async_acquire_outlives_the_task(one_slot):
+    async def explain(sql):
+        return _explain(admission.ADMISSION_EXPENSIVE_COST + 1)(sql)
+
+    async def main():
+        # taken in one task, released in another, as for a streamed response
+        _, release = await asyncio.ensure_future(admission.acquire("select 'async 1'", explain))
+        with pytest.raises(admission.AdmissionRejected):
+            async with admission.admitted("select 'async 2'", explain):
+                pass
+        await asyncio.ensure_future(release())
+        async with admission.admitted("select 'async 2'", explain):
+            assert one_slot["expensive"].in_flight == 1
+
+    asyncio.run(main())
+    assert one_slot["expensive"].in_flight == 0
@@ -0,0 +1,68 @@
+import itertools
+import math
+import random
+
+import pytest
+
+from core.benchmark import mann_whitney_less, summarize, verdict
+
+
+def _permutation_p(a, b):
+    """One-sided p-value of U by enumerating every split of the pooled samples."""
+    def u(x, y):
+        return sum(1.0 if i > j else 0.5 if i == j else 0.0 for i in x for j in y)
+
+    pooled = list(a) + list(b)
+    observed = u(a, b)
+    total = hits = 0
+    for idx in itertools.combinations(range(len(pooled)), len(a)):
+        chosen = set(idx)
+        x = [pooled[i] for i in idx]
+        y = [pooled[i] for i in range(len(pooled)) if i not in chosen]
+        total += 1
+        hits += u(x, y) <= observed
+    return hits / total
+
+
+def test_exact_complete_separation():
+    assert mann_whitney_less([1, 2, 3, 4, 5], [6, 7, 8, 9, 10]) == pytest.approx(1 / math.comb(10, 5))
+    assert mann_whitney_less([1, 2, 3], [4, 5, 6]) == pytest.approx(0.05)
+    assert mann_whitney_less([4, 5, 6], [1, 2, 3]) == pytest.approx(1.0)
+
+
+def test_exact_matches_permutation_test():
+    rng = random.Random(1)
+    for _ in range(20):
+        a = [rng.random() for _ in range(5)]
+        b = [rng.random() for _ in range(6)]
+        assert mann_whitney_less(a, b) == pytest.approx(_permutation_p(a, b))
+
+
+def test_normal_approximation_with_ties():
+    rng = random.Random(2)
+    for _ in range(10):
+        a = [rng.randint(0, 6) for _ in range(6)]
+        b = [rng.randint(2, 8) for _ in range(6)]
+        assert abs(mann_whitney_less(a, b) - _permutation_p(a, b)) < 0.03
+
+
+def test_empty_samples():
+    assert mann_whitney_less([], [1, 2]) == 1.0
+
+
+def test_verdict():
+    original = [100, 102, 98, 101, 99]
+    assert verdict(original, [50, 51, 49, 52, 48])["verdict"] == "faster"
+    assert verdict(original, [200, 201, 199, 202, 198])["verdict"] == "slower"
+    # significant but below the minimum improvement
+    assert verdict(original, [97, 96.5, 96, 97.5, 96.8])["verdict"] == "inconclusive"
+    assert verdict(original, [])["verdict"] == "inconclusive"
+    out = verdict(original, [50, 51, 49, 52, 48])
+    assert out["speedup"] == 2.0
+    assert out["p_faster"] < 0.05 < out["p_slower"]
+
+
+def test_summarize():
+    s = summarize([5, 1, 3, 2, 4])
+    assert (s["n"], s["median_ms"], s["min_ms"], s["max_ms"], s["p95_ms"]) == (5, 3, 1, 5, 5)
+    assert summarize([]) == {"n": 0}
@@ -0,0 +1,40 @@
+from core.fingerprint import (fingerprint, has_top_level_limit, normalize_sql, referenced_tables,
+                              uses_volatile_functions)
+
+
+def test_normalize_collapses_whitespace_case_and_comments():
+    assert normalize_sql("SELECT  *\nFROM t WHERE a = 5 -- c\n") == "select * from t where a = 5"
+
+
+def test_normalize_strip_literals():
+    out = normalize_sql("select * from t where a = 5 and b = 'x'", strip_literals=True)
+    assert "5" not in out and "'x'" not in out
+    assert out == normalize_sql("select * from t where a = 7 and b = 'y'", strip_literals=True)
+
+
+def test_fingerprint_ignores_formatting():
+    assert fingerprint("SELECT a FROM t") == fingerprint("select   a\nfrom t;")
+    assert fingerprint("select a from t") != fingerprint("select b from t")
+
+
+def test_referenced_tables():
+    assert referenced_tables("select * from public.customer c join rental r on true") == {
+        "public.customer", "rental"}
+
+
+def test_referenced_tables_excludes_ctes_and_functions():
+    assert referenced_tables("with x as (select * from film) select * from x, actor") == {"actor", "film"}
+    assert referenced_tables("select * from generate_series(1, 3)") == set()
+
+
+def test_has_top_level_limit():
+    assert has_top_level_limit("select * from t limit 5")
+    assert has_top_level_limit("select * from t fetch first 5 rows only")
+    assert not has_top_level_limit("select * from (select * from t limit 5) s")
+    assert not has_top_level_limit("with x as (select * from t limit 5) select * from x")
+    assert not has_top_level_limit("select * from t offset 5")
+
+
+def test_uses_volatile_functions():
+    assert uses_volatile_functions("select now()")
+    assert not uses_volatile_functions("select * from t")
@@ -0,0 +1,36 @@
+from core.index_advisor import derive_candidates
+
+
+def _plan():
+    rental = {"Node Type": "Seq Scan", "Relation Name": "rental", "Schema": "public", "Alias": "r",
+              "Filter": "((r.return_date IS NULL) AND (r.staff_id = 1) AND (r.rental_date > now()))"}
+    customer = {"Node Type": "Seq Scan", "Relation Name": "customer", "Schema": "public", "Alias": "c"}
+    join = {"Node Type": "Hash Join", "Hash Cond": "(r.customer_id = c.customer_id)",
+            "Plans": [rental, {"Node Type": "Hash", "Plans": [customer]}]}
+    return [{"Plan": {"Node Type": "Sort", "Sort Key": ["r.last_update DESC"], "Plans": [join]}}]
+
+
+def test_candidates_by_source_and_priority():
+    assert derive_candidates(_plan()) == [
+        {"table": "public.rental", "columns": ["return_date", "staff_id", "rental_date"], "source": "filter"},
+        {"table": "public.rental", "columns": ["customer_id"], "source": "join"},
+        {"table": "public.customer", "columns": ["customer_id"], "source": "join"},
+        {"table": "public.rental", "columns": ["last_update"], "source": "sort"},
+    ]
+
+
+def test_max_candidates():
+    assert len(derive_candidates(_plan(), max_candidates=2)) == 2
+
+
+def test_unaliased_single_table_and_duplicates():
+    scan = {"Node Type": "Seq Scan", "Relation Name": "film", "Filter": "(length > 100)"}
+    plan = {"Plan": {"Node Type": "Sort", "Sort Key": ["length"], "Plans": [scan]}}
+    assert derive_candidates(plan) == [{"table": "film", "columns": ["length"], "source": "filter"}]
+
+
+def test_index_scans_and_expression_sorts_give_nothing():
+    scan = {"Node Type": "Index Scan", "Relation Name": "film", "Index Name": "film_pkey",
+            "Filter": "(length > 100)"}
+    plan = {"Plan": {"Node Type": "Sort", "Sort Key": ["lower(title)"], "Plans": [scan]}}
+    assert derive_candidates(plan) == []
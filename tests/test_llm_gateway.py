@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from core import llm_gateway
+from core.llm_gateway import CircuitBreaker, TokenBucket
+
+
+def test_token_bucket_burst_then_wait():
+    bucket = TokenBucket(rate_per_s=10, burst=2)
+    assert bucket.reserve(0) == 0.0
+    assert bucket.reserve(0) == 0.0
+    # empty: the next token is 0.1 s away, over a zero wait budget
+    assert bucket.reserve(0) is None
+    wait = bucket.reserve(1.0)
+    assert 0.05 < wait <= 0.1
+    # the reservation was taken, so the next caller queues behind it
+    assert bucket.reserve(1.0) > wait
+
+
+def test_token_bucket_refills_up_to_burst():
+    bucket = TokenBucket(rate_per_s=10, burst=2)
+    bucket.reserve(0)
+    bucket.reserve(0)
+    bucket.updated -= 10.0
+    assert bucket.reserve(0) == 0.0
+    assert bucket.reserve(0) == 0.0
+    assert bucket.reserve(0) is None
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failures=3, cooldown_s=60)
+    breaker.record(False)
+    breaker.record(False)
+    breaker.record(True)
+    assert breaker.state == "closed" and breaker.failures == 0
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record(False)
+    assert breaker.state == "open" and breaker.opens == 1
+    assert not breaker.allow()
+
+
+def test_breaker_half_open_single_probe():
+    breaker = CircuitBreaker(failures=1, cooldown_s=60)
+    breaker.record(False)
+    breaker.opened_at -= 60
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+    # a failed probe re-opens it
+    breaker.record(False)
+    assert breaker.state == "open" and breaker.opens == 2
+    breaker.opened_at -= 60
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_breaker_release():
+    breaker = CircuitBreaker(failures=1, cooldown_s=60)
+    # outside half-open a release changes nothing
+    breaker.release()
+    assert breaker.state == "closed" and breaker.failures == 0
+    breaker.record(False)
+    breaker.opened_at -= 60
+    assert breaker.allow()
+    # an abandoned probe frees the probe slot without a verdict
+    breaker.release()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def _half_open_and_rate_limited(model):
+    breaker = llm_gateway._breaker(model)
+    breaker.record(False)
+    breaker.state, breaker.opened_at = "open", 0.0
+    bucket = llm_gateway._bucket(model)
+    bucket.tokens, bucket.rate = 0.0, 1.0   # the probe waits ~1 s for a token
+    return breaker
+
+
+async def _cancel_soon(coro):
+    task = asyncio.ensure_future(coro)
+    await asyncio.sleep(0.05)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+def test_cancel_during_rate_limit_wait_releases_probe():
+    breaker = _half_open_and_rate_limited("test-cancel-chat")
+    asyncio.run(_cancel_soon(llm_gateway.chat_async([], "test-cancel-chat")))
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+def test_cancel_stream_during_rate_limit_wait_releases_probe():
+    breaker = _half_open_and_rate_limited("test-cancel-stream")
+
+    async def consume():
+        async for _ in llm_gateway.chat_stream_async([], "test-cancel-stream"):
+            pass
+
+    asyncio.run(_cancel_soon(consume()))
+    assert breaker.state == "half_open"
+    assert breaker.allow()
@@ -0,0 +1,35 @@
+import json
+
+from core.nl2sql import SqlFieldExtractor
+
+
+def _feed(chunks):
+    ex = SqlFieldExtractor()
+    results = [ex.feed(c) for c in chunks]
+    return ex, [r for r in results if r is not None]
+
+
+def test_sql_returned_once_its_string_closes():
+    ex, found = _feed(['{"reas', 'oning": "x", "sql": "select ', '* from t"', ', "notes": "n"}'])
+    assert found == ["select * from t"]
+    assert ex.sql == "select * from t"
+    assert json.loads(ex.text)["notes"] == "n"
+
+
+def test_escapes_split_across_deltas():
+    sql = 'select "a\\b" from t where c = \'\n\''
+    text = json.dumps({"sql": sql})
+    for cut in range(1, len(text)):
+        _, found = _feed([text[:cut], text[cut:]])
+        assert found == [sql]
+
+
+def test_one_character_at_a_time():
+    sql = 'select \'say "hi"\' from t'
+    _, found = _feed(list(json.dumps({"explanation": "sql: \"x\"", "sql": sql})))
+    assert found == [sql]
+
+
+def test_no_sql_field():
+    _, found = _feed(['{"error": "no ', 'answer"}'])
+    assert found == []
@@ -0,0 +1,88 @@
+import pytest
+
+from core.plan_model import diff_plans, parse_plan
+
+
+def _scan(rel, node="Seq Scan", ms=None, rows=100, cost=10.0, loops=1, **extra):
+    out = {"Node Type": node, "Relation Name": rel, "Alias": rel, "Total Cost": cost, "Plan Rows": rows}
+    if ms is not None:
+        out.update({"Actual Total Time": ms, "Actual Rows": rows, "Actual Loops": loops})
+    out.update(extra)
+    return out
+
+
+def _join(children, ms=None, cost=50.0, rows=100):
+    out = {"Node Type": "Hash Join", "Total Cost": cost, "Plan Rows": rows, "Plans": children}
+    if ms is not None:
+        out.update({"Actual Total Time": ms, "Actual Rows": rows, "Actual Loops": 1})
+    return out
+
+
+def test_exclusive_time_and_cost():
+    plan = parse_plan([{"Plan": _join([_scan("a", ms=30.0), _scan("b", ms=20.0)], ms=80.0),
+                        "Execution Time": 81.0}])
+    root, a, b = plan.nodes
+    assert (root.id, a.id, b.id) == (0, 1, 2)
+    assert root.exclusive_ms == pytest.approx(30.0)
+    assert a.exclusive_ms == pytest.approx(30.0)
+    assert root.exclusive_cost == pytest.approx(30.0)
+    assert plan.total_ms == 81.0
+    assert plan.hot_nodes(1)[0]["share"] == pytest.approx(30.0 / 80.0, abs=1e-4)
+
+
+def test_loops_multiply_per_loop_times():
+    node = parse_plan({"Plan": _scan("a", node="Index Scan", ms=0.5, rows=2, loops=10)}).root
+    assert node.total_ms == pytest.approx(5.0)
+    assert node.rows == 20
+
+
+def test_parallel_workers_divide_time():
+    gather = {"Node Type": "Gather", "Total Cost": 20.0, "Plan Rows": 300, "Workers Launched": 2,
+              "Actual Total Time": 12.0, "Actual Rows": 300, "Actual Loops": 1,
+              "Plans": [_scan("a", ms=10.0, loops=3)]}
+    plan = parse_plan({"Plan": gather})
+    scan = plan.nodes[1]
+    assert scan.total_ms == pytest.approx(10.0)
+    assert plan.root.exclusive_ms == pytest.approx(2.0)
+
+
+def test_q_error():
+    node = parse_plan({"Plan": dict(_scan("a", ms=1.0, rows=1000), **{"Plan Rows": 10})}).root
+    assert node.q_error == pytest.approx(100.0)
+    assert node.underestimated
+
+
+def test_plain_explain_has_no_times():
+    plan = parse_plan([{"Plan": _scan("a")}])
+    assert not plan.analyzed
+    assert plan.total_ms is None and plan.root.exclusive_ms is None
+
+
+def test_diff_plans_access_path_replaced():
+    before = [{"Plan": _join([_scan("a", ms=40.0), _scan("b", ms=10.0)], ms=60.0), "Execution Time": 60.0}]
+    after = [{"Plan": _join([_scan("a", node="Index Scan", ms=2.0, **{"Index Name": "a_idx"}),
+                             _scan("b", ms=10.0)], ms=22.0), "Execution Time": 22.0}]
+    out = diff_plans(before, after)
+    assert out["metric"] == "ms"
+    assert (out["before"], out["after"], out["delta"]) == (60.0, 22.0, -38.0)
+    first = out["nodes"][0]
+    assert first["change"] == "replaced"
+    assert first["before"] == "Seq Scan on a" and first["after"] == "Index Scan using a_idx on a"
+    assert first["delta_ms"] == pytest.approx(-38.0)
+    changes = {(r["before"], r["change"]) for r in out["nodes"]}
+    assert ("Seq Scan on b", "unchanged") in changes
+    assert ("Hash Join", "unchanged") in changes
+    assert len(diff_plans(before, after, top=5)["nodes"]) == 1
+
+
+def test_diff_plans_added_and_removed_by_cost():
+    before = {"Plan": _join([_scan("a", cost=10.0), _scan("b", cost=10.0)], cost=50.0)}
+    after = {"Plan": {"Node Type": "Sort", "Total Cost": 70.0, "Plan Rows": 100,
+                      "Plans": [_scan("a", cost=60.0)]}}
+    out = diff_plans(before, after)
+    assert out["metric"] == "cost"
+    changes = {(r["before"], r["after"], r["change"]) for r in out["nodes"]}
+    assert ("Seq Scan on a", "Seq Scan on a", "costlier") in changes
+    assert ("Hash Join", None, "removed") in changes
+    assert ("Seq Scan on b", None, "removed") in changes
+    assert (None, "Sort", "added") in changes
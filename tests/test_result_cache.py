@@ -0,0 +1,70 @@
+from core.result_cache import ResultCache, cacheable_tables, estimate_size
+
+
+def _result(n, width=100):
+    return {"columns": ["a"], "rows": [["x" * width] for _ in range(n)]}
+
+
+def test_hit_and_version_invalidation():
+    cache = ResultCache(max_bytes=1 << 20, ttl_s=600)
+    key = cache.key("select * from t", 100)
+    assert cache.put(key, _result(1), {"t"}, {"t": 1, "u": 9})
+    result, age = cache.get(key, {"t": 1, "u": 10})   # only tables it read count
+    assert result == _result(1) and age >= 0
+    assert cache.get(key, {"t": 2}) is None
+    assert cache.get(key, {"t": 1}) is None           # dropped on the stale lookup
+    assert (cache.hits, cache.misses, cache.invalidations) == (1, 2, 1)
+
+
+def test_key_includes_row_limit():
+    assert ResultCache.key("select * from t", 10) != ResultCache.key("select * from t", 20)
+    assert ResultCache.key("SELECT * FROM t", 10) == ResultCache.key("select  *  from t", 10)
+
+
+def test_ttl_expiry():
+    cache = ResultCache(max_bytes=1 << 20, ttl_s=10)
+    cache.put("k", _result(1), {"t"}, {"t": 1})
+    cache._data["k"].created_at -= 11
+    assert cache.get("k", {"t": 1}) is None
+
+
+def test_byte_budget_evicts_least_recently_used():
+    size = estimate_size(_result(10))
+    cache = ResultCache(max_bytes=size * 4, ttl_s=600)
+    for k in "abcd":
+        assert cache.put(k, _result(10), {"t"}, {"t": 1})
+    assert cache.get("a", {"t": 1}) is not None       # "b" is now the oldest
+    cache.put("e", _result(10), {"t"}, {"t": 1})
+    assert cache.get("b", {"t": 1}) is None
+    assert cache.get("a", {"t": 1}) is not None
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["entries"] == 4
+    assert stats["bytes"] == 4 * size <= cache.max_bytes
+
+
+def test_oversized_result_rejected():
+    cache = ResultCache(max_bytes=4096, ttl_s=600)
+    assert not cache.put("k", _result(100), {"t"}, {"t": 1})
+    assert cache.stats()["rejected"] == 1 and cache.stats()["bytes"] == 0
+
+
+def test_replacing_a_key_keeps_the_byte_count():
+    cache = ResultCache(max_bytes=1 << 20, ttl_s=600)
+    cache.put("k", _result(10), {"t"}, {"t": 1})
+    cache.put("k", _result(1), {"t"}, {"t": 1})
+    assert cache.stats()["bytes"] == estimate_size(_result(1))
+
+
+def test_invalidate_tables():
+    cache = ResultCache(max_bytes=1 << 20, ttl_s=600)
+    cache.put("a", _result(1), {"t", "u"}, {})
+    cache.put("b", _result(1), {"v"}, {})
+    cache.invalidate_tables(["u"])
+    assert cache.get("a", {}) is None and cache.get("b", {}) is not None
+
+
+def test_cacheable_tables():
+    assert cacheable_tables("select * from t join u on true") == {"t", "u"}
+    assert cacheable_tables("select now()") is None
+    assert cacheable_tables("select * from t where d < now()") is None
+    assert cacheable_tables("select 1") is None
@@ -0,0 +1,37 @@
+import pytest
+
+from core import validator
+
+
+@pytest.mark.parametrize("sql", [
+    "select * from t",
+    "WITH x AS (select 1) select * from x",
+    "explain select * from t",
+    "select last_update from t;",
+    "select 'drop table t' from t",
+])
+def test_safe(sql):
+    assert validator.is_safe_sql(sql)[0]
+
+
+def test_rejects_other_statements():
+    assert validator.is_safe_sql("delete from t") == (False, "Only SELECT/EXPLAIN allowed. Found: delete")
+
+
+def test_rejects_chained_statements():
+    ok, reason = validator.is_safe_sql("select 1; drop table t")
+    assert not ok
+    assert "Semicolons" in reason
+
+
+def test_cached_verdict_matches_scan():
+    for sql in ("select * from t", "update t set a = 1", "select 1; select 2"):
+        assert validator._check(sql) == validator._scan(sql)
+        assert validator._check(sql) == validator._scan(sql)
+
+
+def test_cache_keyed_on_full_text():
+    # statements sharing a long prefix must not share a verdict
+    prefix = "select * from t where a = 1 " + "and a = 1 " * 200
+    assert validator._check(prefix)[0]
+    assert not validator._check(prefix + "; drop table t")[0]